@@ -1,18 +1,48 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+import asyncio
 import uvicorn
 import warnings
 
 # Import routers
 from routers import conversion, documents, tasks, misc
+from services import warmup_service, conversion_executor, job_queue, light_lane, download_service, image_service, image_store
+from config import Config
 
 # --- Initial Setup ---
 warnings.filterwarnings(action="ignore", category=UserWarning, module="pydantic|torch")
 warnings.filterwarnings(action="ignore", category=FutureWarning, module="easyocr")
 
+# --- Lifespan (啟動/關閉) ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 啟動轉換工作行程，並在背景執行模型預熱
+    # /healthz 可立即回應，/readyz 則在預熱完成後才返回就緒
+    await conversion_executor.EXECUTOR.start()
+    warmup_task = asyncio.create_task(warmup_service.run_startup_warmup())
+    light_warmup_task = asyncio.create_task(light_lane.warm_up())
+    # 啟動持久化工作佇列 (會先將上次中斷的工作重新排入)
+    light_workers = Config.LIGHT_JOB_WORKERS if Config.LIGHT_LANE_ENABLED else 0
+    await job_queue.JOB_QUEUE.start(
+        Config.JOB_WORKERS, light_workers=light_workers, download_workers=Config.DOWNLOAD_JOB_WORKERS
+    )
+    # 在背景移除圖片儲存中已無引用的檔案 (例如上次中斷留下的)
+    if Config.IMAGE_STORE_ENABLED:
+        asyncio.create_task(asyncio.to_thread(image_store.collect_garbage, image_service.discard_variants))
+    yield
+    await job_queue.JOB_QUEUE.stop()
+    for task in (warmup_task, light_warmup_task):
+        if not task.done():
+            task.cancel()
+    await conversion_executor.EXECUTOR.shutdown()
+    light_lane.shutdown()
+    image_service.shutdown_optimizer()
+    await download_service.close_client()
+
 # Initialize FastAPI app
-app = FastAPI(title="Docling 文件轉換應用程式")
+app = FastAPI(title="Docling 文件轉換應用程式", lifespan=lifespan)
 
 # --- Static Files and Templates ---
 app.mount("/static", StaticFiles(directory="static"), name="static")
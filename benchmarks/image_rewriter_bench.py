@@ -0,0 +1,122 @@
+"""services/image_rewriter.py 的效能量測
+
+產生含大量 base64 圖片、相對路徑圖片與 `<!-- image -->` 佔位註解的 Markdown / HTML 文件
+(預設 1、10、25、50、100 MB)，量測單次掃描改寫的耗時，並檢查每 MB 耗時不隨文件大小增加 (線性)。
+`--legacy` 會以較小的文件比較原本的多個正規表示式 (只量測掃描，不寫入檔案)。
+
+用法:
+    python benchmarks/image_rewriter_bench.py
+    python benchmarks/image_rewriter_bench.py --sizes 1 10 100 --legacy
+
+每 MB 耗時的最大/最小比值超過 --max-ratio 時以結束碼 1 結束。
+"""
+import argparse
+import base64
+import importlib.util
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+# 直接載入模組檔案，不經過 services/__init__.py (避免匯入 docling)
+_MODULE_PATH = Path(__file__).resolve().parent.parent / "services" / "image_rewriter.py"
+_spec = importlib.util.spec_from_file_location("image_rewriter", _MODULE_PATH)
+image_rewriter = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(image_rewriter)
+
+MB = 1024 * 1024
+
+# 原本 process_markdown_images / process_html_images 使用的正規表示式
+_LEGACY_PATTERNS = {
+    "markdown": [
+        r'!\[(.*?)\]\((data:image\/([^;]+);base64,([^)]+))\)',
+        r'!\[(.*?)\]\((?!data:|https?:|/)([^)]+?)\)',
+        r'<!-- image -->',
+    ],
+    "html": [
+        r'<img(?:[^>]*?)src="(data:image\/([^;]+);base64,([^"]+))"(?:[^>]*?)alt="([^"]*)"(?:[^>]*?)>',
+        r'<img(?:[^>]*?)src="(data:image\/([^;]+);base64,([^"]+))"(?:[^>]*?)>',
+        r'<img(?:[^>]*?)src="(?!data:|https?:|/)([^"]+)"(?:[^>]*?)alt="([^"]*)"(?:[^>]*?)>',
+        r'<img(?:[^>]*?)src="(?!data:|https?:|/)([^"]+)"(?:[^>]*?)>',
+        r'<!-- image -->',
+    ],
+}
+
+def build_document(syntax: str, size_bytes: int, image_bytes: int = 256 * 1024) -> str:
+    """產生約 size_bytes 大小的文件：文字段落與各種圖片引用交錯"""
+    payload = base64.b64encode(os.urandom(image_bytes * 3 // 4)).decode("ascii")
+    paragraph = ("Lorem ipsum dolor sit amet, [link](http://example.com) consectetur ![alt text "
+                 "adipiscing elit (not an image).\n") * 20
+    if syntax == "markdown":
+        blocks = [
+            paragraph,
+            f"![Figure]( data-not-image )\n![Image](data:image/png;base64,{payload})\n",
+            "![chart](images/chart.png)\n<!-- image -->\n![remote](https://example.com/a.png)\n",
+        ]
+    else:
+        html_paragraph = f"<p>{paragraph}</p>\n"
+        blocks = [
+            html_paragraph,
+            f'<figure><img loading="lazy" src="data:image/png;base64,{payload}" alt="Image"></figure>\n',
+            '<img src="images/chart.png"><!-- image --><img src="https://example.com/a.png" alt="r">\n',
+        ]
+    unit = "".join(blocks)
+    repeat = max(1, size_bytes // len(unit))
+    return unit * repeat
+
+def replace_without_decoding(reference):
+    # 只量測掃描與輸出組合：以短路徑取代，不解碼、不寫檔
+    if reference.kind == image_rewriter.KIND_PLACEHOLDER:
+        return "![Image](/static/images/doc/placeholder.png)"
+    return f"![{reference.alt or ''}](/static/images/doc/{reference.start}.png)"
+
+def time_rewrite(syntax: str, content: str, repeat: int) -> float:
+    rewrite = image_rewriter.rewrite_markdown if syntax == "markdown" else image_rewriter.rewrite_html
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        counts = {}
+        rewrite(content, replace_without_decoding, counts)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def time_legacy(syntax: str, content: str) -> float:
+    start = time.perf_counter()
+    for pattern in _LEGACY_PATTERNS[syntax]:
+        list(re.finditer(pattern, content))
+    return time.perf_counter() - start
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="image_rewriter 線性掃描效能量測")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 25, 50, 100], help="文件大小 (MB)")
+    parser.add_argument("--syntax", choices=["markdown", "html", "both"], default="both")
+    parser.add_argument("--repeat", type=int, default=3, help="每個大小量測次數 (取最佳值)")
+    parser.add_argument("--max-ratio", type=float, default=2.0, help="每 MB 耗時最大/最小比值的上限")
+    parser.add_argument("--legacy", action="store_true", help="同時量測原本的正規表示式 (只用前兩個大小)")
+    args = parser.parse_args()
+
+    syntaxes = ["markdown", "html"] if args.syntax == "both" else [args.syntax]
+    failed = False
+    for syntax in syntaxes:
+        print(f"\n== {syntax} ==")
+        print(f"{'size (MB)':>10} {'seconds':>10} {'ms/MB':>10} {'MB/s':>10}" + (f" {'legacy s':>10}" if args.legacy else ""))
+        per_mb = []
+        for index, size in enumerate(sorted(args.sizes)):
+            content = build_document(syntax, int(size * MB))
+            actual_mb = len(content) / MB
+            seconds = time_rewrite(syntax, content, args.repeat)
+            per_mb.append(seconds / actual_mb)
+            line = f"{actual_mb:>10.1f} {seconds:>10.3f} {seconds / actual_mb * 1000:>10.2f} {actual_mb / seconds:>10.1f}"
+            if args.legacy and index < 2:
+                line += f" {time_legacy(syntax, content):>10.3f}"
+            print(line)
+            del content
+        ratio = max(per_mb) / min(per_mb)
+        status = "OK" if ratio <= args.max_ratio else "FAIL"
+        print(f"每 MB 耗時最大/最小比值: {ratio:.2f} (上限 {args.max_ratio}) -> {status}")
+        failed = failed or ratio > args.max_ratio
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from typing import Dict
 from models import ConversionOptions # 從 models.py 匯入
@@ -7,17 +8,16 @@ OUTPUT_DIR = Path("output")
 UPLOADS_DIR = Path("uploads")
 IMAGES_DIR = Path("static/images")
 TEMPLATES_DIR = Path("templates")
+DATA_DIR = Path("data")
 
 OUTPUT_DIR.mkdir(exist_ok=True)
 UPLOADS_DIR.mkdir(exist_ok=True)
 IMAGES_DIR.mkdir(exist_ok=True, parents=True)
+DATA_DIR.mkdir(exist_ok=True)
 
 # 全域變數來儲存轉換進度 (之後會考慮移到更合適的地方，例如 Service 或資料庫)
 CONVERSION_PROGRESS: Dict[str, Dict] = {}
 
-# 儲存活躍的批次任務 (之後會考慮移到更合適的地方，例如 Service 或資料庫)
-ACTIVE_BATCH_TASKS: Dict[str, Dict] = {}
-
 # 建立全域的預設設定
 DEFAULT_CONVERSION_OPTIONS = ConversionOptions()
 
@@ -30,6 +30,7 @@ class Config:
     UPLOADS_DIR = UPLOADS_DIR
     IMAGES_DIR = IMAGES_DIR
     TEMPLATES_DIR = TEMPLATES_DIR
+    DATA_DIR = DATA_DIR
     
     # API 設定
     HOST = "0.0.0.0"
@@ -37,7 +38,116 @@ class Config:
     DEBUG = True
     
     # Docling 核心設定
-    DOCLING_TIMEOUT = 120  # 秒
+    DOCLING_TIMEOUT = float(os.getenv("DOCLING_TIMEOUT", "120"))  # 單一文件轉換的預設逾時 (秒)
+    DOCLING_MAX_TIMEOUT = float(os.getenv("DOCLING_MAX_TIMEOUT", "1800"))  # 每個請求可指定的逾時上限 (秒)
+
+    # 轉換器池設定 (依選項快取已初始化的 DocumentConverter)
+    CONVERTER_POOL_SIZE = int(os.getenv("DOCLING_CONVERTER_POOL_SIZE", "4"))
+
+    # 轉換工作行程數 (0 表示在主行程的執行緒中執行)
+    CONVERSION_WORKERS = int(os.getenv("DOCLING_CONVERSION_WORKERS", str(max(1, (os.cpu_count() or 4) // 4))))
+
+    # ocr_mode="auto" 的逐頁判斷門檻
+    OCR_AUTO_MIN_CHARS = int(os.getenv("DOCLING_OCR_AUTO_MIN_CHARS", "20"))  # 文字層字元數低於此值視為沒有文字層
+    OCR_AUTO_MIN_QUALITY = float(os.getenv("DOCLING_OCR_AUTO_MIN_QUALITY", "0.9"))  # 可辨識字元比例低於此值視為亂碼
+    OCR_AUTO_BITMAP_THRESHOLD = float(os.getenv("DOCLING_OCR_AUTO_BITMAP_THRESHOLD", "0.05"))  # 點陣區域佔頁面比例達此值時 OCR 該區域
+
+    # 分頁平行轉換設定 (ConversionOptions.shard_pages 啟用時)
+    SHARD_PAGE_SIZE = int(os.getenv("DOCLING_SHARD_PAGE_SIZE", "50"))  # 每個分片的頁數
+    SHARD_MAX_PARALLEL = int(os.getenv("DOCLING_SHARD_MAX_PARALLEL", str(max(1, CONVERSION_WORKERS))))  # 同一文件同時轉換的分片數
+
+    # 輕量線道設定 (DOCX、HTML、Markdown 等不需要模型的格式)
+    LIGHT_LANE_ENABLED = os.getenv("DOCLING_LIGHT_LANE_ENABLED", "true").lower() == "true"
+    LIGHT_WORKERS = int(os.getenv("DOCLING_LIGHT_WORKERS", "2"))  # 輕量轉換執行緒數
+    LIGHT_JOB_WORKERS = int(os.getenv("DOCLING_LIGHT_JOB_WORKERS", "2"))  # 輕量線道的佇列 worker 數
+
+    # 批次轉換設定：同一批次的檔案分組後，每組以單一轉換器串流轉換
+    BATCH_CHUNK_SIZE = int(os.getenv("DOCLING_BATCH_CHUNK_SIZE", "10"))  # 每組的檔案數上限
+    BATCH_EXPORT_CONCURRENCY = int(os.getenv("DOCLING_BATCH_EXPORT_CONCURRENCY", "2"))  # 與轉換重疊進行的匯出數
+    DOWNLOAD_JOB_WORKERS = int(os.getenv("DOCLING_DOWNLOAD_JOB_WORKERS", "1"))  # 批次 URL 下載線道的佇列 worker 數 (不佔用轉換線道)
+
+    # 逐頁進度回報的最小間隔 (秒)，避免每頁都寫入進度
+    PROGRESS_MIN_INTERVAL = float(os.getenv("DOCLING_PROGRESS_MIN_INTERVAL", "0.5"))
+
+    # 工作佇列設定
+    JOB_DB_PATH = DATA_DIR / "jobs.sqlite3"
+    JOB_WORKERS = int(os.getenv("DOCLING_JOB_WORKERS", str(max(1, CONVERSION_WORKERS))))  # 同時執行的轉換工作數
+    JOB_MAX_ATTEMPTS = 3  # 服務中斷後重新排入佇列的最大次數
+
+    # 准入控制設定 (成本以等效頁數計算)
+    ADMISSION_BUDGET_PAGES = float(os.getenv("DOCLING_ADMISSION_BUDGET_PAGES", "200"))  # 同時轉換中的成本上限
+    ADMISSION_MODE = os.getenv("DOCLING_ADMISSION_MODE", "queue").lower()  # queue: 預算不足時排隊；reject: 直接回應 429
+    ADMISSION_MAX_QUEUED_JOBS = int(os.getenv("DOCLING_ADMISSION_MAX_QUEUED_JOBS", "500"))  # 佇列中的工作數上限
+    ADMISSION_MIN_FREE_MEMORY_MB = int(os.getenv("DOCLING_ADMISSION_MIN_FREE_MEMORY_MB", "1024"))  # 可用記憶體低於此值時拒絕新請求
+    ADMISSION_OCR_COST_FACTOR = float(os.getenv("DOCLING_ADMISSION_OCR_COST_FACTOR", "3.0"))  # 整頁 OCR 的成本倍率
+    ADMISSION_BYTES_PER_PAGE = 100 * 1024  # 無法取得頁數的文件，以每 100 KB 視為一頁
+    ADMISSION_RETRY_AFTER = 30  # 尚無耗時統計時建議的 Retry-After (秒)
+
+    # 上傳檔案設定 (串流寫入並依內容雜湊存放，相同內容只保存一份)
+    UPLOAD_MAX_FILE_BYTES = int(os.getenv("DOCLING_UPLOAD_MAX_FILE_BYTES", str(500 * 1024 ** 2)))  # 單一檔案上限，預設 500 MB
+    UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("DOCLING_UPLOAD_MAX_REQUEST_BYTES", str(2 * 1024 ** 3)))  # 單次請求總大小上限，預設 2 GB
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # 每次讀取、雜湊與寫入的區塊大小
+    UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("DOCLING_UPLOAD_SPOOL_MAX_BYTES", str(16 * 1024 ** 2)))  # 不超過此大小的單檔上傳保留在記憶體中直接轉換
+    UPLOAD_MEMORY_MAX_BYTES = int(os.getenv("DOCLING_UPLOAD_MEMORY_MAX_BYTES", str(512 * 1024 ** 2)))  # 記憶體中上傳內容的總量上限，超過時寫入磁碟
+    UPLOAD_RETAIN = os.getenv("DOCLING_UPLOAD_RETAIN", "true").lower() == "true"  # false: 不保存上傳檔案 (轉換後即丟棄)
+
+    # URL 下載設定 (以串流方式寫入磁碟)
+    DOWNLOAD_MAX_BYTES = int(os.getenv("DOCLING_DOWNLOAD_MAX_BYTES", str(500 * 1024 ** 2)))  # 單一 URL 的大小上限，預設 500 MB
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 每次讀取與寫入的區塊大小
+    DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOCLING_DOWNLOAD_CONNECT_TIMEOUT", "10"))  # 建立連線的逾時 (秒)
+    DOWNLOAD_IDLE_TIMEOUT = float(os.getenv("DOCLING_DOWNLOAD_IDLE_TIMEOUT", "30"))  # 兩個區塊之間沒有收到資料的逾時 (秒)
+    DOWNLOAD_TOTAL_TIMEOUT = float(os.getenv("DOCLING_DOWNLOAD_TOTAL_TIMEOUT", "900"))  # 整個下載 (含重試) 的期限 (秒)
+    DOWNLOAD_MAX_RETRIES = int(os.getenv("DOCLING_DOWNLOAD_MAX_RETRIES", "3"))  # 暫時性錯誤的重試次數 (支援時以 Range 續傳)
+
+    # 共用 HTTP 連線池設定 (所有 URL 下載共用同一個用戶端)
+    HTTP_MAX_CONNECTIONS = int(os.getenv("DOCLING_HTTP_MAX_CONNECTIONS", "100"))  # 全部主機的連線總數上限
+    HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("DOCLING_HTTP_MAX_CONNECTIONS_PER_HOST", "6"))  # 同一主機同時進行的下載數
+    HTTP_KEEPALIVE_EXPIRY = float(os.getenv("DOCLING_HTTP_KEEPALIVE_EXPIRY", "30"))  # 閒置連線保留秒數
+    HTTP2_ENABLED = os.getenv("DOCLING_HTTP2_ENABLED", "true").lower() == "true"  # 需安裝 h2 套件 (pip install httpx[http2])
+
+    # URL 來源快取：記錄 ETag/Last-Modified 與內容雜湊，以條件式請求確認遠端文件是否變更
+    URL_CACHE_ENABLED = os.getenv("DOCLING_URL_CACHE_ENABLED", "true").lower() == "true"
+    URL_CACHE_DIR = DATA_DIR / "url_cache"
+
+    # 批次 URL 轉換：同時下載的 URL 數 (同一主機另受 HTTP_MAX_CONNECTIONS_PER_HOST 限制) 與單次請求的 URL 上限
+    URL_BATCH_CONCURRENCY = int(os.getenv("DOCLING_URL_BATCH_CONCURRENCY", "16"))
+    URL_BATCH_MAX_URLS = int(os.getenv("DOCLING_URL_BATCH_MAX_URLS", "1000"))
+
+    # 轉換結果快取設定
+    RESULT_CACHE_ENABLED = os.getenv("DOCLING_RESULT_CACHE_ENABLED", "true").lower() == "true"
+    RESULT_CACHE_DIR = DATA_DIR / "result_cache"
+    RESULT_CACHE_MAX_BYTES = int(os.getenv("DOCLING_RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))  # 預設 2 GB
+
+    # 內容定址圖片儲存：匯出的圖片依內容雜湊只保存一份，各文件的 static/images/<主檔名>/ 以硬連結引用 (見 services/image_store.py)
+    IMAGE_STORE_ENABLED = os.getenv("DOCLING_IMAGE_STORE_ENABLED", "true").lower() == "true"
+    IMAGE_STORE_DIR = DATA_DIR / "image_store"
+
+    # 圖片最佳化：/images/<主檔名>/<檔名> 提供轉檔 (webp 或 jpeg) 並限制尺寸的版本與縮圖，首次請求時產生並快取
+    IMAGE_OPTIMIZE_ENABLED = os.getenv("DOCLING_IMAGE_OPTIMIZE_ENABLED", "true").lower() == "true"
+    IMAGE_OPTIMIZE_FORMAT = os.getenv("DOCLING_IMAGE_OPTIMIZE_FORMAT", "webp").lower()  # webp 或 jpeg
+    IMAGE_OPTIMIZE_QUALITY = int(os.getenv("DOCLING_IMAGE_OPTIMIZE_QUALITY", "80"))
+    IMAGE_MAX_DIMENSION = int(os.getenv("DOCLING_IMAGE_MAX_DIMENSION", "1600"))  # 最佳化版本的最長邊 (像素)，0 表示不縮小
+    IMAGE_THUMBNAIL_SIZE = int(os.getenv("DOCLING_IMAGE_THUMBNAIL_SIZE", "320"))  # 縮圖的最長邊 (像素)
+    IMAGE_OPTIMIZE_WORKERS = int(os.getenv("DOCLING_IMAGE_OPTIMIZE_WORKERS", "2"))
+    # 匯出圖片時即在背景產生最佳化版本 (不等待完成，不增加轉換時間)
+    IMAGE_OPTIMIZE_PREGENERATE = os.getenv("DOCLING_IMAGE_OPTIMIZE_PREGENERATE", "true").lower() == "true"
+    IMAGE_VARIANT_DIR = DATA_DIR / "image_variants"
+
+    # 文件儲存設定：每次轉換的 DoclingDocument 保存為標準產物，其他格式可依需求再產生
+    DOCUMENT_STORE_ENABLED = os.getenv("DOCLING_DOCUMENT_STORE_ENABLED", "true").lower() == "true"
+    DOCUMENT_STORE_DIR = DATA_DIR / "documents"
+    DOCUMENT_CACHE_SIZE = int(os.getenv("DOCLING_DOCUMENT_CACHE_SIZE", "16"))  # 記憶體中保留的已反序列化文件數
+    # json: DoclingDocument JSON (圖片以 base64 內嵌)；binary: zlib 壓縮的標頭 + 原始圖片位元組 (見 services/document_codec.py)
+    DOCUMENT_STORE_FORMAT = os.getenv("DOCLING_DOCUMENT_STORE_FORMAT", "json").lower()
+    DOCUMENT_STORE_COMPRESSION_LEVEL = int(os.getenv("DOCLING_DOCUMENT_STORE_COMPRESSION_LEVEL", "6"))
+
+    # 本地模型檔案目錄 (離線環境使用，None 表示從網路下載)
+    DOCLING_ARTIFACTS_PATH = os.getenv("DOCLING_ARTIFACTS_PATH") or None
+
+    # 啟動預熱設定
+    WARMUP_ENABLED = os.getenv("DOCLING_WARMUP_ENABLED", "true").lower() == "true"
+    WARMUP_RUN_SAMPLE = os.getenv("DOCLING_WARMUP_RUN_SAMPLE", "true").lower() == "true"
+    WARMUP_PROFILES = [DEFAULT_CONVERSION_OPTIONS]  # 啟動時預先建立轉換器的選項組合
     
     # 預設選項
     DEFAULT_CONVERSION_OPTIONS = DEFAULT_CONVERSION_OPTIONS
@@ -30,6 +30,9 @@ class ConversionRequest(BaseModel):
     enrich_picture_description: bool = False
     num_threads: int = 4
     device: AcceleratorDevice = AcceleratorDevice.AUTO
+    ocr_mode: Literal["standard", "auto"] = "standard"  # auto: 依各頁文字層逐頁決定是否 OCR
+    shard_pages: bool = False  # 大型 PDF 分頁平行轉換
+    timeout: Optional[float] = None  # 轉換逾時秒數 (None 使用 Config.DOCLING_TIMEOUT)
 
 class ProgressInfo(BaseModel):
     task_id: str
@@ -60,3 +63,12 @@ class ConversionOptions(BaseModel):
     enrich_picture_description: bool = False
     num_threads: int = 4
     device: AcceleratorDevice = AcceleratorDevice.AUTO
+    ocr_mode: Literal["standard", "auto"] = "standard"  # auto: 依各頁文字層逐頁決定是否 OCR
+    shard_pages: bool = False  # 大型 PDF 分頁平行轉換
+    timeout: Optional[float] = None  # 轉換逾時秒數 (None 使用 Config.DOCLING_TIMEOUT)
+
+class BatchUrlConversionRequest(BaseModel):
+    """批次 URL 轉換請求"""
+    urls: List[str]
+    format: List[Literal["markdown", "json", "yaml", "html", "text", "doctags"]] = ["markdown"]
+    options: ConversionOptions = ConversionOptions()
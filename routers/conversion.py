@@ -1,27 +1,40 @@
+import asyncio
+import math
 import uuid
 import os
 from typing import Optional, Literal, List
 from urllib.parse import urlparse
 from fastapi import (
-    APIRouter, Form, UploadFile, File, HTTPException, 
-    Query, BackgroundTasks, Depends, Request
+    APIRouter, HTTPException, 
+    Query, Depends, Request
 )
+from fastapi.encoders import jsonable_encoder
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
+from pydantic import ValidationError
 
-from models import ConversionOptions
-from services import file_service, conversion_service, progress_service
+from models import ConversionOptions, BatchUrlConversionRequest
+from services import file_service, conversion_service, progress_service, job_queue, admission_service, light_lane, upload_service
 from docling_core.types.doc import ImageRefMode
 from docling.datamodel.pipeline_options import (
     PdfPipeline, VlmModelType, EasyOcrOptions, PdfBackend, TableFormerMode, AcceleratorDevice
 )
-from config import ACTIVE_BATCH_TASKS, TEMPLATES_DIR # Import batch tasks dict and templates dir
-import time
+from config import TEMPLATES_DIR, Config
 
 router = APIRouter()
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
+def _reject_if_saturated() -> None:
+    """佇列已滿或主機資源不足時回應 429，請用戶端於 Retry-After 秒後重試"""
+    retry_after = admission_service.ADMISSION.retry_after(job_queue.JOB_QUEUE.queued_count())
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="轉換服務忙碌中，請稍後再試",
+            headers={"Retry-After": str(retry_after)},
+        )
+
 @router.get("/file-convert", response_class=HTMLResponse)
 async def file_convert_page(request: Request):
     """統一的檔案轉換頁面，支援單一和批量檔案轉換功能"""
@@ -30,15 +43,15 @@ async def file_convert_page(request: Request):
 
 @router.get("/convert-url")
 async def convert_url(
-    background_tasks: BackgroundTasks,
     source: str = Query(..., description="文件 URL 地址"),
     output_filename: Optional[str] = Query(None, description="輸出檔案名稱"),
-    format: Literal["markdown", "json", "yaml", "html", "text", "doctags"] = Query("markdown", description="輸出格式"),
+    format: List[Literal["markdown", "json", "yaml", "html", "text", "doctags"]] = Query(["markdown"], description="輸出格式 (可重複指定，一次轉換匯出多種格式)"),
     image_export_mode: ImageRefMode = Query(ImageRefMode.REFERENCED, description="圖片匯出模式"),
     pipeline: PdfPipeline = Query(PdfPipeline.STANDARD, description="PDF 處理管道"),
     vlm_model: VlmModelType = Query(VlmModelType.SMOLDOCLING, description="VLM 模型"),
     ocr: bool = Query(True, description="啟用 OCR"),
     force_ocr: bool = Query(False, description="強制 OCR"),
+    ocr_mode: Literal["standard", "auto"] = Query("standard", description="OCR 模式 (auto: 逐頁判斷是否 OCR)"),
     ocr_engine: str = Query(EasyOcrOptions.kind, description="OCR 引擎"),
     ocr_lang: Optional[str] = Query(None, description="OCR 語言 (逗號分隔)"),
     pdf_backend: PdfBackend = Query(PdfBackend.DLPARSE_V2, description="PDF 後端"),
@@ -48,12 +61,20 @@ async def convert_url(
     enrich_picture_classes: bool = Query(False, description="圖片分類"),
     enrich_picture_description: bool = Query(False, description="圖片描述"),
     num_threads: int = Query(4, description="線程數"),
-    device: AcceleratorDevice = Query(AcceleratorDevice.AUTO, description="加速器裝置")
+    device: AcceleratorDevice = Query(AcceleratorDevice.AUTO, description="加速器裝置"),
+    shard_pages: bool = Query(False, description="大型 PDF 分頁平行轉換"),
+    timeout: Optional[float] = Query(None, gt=0, description="轉換逾時秒數 (預設使用伺服器設定)")
 ):
     if not source.startswith(('http://', 'https://')):
         raise HTTPException(status_code=422, detail="無效的URL格式。URL必須以 http:// 或 https:// 開頭。")
+    # URL 路徑為輕量格式時走輕量線道 (下載後仍會依實際檔案類型選擇轉換器)
+    lane = job_queue.LANE_LIGHT if light_lane.is_light_document(urlparse(source).path) else job_queue.LANE_STANDARD
+    if lane == job_queue.LANE_STANDARD:
+        _reject_if_saturated()
 
     task_id = str(uuid.uuid4())
+    # 多種格式共用同一個主檔名，輸出檔名以第一個格式的副檔名表示
+    formats = file_service.normalize_formats(format)
     
     # 決定輸出檔名
     final_output_filename = output_filename # Start with user provided
@@ -62,169 +83,220 @@ async def convert_url(
         base_name = os.path.basename(url_path) if url_path and os.path.basename(url_path) else "document_from_url"
         # Use determine_output_path to handle unique name and extension
         # Need the original filename part for stem, use base_name
-        temp_path_for_naming = file_service.determine_output_path(base_name, format, None) 
+        temp_path_for_naming = file_service.determine_output_path(base_name, formats[0], None)
         final_output_filename = temp_path_for_naming.name # Get the final name with extension
     else:
         # Ensure provided filename has correct extension
-        ext = file_service.get_file_extension(format)
+        ext = file_service.get_file_extension(formats[0])
         if not final_output_filename.endswith(ext):
             final_output_filename = f"{final_output_filename.rstrip('.')}{ext}"
 
     # 初始化進度
     progress_service.update_progress(task_id, 0, "queued", "已加入佇列，準備下載")
 
-    # 建立選項字典以傳遞給背景任務
+    # 建立選項字典以傳遞給佇列工作 (JSON 模式以便持久化)
     options_dict = ConversionOptions(
          image_export_mode=image_export_mode,
-         pipeline=pipeline, vlm_model=vlm_model, ocr=ocr, force_ocr=force_ocr,
+         pipeline=pipeline, vlm_model=vlm_model, ocr=ocr, force_ocr=force_ocr, ocr_mode=ocr_mode,
          ocr_engine=ocr_engine, ocr_lang=ocr_lang, pdf_backend=pdf_backend,
          table_mode=table_mode, enrich_code=enrich_code, enrich_formula=enrich_formula,
          enrich_picture_classes=enrich_picture_classes, enrich_picture_description=enrich_picture_description,
-         num_threads=num_threads, device=device
-    ).dict()
-
-    # 將任務添加到背景
-    background_tasks.add_task(
-        conversion_service.process_url_conversion_task,
-        task_id=task_id,
-        source_url=source,
-        output_filename=final_output_filename,
-        format=format,
-        conversion_options_dict=options_dict
+         num_threads=num_threads, device=device, shard_pages=shard_pages,
+         timeout=timeout
+    ).model_dump(mode="json")
+
+    # 將任務加入持久化佇列 (單一 URL 為互動式優先等級)
+    job_queue.JOB_QUEUE.create_task(task_id, kind="url", file_count=1, options=options_dict)
+    job_queue.JOB_QUEUE.enqueue(
+        task_id,
+        kind="url",
+        payload={
+            "source_url": source,
+            "output_filename": final_output_filename,
+            "format": formats,
+            "conversion_options_dict": options_dict,
+        },
+        priority=job_queue.PRIORITY_INTERACTIVE,
+        lane=lane,
     )
 
     return {
         "status": "success",
         "message": "URL 轉換已加入背景佇列",
         "task_id": task_id,
-        "output_filename": final_output_filename
+        "output_filename": final_output_filename,
+        "output_filenames": [p.name for p in file_service.format_output_paths(Path(final_output_filename), formats).values()],
     }
 
+_BATCH_FORMATS = ("markdown", "json", "yaml", "html", "text", "doctags")
+
+def _form_value(fields: dict, name: str, default=None):
+    """表單欄位的值 (重複時取最後一個)；空字串視為未提供"""
+    values = [value for value in fields.get(name, []) if value != ""]
+    return values[-1] if values else default
+
 @router.post("/batch-convert")
-async def batch_convert(
-    # Use same parameters as original endpoint
-    files: List[UploadFile] = File(...),
-    format: Literal["markdown", "json", "yaml", "html", "text", "doctags"] = Form("markdown"),
-    image_export_mode: ImageRefMode = Form(ImageRefMode.REFERENCED),
-    pipeline: PdfPipeline = Form(PdfPipeline.STANDARD),
-    vlm_model: VlmModelType = Form(VlmModelType.SMOLDOCLING),
-    ocr: bool = Form(True),
-    force_ocr: bool = Form(False),
-    ocr_engine: str = Form(EasyOcrOptions.kind),
-    ocr_lang: Optional[str] = Form(None),
-    pdf_backend: PdfBackend = Form(PdfBackend.DLPARSE_V2),
-    table_mode: TableFormerMode = Form(TableFormerMode.ACCURATE),
-    enrich_code: bool = Form(False),
-    enrich_formula: bool = Form(False),
-    enrich_picture_classes: bool = Form(False),
-    enrich_picture_description: bool = Form(False),
-    num_threads: int = Form(4),
-    device: AcceleratorDevice = Form(AcceleratorDevice.AUTO)
-):
+async def batch_convert(request: Request):
+    """批次上傳並轉換檔案 (multipart/form-data)
+
+    欄位: files (可重複)、format (可重複，markdown/json/yaml/html/text/doctags)、ConversionOptions 的各欄位，
+    以及 timeout (每個檔案的轉換逾時秒數) 與 wait (False 時立即返回 task_id)。
+    請求直接以串流解析：上傳內容邊接收邊寫入暫存檔，大小上限在接收過程中即檢查。
+    """
+    upload_budget = upload_service.UploadBudget()
+    try:
+        fields, files = await upload_service.receive_form(request, upload_budget)
+    except upload_service.UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        return await _batch_convert(fields, files)
+    finally:
+        # 未移入儲存的上傳 (例如請求被拒絕) 刪除其暫存檔
+        for file in files:
+            file.close()
+
+async def _batch_convert(fields: dict, files: List[upload_service.IncomingUpload]):
+    if not files:
+        raise HTTPException(status_code=422, detail="至少需要一個檔案")
+    format = [value for value in fields.get("format", []) if value] or ["markdown"]
+    invalid_formats = [value for value in format if value not in _BATCH_FORMATS]
+    if invalid_formats:
+        raise HTTPException(status_code=422, detail=f"不支援的輸出格式: {invalid_formats[0]}")
+    # Create ConversionOptions object from Form data
+    try:
+        options = ConversionOptions(**{
+            name: _form_value(fields, name) for name in ConversionOptions.model_fields if _form_value(fields, name) is not None
+        })
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=jsonable_encoder(e.errors()))
+    if options.timeout is not None and options.timeout <= 0:
+        raise HTTPException(status_code=422, detail="timeout 必須大於 0")
+    wait = str(_form_value(fields, "wait", "true")).lower() in ("true", "1", "yes", "on")
+
+    # 只有輕量格式的請求不受標準線道壅塞影響
+    if not all(light_lane.is_light_document(file.filename) for file in files):
+        _reject_if_saturated()
     task_id = uuid.uuid4().hex
-    results = []
     total_files = len(files)
+    formats = file_service.normalize_formats(format)
 
-    # Create ConversionOptions object from Form data
-    options = ConversionOptions(
-        image_export_mode=image_export_mode,
-        pipeline=pipeline, vlm_model=vlm_model, ocr=ocr, force_ocr=force_ocr,
-        ocr_engine=ocr_engine, ocr_lang=ocr_lang, pdf_backend=pdf_backend,
-        table_mode=table_mode, enrich_code=enrich_code, enrich_formula=enrich_formula,
-        enrich_picture_classes=enrich_picture_classes, enrich_picture_description=enrich_picture_description,
-        num_threads=num_threads, device=device
-    )
+    options_dict = options.model_dump(mode="json")
+    progress_service.update_progress(task_id, 0, "queued", f"已加入佇列: {total_files} 個檔案")
 
-    # Initialize batch task record and progress
-    ACTIVE_BATCH_TASKS[task_id] = {
-        "created_at": time.time(),
-        "file_count": total_files,
-        "results": [],
-        "options": options.dict(), # Store options used for this batch
-        "status": "init"
-    }
-    progress_service.update_progress(task_id, 0, "init", "初始化檔案轉換")
-
-    img_export_mode_value = image_export_mode.value if hasattr(image_export_mode, 'value') else image_export_mode
-
-    for i, file in enumerate(files):
-        current_progress = int(((i + 0.5) / total_files) * 100) # Progress midway through file
-        progress_service.update_progress(task_id, current_progress, "processing", f"處理檔案 {i+1}/{total_files}: {file.filename}")
-        
-        uploaded_file_path = None
-        file_result = {"original_filename": file.filename, "status": "pending", "output_filename": None}
-
-        try:
-            # 1. Save uploaded file
-            uploaded_file_path = file_service.save_uploaded_file(file)
-
-            # 2. Determine output path (provide None for output_filename to generate unique)
-            output_path = file_service.determine_output_path(
-                original_filename=file.filename, 
-                format=format, 
-                output_filename=None 
-            )
-            output_filename_final = output_path.name
-
-            # 3. Run conversion
-            conversion_result = conversion_service.run_conversion(uploaded_file_path, options)
-
-            # 4. Export document
-            content = None
-            export_result = await file_service.export_document(
-                result=conversion_result,
-                format=format,
-                image_export_mode=img_export_mode_value,
-                out_path=str(output_path)
+    # 1. Group the uploads: lightweight formats (DOCX, HTML, Markdown, ...) are single-file jobs
+    #    on the light lane, everything else is chunked for the standard lane
+    priority = job_queue.PRIORITY_INTERACTIVE if total_files == 1 else job_queue.PRIORITY_BULK
+    job_queue.JOB_QUEUE.create_task(task_id, kind="batch", file_count=total_files, options=options_dict, sealed=False)
+    light_files = [(i, file) for i, file in enumerate(files) if light_lane.is_light_document(file.filename)]
+    heavy_files = [(i, file) for i, file in enumerate(files) if not light_lane.is_light_document(file.filename)]
+    chunk_size = max(1, min(Config.BATCH_CHUNK_SIZE, math.ceil(len(heavy_files) / max(1, Config.CONVERSION_WORKERS))))
+    if options.shard_pages:
+        chunk_size = 1  # 分頁平行轉換以單一檔案為單位
+    groups = [([entry], job_queue.LANE_LIGHT) for entry in light_files]
+    groups += [(heavy_files[i:i + chunk_size], job_queue.LANE_STANDARD) for i in range(0, len(heavy_files), chunk_size)]
+
+    # 2. Move the received uploads into the store group by group; each group is enqueued as soon as it is stored
+    #    (uploads were streamed to staging files and hashed while the request was read, and are moved by content hash;
+    #     small uploads for single-file jobs stay in memory and are converted from a DocumentStream)
+    saved_files = []
+    save_errors = []
+    too_large = None
+    for group, lane in groups:
+        single = lane == job_queue.LANE_LIGHT or options.shard_pages or len(group) == 1
+        saved = await asyncio.gather(
+            *(file.store(in_memory=single) for _, file in group),
+            return_exceptions=True,
+        )
+        chunk_entries = []
+        for (index, file), stored in zip(group, saved):
+            if isinstance(stored, Exception):
+                if isinstance(stored, upload_service.UploadTooLargeError):
+                    too_large = stored
+                print(f"[Task {task_id}] 儲存上傳檔案失敗: {file.filename} - {stored}")
+                save_errors.append({"original_filename": file.filename, "status": "error", "output_filename": None, "error": str(stored)})
+                continue
+            chunk_entries.append({
+                "file_path": str(stored.path), "original_filename": file.filename,
+                "input_hash": stored.sha256, "memory_key": stored.memory_key,
+                "retained": stored.retained, "index": index,
+            })
+            saved_files.append((file.filename, stored.path))
+        if not chunk_entries:
+            continue
+
+        # 3. Enqueue; a single upload or a lightweight file is interactive, larger batches are bulk work
+        if single:
+            entry = chunk_entries[0]
+            job_queue.JOB_QUEUE.enqueue(
+                task_id,
+                kind="file",
+                payload={
+                    "file_path": entry["file_path"],
+                    "original_filename": entry["original_filename"],
+                    "input_hash": entry["input_hash"],
+                    "memory_key": entry["memory_key"],
+                    "retained": entry["retained"],
+                    "format": formats,
+                    "conversion_options_dict": options_dict,
+                    "index": entry["index"],
+                    "total": total_files,
+                },
+                priority=job_queue.PRIORITY_INTERACTIVE if lane == job_queue.LANE_LIGHT else priority,
+                seq=entry["index"],
+                lane=lane,
             )
-            if format in export_result.get("content", {}):
-                content = export_result["content"][format]
-            else:
-                # 如果內容不在返回中，可能是因為沒有使用 in_memory=True
-                paths = export_result.get("paths", {})
-                if format in paths:
-                    print(f"文件已匯出至: {paths[format]}")
-
-            # 5. Save metadata
-            file_service.save_metadata(
-                output_path=output_path,
-                source_identifier=file.filename,
-                format=format,
-                image_export_mode=img_export_mode_value
+        else:
+            job_queue.JOB_QUEUE.enqueue(
+                task_id,
+                kind="batch_chunk",
+                payload={
+                    "files": chunk_entries,
+                    "format": formats,
+                    "conversion_options_dict": options_dict,
+                    "total": total_files,
+                },
+                priority=priority,
+                seq=chunk_entries[0]["index"],
             )
 
-            # Update result for this file
-            file_result["status"] = "success"
-            file_result["output_filename"] = output_filename_final
-            print(f"[Task {task_id}] 成功處理檔案: {file.filename} -> {output_filename_final}")
-
-        except Exception as e:
-            error_message = str(e)
-            file_result["status"] = "error"
-            file_result["error"] = error_message
-            print(f"[Task {task_id}] 處理檔案失敗: {file.filename} - {error_message}")
-            # Update progress with error for this specific file if desired
-            # progress_service.update_progress(task_id, current_progress, "error", f"處理檔案失敗 {i+1}/{total_files}: {file.filename} - {error_message}")
-        finally:
-             # Store result (success or error) for this file
-             results.append(file_result)
-             ACTIVE_BATCH_TASKS[task_id]["results"].append(file_result)
-             # Optional: Clean up uploaded file immediately if needed
-             # if uploaded_file_path and uploaded_file_path.exists():
-             #     uploaded_file_path.unlink()
-             pass
-
-    # Final progress update for the batch
+    if not saved_files:
+        job_queue.JOB_QUEUE.delete_task(task_id)
+        progress_service.update_progress(task_id, 100, "error", "所有檔案儲存失敗")
+        if too_large is not None:
+            raise HTTPException(status_code=413, detail=str(too_large))
+        return {
+            "status": "error",
+            "message": "所有檔案儲存失敗",
+            "task_id": task_id,
+            "total_files": total_files,
+            "results": save_errors
+        }
+    job_queue.JOB_QUEUE.seal_task(task_id)
+
+    if not wait:
+        return {
+            "status": "queued",
+            "message": f"已加入佇列: {len(saved_files)} 個檔案",
+            "task_id": task_id,
+            "total_files": total_files,
+            "results": save_errors
+        }
+
+    # 3. Wait for the queued jobs (the event loop stays free while workers convert)
+    await job_queue.JOB_QUEUE.wait_for_task(task_id)
+    results = save_errors + job_queue.JOB_QUEUE.task_results(task_id)
+
+    # Final status for the batch
     success_count = len([r for r in results if r["status"] == "success"])
-    final_status = "complete" if success_count == total_files else "partial_error"
+    if any(r["status"] == "cancelled" for r in results):
+        final_status = "cancelled"
+    else:
+        final_status = "complete" if success_count == total_files else "partial_error"
     final_message = f"檔案轉換完成: 成功 {success_count}/{total_files} 檔案"
     if success_count < total_files:
          final_message += f", 失敗 {total_files - success_count}"
-         ACTIVE_BATCH_TASKS[task_id]["status"] = "error" # Mark batch task as having errors
-    else:
-        ACTIVE_BATCH_TASKS[task_id]["status"] = "complete"
-        
-    progress_service.update_progress(task_id, 100, final_status, final_message)
 
     return {
         "status": final_status, # Reflect overall batch status
@@ -234,4 +306,50 @@ async def batch_convert(
         "results": results # Return detailed results for each file
     }
 
+@router.post("/batch-convert-urls")
+async def batch_convert_urls(request: BatchUrlConversionRequest):
+    """批次轉換多個 URL
+
+    下載工作並行擷取所有 URL，每個檔案下載完成就排入轉換佇列，下載與轉換重疊進行。
+    立即返回 task_id，以 /progress/{task_id} 與 /tasks/{task_id} 查詢進度與結果。
+    """
+    urls = [url.strip() for url in request.urls if url.strip()]
+    if not urls:
+        raise HTTPException(status_code=422, detail="至少需要一個 URL")
+    if len(urls) > Config.URL_BATCH_MAX_URLS:
+        raise HTTPException(status_code=422, detail=f"URL 數量超過上限 ({Config.URL_BATCH_MAX_URLS})")
+    invalid = [url for url in urls if not url.startswith(('http://', 'https://'))]
+    if invalid:
+        raise HTTPException(status_code=422, detail=f"無效的URL格式。URL必須以 http:// 或 https:// 開頭: {invalid[0]}")
+    _reject_if_saturated()
+
+    task_id = uuid.uuid4().hex
+    total_urls = len(urls)
+    formats = file_service.normalize_formats(request.format)
+    options_dict = request.options.model_dump(mode="json")
+    progress_service.update_progress(task_id, 0, "queued", f"已加入佇列: {total_urls} 個 URL")
+
+    # 單一下載工作負責所有 URL，下載完成的檔案由它逐一排入轉換工作；
+    # 下載只等待網路，排入獨立的下載線道，不佔用標準或輕量線道的轉換 worker
+    job_queue.JOB_QUEUE.create_task(task_id, kind="url_batch", file_count=total_urls, options=options_dict)
+    job_queue.JOB_QUEUE.enqueue(
+        task_id,
+        kind="url_batch_download",
+        payload={
+            "urls": [{"source_url": url, "index": index} for index, url in enumerate(urls)],
+            "format": formats,
+            "conversion_options_dict": options_dict,
+            "total": total_urls,
+        },
+        priority=job_queue.PRIORITY_BULK,
+        lane=job_queue.LANE_DOWNLOAD,
+    )
+
+    return {
+        "status": "queued",
+        "message": f"已加入佇列: {total_urls} 個 URL",
+        "task_id": task_id,
+        "total_urls": total_urls,
+    }
+
 # 可以在這裡添加其他與轉換相關的路由 
\ No newline at end of file
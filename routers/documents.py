@@ -1,12 +1,17 @@
+import glob
 import json
 import os
-import shutil
 from pathlib import Path
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from typing import Literal
+from fastapi import APIRouter, Request, HTTPException, Query
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
 
-from config import OUTPUT_DIR, IMAGES_DIR
+from config import OUTPUT_DIR, IMAGES_DIR, Config
 from services.file_service import sanitize_filename
+from services import doclingservice, image_service, image_store
+
+# 圖片檔名為內容雜湊或含唯一 ID，內容不會改變，可讓瀏覽器與 CDN 長期快取
+_IMMUTABLE_CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
 
 router = APIRouter()
 
@@ -51,6 +56,10 @@ async def view_document(request: Request, filename: str):
             print(f"警告：無法讀取或解析元數據檔案 {meta_path}: {e}")
             source_info = "無法讀取來源資訊"
 
+    if Config.IMAGE_OPTIMIZE_ENABLED and format_type in ("markdown", "html"):
+        # 檢視頁面使用轉檔並縮小尺寸的圖片版本 (下載的輸出檔案仍引用原始圖片)
+        content = content.replace("/static/images/", "/images/")
+
     return templates.TemplateResponse(
         "view.html",
         {
@@ -62,6 +71,34 @@ async def view_document(request: Request, filename: str):
         }
     )
 
+@router.get("/images/{directory}/{filename}")
+async def get_image(
+    directory: str,
+    filename: str,
+    variant: Literal["optimized", "thumb", "original"] = Query(
+        "optimized", description="optimized: 轉檔並限制尺寸；thumb: 縮圖；original: 原始圖片"
+    ),
+):
+    """提供匯出圖片的最佳化版本或縮圖 (首次請求時產生並快取)"""
+    # 目錄名稱來自輸出檔名 (可能含空白或中文)，不以 sanitize_filename 比對，改為確認解析後的路徑仍在圖片目錄中
+    images_root = IMAGES_DIR.resolve()
+    try:
+        image_path = (images_root / directory / filename).resolve()
+    except (OSError, ValueError):
+        raise HTTPException(status_code=400, detail="檔名包含無效字元")
+    if image_path.parent.parent != images_root:
+        raise HTTPException(status_code=400, detail="檔名包含無效字元")
+    if not image_path.is_file():
+        raise HTTPException(status_code=404, detail="找不到圖片")
+    if variant == "original" or not Config.IMAGE_OPTIMIZE_ENABLED or not image_service.is_optimizable(image_path):
+        return FileResponse(image_path, headers=_IMMUTABLE_CACHE_HEADERS)
+    try:
+        variant_path = await image_service.get_image_variant(image_path, variant)
+    except Exception as e:
+        print(f"產生圖片版本時發生錯誤 {image_path}: {e}")
+        return FileResponse(image_path, headers=_IMMUTABLE_CACHE_HEADERS)
+    return FileResponse(variant_path, media_type=image_service.variant_media_type(variant_path), headers=_IMMUTABLE_CACHE_HEADERS)
+
 @router.get("/documents")
 async def list_documents():
     """列出所有已轉換的輸出文件"""
@@ -155,16 +192,26 @@ async def delete_document(filename: str):
     # 刪除關聯的圖片目錄
     try:
         if image_dir_path.exists() and image_dir_path.is_dir():
-            # 使用 shutil.rmtree 刪除整個目錄及其內容
-            shutil.rmtree(image_dir_path)
+            # 圖片是內容定址儲存的硬連結：刪除目錄後，不再被其他文件或快取引用的圖片才從儲存移除
+            released = image_store.release_tree(image_dir_path, on_release=image_service.discard_variants)
             deleted_files.append(f"圖片目錄: {image_dir_path}")
-            print(f"已刪除圖片目錄: {image_dir_path}")
+            print(f"已刪除圖片目錄: {image_dir_path} (釋放 {released} 張不再被引用的圖片)")
         else:
             print(f"圖片目錄不存在，無需刪除: {image_dir_path}")
     except OSError as e:
         print(f"刪除圖片目錄時發生錯誤 {image_dir_path}: {e}")
         errors.append(f"無法刪除圖片目錄 {image_dir_path.name}: {e}")
 
+    # 同一主檔名已沒有其他格式的輸出時，一併刪除保存的 DoclingDocument
+    remaining = [f for f in OUTPUT_DIR.glob(f"{glob.escape(file_basename)}.*") if not f.name.endswith(".meta.json")]
+    if not remaining:
+        try:
+            if doclingservice.delete_document(file_basename):
+                deleted_files.append(f"保存的文件: {file_basename}")
+        except OSError as e:
+            print(f"刪除保存的文件時發生錯誤 {file_basename}: {e}")
+            errors.append(f"無法刪除保存的文件 {file_basename}: {e}")
+
     if errors:
         # 如果有任何錯誤，返回失敗狀態
         raise HTTPException(status_code=500, detail="; ".join(errors))
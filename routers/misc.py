@@ -1,10 +1,14 @@
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import APIRouter, Request, HTTPException, Query
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
 import importlib
+import json
 import platform
 import sys
+from pathlib import Path
+from typing import Literal, Optional
 
-from config import CONVERSION_PROGRESS, OUTPUT_DIR, ACTIVE_BATCH_TASKS # Import necessary config
+from config import CONVERSION_PROGRESS, OUTPUT_DIR # Import necessary config
+from services import conversion_service, conversion_executor, job_queue, result_cache, warmup_service, admission_service, light_lane, file_service, doclingservice, download_service, url_cache, upload_service, image_store, image_service
 from docling.models.factories import get_ocr_factory
 from docling_core.types.doc import ImageRefMode
 from docling.datamodel.pipeline_options import (
@@ -27,6 +31,38 @@ async def get_progress(task_id: str):
         raise HTTPException(status_code=404, detail="找不到該任務")
     return CONVERSION_PROGRESS[task_id]
 
+@router.get("/healthz")
+async def healthz():
+    """存活檢查：行程可以回應即視為健康"""
+    return {"status": "ok"}
+
+@router.get("/readyz")
+async def readyz():
+    """就緒檢查：模型預熱完成前返回 503，避免負載平衡器將流量導向冷啟動的實例"""
+    state = warmup_service.WARMUP_STATE
+    if not warmup_service.is_ready():
+        return JSONResponse(status_code=503, content={"status": state["status"], "warmup": state})
+    return {"status": "ready", "warmup": state}
+
+@router.get("/api/metrics")
+async def get_metrics():
+    """獲取轉換服務的執行統計資料"""
+    return {
+        # 使用工作行程時，轉換器池位於各工作行程內，主行程的池僅反映執行緒模式的使用情況
+        "converter_pool": conversion_service.CONVERTER_POOL.stats(),
+        "executor": conversion_executor.EXECUTOR.stats(),
+        "job_queue": job_queue.JOB_QUEUE.stats(),
+        "result_cache": result_cache.RESULT_CACHE.stats(),
+        "admission": admission_service.ADMISSION.stats(),
+        "light_lane": light_lane.stats(),
+        "document_store": doclingservice.stats(),
+        "downloads": download_service.stats(),
+        "url_cache": url_cache.stats(),
+        "uploads": upload_service.stats(),
+        "image_store": image_store.stats(),
+        "image_optimize": image_service.optimization_stats(),
+    }
+
 @router.get("/api/ocr-engines")
 async def get_ocr_engines(allow_external_plugins: bool = False):
     """獲取系統中可用的 OCR 引擎"""
@@ -86,17 +122,61 @@ async def get_version():
         raise HTTPException(status_code=500, detail=f"獲取版本資訊失敗: {str(e)}")
 
 @router.get("/output/{filename}")
-async def download_output(filename: str):
-    """下載已轉換的輸出檔案"""
-    # 使用從 config 匯入的路徑
-    file_path = OUTPUT_DIR / filename
+async def download_output(
+    filename: str,
+    format: Optional[Literal["html", "markdown", "json", "yaml", "text", "doctags"]] = Query(
+        None, description="從保存的 DoclingDocument 產生指定格式 (不重新轉換)"
+    ),
+):
+    """下載已轉換的輸出檔案；指定 format 時由保存的文件產生該格式 (產生後保留在輸出目錄)"""
+    if format is None:
+        # 使用從 config 匯入的路徑
+        file_path = OUTPUT_DIR / filename
+        if not file_path.exists():
+            raise HTTPException(status_code=404, detail="找不到檔案")
+
+        return FileResponse(
+            path=file_path,
+            filename=filename,
+            media_type="application/octet-stream" # 通用二進位流
+        )
+
+    safe_filename = file_service.sanitize_filename(filename)
+    if safe_filename != filename:
+        raise HTTPException(status_code=400, detail="檔名包含無效字元")
+    # 同一次轉換的所有格式共用主檔名，主檔名即文件儲存中的文件 ID
+    document_id = Path(safe_filename).stem
+    target_name = f"{document_id}{file_service.get_file_extension(format)}"
+    file_path = OUTPUT_DIR / target_name
     if not file_path.exists():
-        raise HTTPException(status_code=404, detail="找不到檔案")
-    
+        if not doclingservice.has_document(document_id):
+            raise HTTPException(status_code=404, detail="找不到此文件保存的 DoclingDocument，無法產生其他格式")
+        image_export_mode = "referenced"
+        meta_path = OUTPUT_DIR / f"{document_id}.meta.json"
+        if meta_path.exists():
+            try:
+                image_export_mode = json.loads(meta_path.read_text(encoding="utf-8")).get("image_export_mode", image_export_mode)
+            except Exception as e:
+                print(f"警告：無法讀取或解析元數據檔案 {meta_path}: {e}")
+        try:
+            await file_service.export_document(
+                document_id=document_id,
+                format=format,
+                image_export_mode=image_export_mode,
+                out_dir_path=str(OUTPUT_DIR),
+                out_path=str(file_path),
+                task_id=document_id,
+            )
+        except doclingservice.DocumentNotFoundError:
+            raise HTTPException(status_code=404, detail="找不到此文件保存的 DoclingDocument，無法產生其他格式")
+        except Exception as e:
+            print(f"產生 {format} 格式時發生錯誤 {document_id}: {e}")
+            raise HTTPException(status_code=500, detail=f"無法產生 {format} 格式: {e}")
+
     return FileResponse(
-        path=file_path, 
-        filename=filename,
-        media_type="application/octet-stream" # 通用二進位流
+        path=file_path,
+        filename=target_name,
+        media_type="application/octet-stream"
     )
 
 @router.get("/tasks", response_class=HTMLResponse)
@@ -1,64 +1,103 @@
 from fastapi import APIRouter, HTTPException
 
-from config import ACTIVE_BATCH_TASKS, CONVERSION_PROGRESS
+from config import CONVERSION_PROGRESS
+from services import job_queue, progress_service
 
 router = APIRouter(prefix="/api/tasks", tags=["tasks"])
 
+def _task_progress(task: dict) -> dict:
+    """取得任務進度：優先使用記憶體中的即時進度，服務重啟後則由佇列狀態推算"""
+    progress_info = CONVERSION_PROGRESS.get(task["task_id"])
+    if progress_info is not None:
+        return progress_info
+
+    counts = task.get("counts") or job_queue.JOB_QUEUE.task_counts(task["task_id"])
+    total = sum(counts.values())
+    finished = sum(counts[state] for state in job_queue.JOB_FINISHED_STATES)
+    return {
+        "progress": int(finished / total * 100) if total else 0,
+        "status": task.get("status", "unknown"),
+        "message": f"已完成 {finished}/{total} 個工作",
+    }
+
 @router.get("/")
 async def list_tasks():
-    """獲取所有活躍的批次處理任務"""
+    """獲取所有轉換任務 (由持久化佇列讀取)"""
     tasks = []
-    # 直接使用從 config 匯入的字典
-    for task_id, task_info in ACTIVE_BATCH_TASKS.items():
-        progress_info = CONVERSION_PROGRESS.get(task_id, {})
+    for task_info in job_queue.JOB_QUEUE.list_tasks():
+        progress_info = _task_progress(task_info)
         tasks.append({
-            "task_id": task_id,
+            "task_id": task_info["task_id"],
+            "kind": task_info.get("kind"),
             "created_at": task_info.get("created_at", 0),
             "file_count": task_info.get("file_count", 0),
-            # 考慮是否返回 options 和 results
             "progress": progress_info.get("progress", 0),
             "status": progress_info.get("status", "unknown"),
             "message": progress_info.get("message", "")
         })
-    
+
     return {"tasks": sorted(tasks, key=lambda x: x["created_at"], reverse=True)}
 
 @router.get("/{task_id}")
 async def get_task(task_id: str):
     """獲取特定任務的詳細資訊"""
-    if task_id not in ACTIVE_BATCH_TASKS:
+    task_info = job_queue.JOB_QUEUE.get_task(task_id)
+    if task_info is None:
         raise HTTPException(status_code=404, detail="找不到該任務")
-    
-    task_info = ACTIVE_BATCH_TASKS[task_id]
-    progress_info = CONVERSION_PROGRESS.get(task_id, {})
-    
+
+    progress_info = _task_progress(task_info)
+
     return {
         "task_id": task_id,
+        "kind": task_info.get("kind"),
         "created_at": task_info.get("created_at", 0),
+        "finished_at": task_info.get("finished_at"),
         "file_count": task_info.get("file_count", 0),
-        "results": task_info.get("results", []), # 返回結果
+        "jobs": task_info.get("counts", {}), # 各狀態的工作數
+        "results": job_queue.JOB_QUEUE.task_results(task_id), # 返回結果
         "options": task_info.get("options", {}), # 返回選項
         "progress": progress_info.get("progress", 0),
         "status": progress_info.get("status", "unknown"),
         "message": progress_info.get("message", "")
     }
 
+@router.api_route("/{task_id}/cancel", methods=["POST", "DELETE"])
+async def cancel_task(task_id: str):
+    """取消任務：佇列中的工作不再執行，執行中的轉換會被中止並釋放工作行程"""
+    task_info = job_queue.JOB_QUEUE.get_task(task_id)
+    if task_info is None:
+        raise HTTPException(status_code=404, detail="找不到該任務")
+
+    counts = task_info.get("counts", {})
+    if not counts.get(job_queue.JOB_QUEUED) and not counts.get(job_queue.JOB_RUNNING):
+        raise HTTPException(status_code=400, detail="任務已結束，無法取消")
+
+    cancelled = job_queue.JOB_QUEUE.cancel_task(task_id)
+    progress_service.update_progress(task_id, 100, "cancelled", "任務已取消")
+
+    print(f"任務已取消: {task_id}")
+    return {
+        "status": "success",
+        "message": "任務已取消",
+        "task_id": task_id,
+        "cancelled_jobs": cancelled,
+    }
+
 @router.delete("/{task_id}")
 async def delete_task(task_id: str):
-    """刪除特定的批次處理任務記錄"""
-    if task_id not in ACTIVE_BATCH_TASKS:
+    """刪除特定任務記錄"""
+    task_info = job_queue.JOB_QUEUE.get_task(task_id)
+    if task_info is None:
         raise HTTPException(status_code=404, detail="找不到該任務")
-    
-    progress_info = CONVERSION_PROGRESS.get(task_id, {})
-    # 考慮允許刪除錯誤狀態的任務
-    if progress_info.get("status") not in ["complete", "error", "unknown", None]: 
-         # 檢查是否正在進行中 (更精確的狀態列表)
-         if progress_info.get("status") in ["init", "uploading", "downloading", "converting", "processing"]:
-            raise HTTPException(status_code=400, detail="無法刪除正在處理中的任務")
-    
-    # 從活躍任務和進度記錄中刪除 (使用 pop 以安全地處理不存在的情況)
-    ACTIVE_BATCH_TASKS.pop(task_id, None)
+
+    # 佇列中或執行中的任務不可刪除
+    counts = task_info.get("counts", {})
+    if counts.get(job_queue.JOB_QUEUED) or counts.get(job_queue.JOB_RUNNING):
+        raise HTTPException(status_code=400, detail="無法刪除正在處理中的任務")
+
+    # 從佇列和進度記錄中刪除
+    job_queue.JOB_QUEUE.delete_task(task_id)
     CONVERSION_PROGRESS.pop(task_id, None)
-    
+
     print(f"任務記錄已刪除: {task_id}")
     return {"status": "success", "message": "任務已刪除"}
@@ -3,6 +3,22 @@ from . import conversion_service
 from . import image_service
 from . import progress_service
 from . import doclingservice
+from . import converter_pool
+from . import conversion_executor
+from . import job_queue
+from . import result_cache
+from . import document_merge
+from . import ocr_selection
+from . import pipeline_hooks
+from . import warmup_service
+from . import admission_service
+from . import light_lane
+from . import document_codec
+from . import download_service
+from . import url_cache
+from . import upload_service
+from . import image_rewriter
+from . import image_store
 
 # 方便直接使用 services.xxx_service 而不需要 services.xxx_service.xxx_service
-# 例如：services.file_service.save_uploaded_file() 可以簡化為 services.file_service.save_uploaded_file()
+# 例如：services.upload_service.receive_form() 可以簡化為 services.upload_service.receive_form()
@@ -0,0 +1,187 @@
+"""轉換准入控制
+
+在真正執行 run_conversion 之前，先以低成本的方式探測輸入文件
+(檔案大小、PDF 頁數與頁面尺寸、圖片像素數、是否需要 OCR)，估算轉換成本 (以「等效頁數」表示)。
+同時執行中的轉換成本總和不超過 `Config.ADMISSION_BUDGET_PAGES`，超過時工作在佇列中等待；
+佇列已滿或主機可用記憶體不足時，路由直接回應 429 並附上 Retry-After，避免主機被推入 swap。
+"""
+import asyncio
+import io
+import math
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import pypdfium2 as pdfium
+
+from config import Config
+from models import ConversionOptions
+
+# A4 頁面面積 (PDF 點) 與 150 DPI 下的像素數，作為「一頁」的基準
+_A4_AREA_POINTS = 595 * 842
+_A4_PIXELS_150DPI = 1240 * 1754
+# 估算頁面尺寸時取樣的頁數
+_PAGE_SIZE_SAMPLES = 5
+# 僅對點陣區域執行 OCR (未強制 OCR) 時的成本倍率
+_PARTIAL_OCR_FACTOR = 1.5
+_IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".webp", ".img"}
+
+def probe_document(file_path: Path, data: Optional[bytes] = None) -> Dict[str, Any]:
+    """低成本探測文件：只讀取檔頭與 PDF 頁面字典，不解析內容
+
+    data 為檔案內容 (保留在記憶體中的上傳) 時直接探測，不讀取 file_path。
+    """
+    file_path = Path(file_path)
+    probe: Dict[str, Any] = {
+        "kind": "other",
+        "file_size": len(data) if data is not None else file_path.stat().st_size,
+        "page_count": None,
+        "page_area_factor": 1.0,
+        "image_pixels": None,
+    }
+    if data is not None:
+        header = data[:8]
+    else:
+        with open(file_path, "rb") as f:
+            header = f.read(8)
+
+    if header.startswith(b"%PDF-"):
+        probe["kind"] = "pdf"
+        try:
+            pdf = pdfium.PdfDocument(data if data is not None else str(file_path))
+            try:
+                probe["page_count"] = len(pdf)
+                samples = [pdf.get_page_size(i) for i in range(min(len(pdf), _PAGE_SIZE_SAMPLES))]
+                if samples:
+                    mean_area = sum(w * h for w, h in samples) / len(samples)
+                    probe["page_area_factor"] = min(max(mean_area / _A4_AREA_POINTS, 0.5), 8.0)
+            finally:
+                pdf.close()
+        except Exception as e:
+            print(f"[admission_service] 無法探測 PDF ({file_path}): {e}")
+    elif file_path.suffix.lower() in _IMAGE_SUFFIXES or header[:4] in (b"\x89PNG", b"II*\x00", b"MM\x00*") or header[:3] == b"\xff\xd8\xff":
+        probe["kind"] = "image"
+        try:
+            from PIL import Image
+            with Image.open(io.BytesIO(data) if data is not None else file_path) as image:  # 只讀取檔頭，不解碼像素
+                probe["image_pixels"] = image.width * image.height
+        except Exception as e:
+            print(f"[admission_service] 無法探測圖片 ({file_path}): {e}")
+    return probe
+
+def estimate_cost(probe: Dict[str, Any], options: ConversionOptions) -> float:
+    """依探測結果與轉換選項估算成本 (等效頁數)"""
+    if probe["kind"] == "pdf" and probe["page_count"]:
+        cost = probe["page_count"] * probe["page_area_factor"]
+        if options.ocr_mode == "auto":
+            cost *= _PARTIAL_OCR_FACTOR  # 只有部分頁面需要 OCR
+        elif options.ocr:
+            cost *= Config.ADMISSION_OCR_COST_FACTOR if options.force_ocr else _PARTIAL_OCR_FACTOR
+    elif probe["kind"] == "image":
+        pixels = probe["image_pixels"] or _A4_PIXELS_150DPI
+        cost = min(max(pixels / _A4_PIXELS_150DPI, 0.25), 16.0)
+        if options.ocr:
+            cost *= Config.ADMISSION_OCR_COST_FACTOR
+    else:
+        # 無法取得頁數 (Office、HTML 等)：以檔案大小粗估
+        cost = 1.0 + probe["file_size"] / Config.ADMISSION_BYTES_PER_PAGE
+    return round(cost, 2)
+
+def available_memory_bytes() -> Optional[int]:
+    """讀取 /proc/meminfo 的 MemAvailable，非 Linux 平台返回 None"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class AdmissionController:
+    """以成本預算限制同時執行的轉換"""
+
+    def __init__(self, budget: float):
+        self.budget = max(1.0, budget)
+        self.in_flight = 0.0
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._condition: Optional[asyncio.Condition] = None
+        # 每個工作的平均耗時 (指數移動平均)，用於估算 Retry-After
+        self.avg_job_seconds: Optional[float] = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def saturated(self) -> bool:
+        return self.in_flight >= self.budget
+
+    @asynccontextmanager
+    async def admit(self, cost: float):
+        """取得預算後執行區塊；預算不足時等待
+
+        單一文件的成本上限為整個預算，因此超大文件仍可在閒置時單獨執行。
+        """
+        cost = min(max(cost, 0.0), self.budget)
+        condition = self._get_condition()
+        async with condition:
+            if self.in_flight + cost > self.budget:
+                self.waiting += 1
+                try:
+                    await condition.wait_for(lambda: self.in_flight + cost <= self.budget)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += cost
+            self.active += 1
+            self.admitted += 1
+
+        start = time.perf_counter()
+        try:
+            yield cost
+        finally:
+            elapsed = time.perf_counter() - start
+            self.avg_job_seconds = elapsed if self.avg_job_seconds is None else 0.8 * self.avg_job_seconds + 0.2 * elapsed
+            async with condition:
+                self.in_flight -= cost
+                self.active -= 1
+                condition.notify_all()
+
+    def retry_after(self, queued_jobs: int) -> Optional[int]:
+        """判斷是否應拒絕新的請求；需要拒絕時返回建議的 Retry-After 秒數，否則返回 None"""
+        reject = queued_jobs >= Config.ADMISSION_MAX_QUEUED_JOBS
+        if Config.ADMISSION_MODE == "reject" and self.saturated():
+            reject = True
+        free_memory = available_memory_bytes()
+        if free_memory is not None and free_memory < Config.ADMISSION_MIN_FREE_MEMORY_MB * 1024 * 1024:
+            reject = True
+        if not reject:
+            return None
+
+        self.rejected += 1
+        if self.avg_job_seconds is None:
+            return Config.ADMISSION_RETRY_AFTER
+        # 預估目前佇列消化所需時間
+        seconds = self.avg_job_seconds * (queued_jobs + 1) / max(1, Config.JOB_WORKERS)
+        return int(min(max(math.ceil(seconds), 1), 600))
+
+    def stats(self) -> Dict[str, Any]:
+        free_memory = available_memory_bytes()
+        return {
+            "mode": Config.ADMISSION_MODE,
+            "budget_pages": self.budget,
+            "in_flight_pages": round(self.in_flight, 2),
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_job_seconds": round(self.avg_job_seconds, 3) if self.avg_job_seconds is not None else None,
+            "available_memory_bytes": free_memory,
+        }
+
+# 全域准入控制器 (主行程)
+ADMISSION = AdmissionController(Config.ADMISSION_BUDGET_PAGES)
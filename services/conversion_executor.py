@@ -0,0 +1,398 @@
+"""轉換執行器
+
+以獨立的工作行程執行 CPU 密集的 docling 轉換，避免阻塞 uvicorn 的事件迴圈。
+每個工作行程各自持有已預熱的轉換器池，主行程僅透過 Pipe 傳遞任務與結果。
+設定 `Config.CONVERSION_WORKERS = 0` 時改為在主行程的執行緒中執行 (開發用)。
+"""
+import asyncio
+import inspect
+import itertools
+import multiprocessing
+import os
+import signal
+import threading
+import traceback
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set
+
+from config import Config
+
+# 同一個工作行程位置連續啟動失敗 (就緒前即結束) 超過此次數時停用該位置
+_MAX_SPAWN_FAILURES = 3
+
+# 目前任務的進度回報函式 (工作行程中經由 Pipe 傳回主行程；執行緒模式中直接回呼)
+_PROGRESS_SINK: ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = ContextVar("progress_sink", default=None)
+
+def progress_sink() -> Optional[Callable[[Dict[str, Any]], None]]:
+    """取得目前任務的進度回報函式，呼叫端未要求進度時返回 None"""
+    return _PROGRESS_SINK.get()
+
+class ConversionWorkerError(RuntimeError):
+    """工作行程內執行任務時發生的錯誤"""
+
+    def __init__(self, error_type: str, message: str, worker_traceback: str = ""):
+        super().__init__(f"{error_type}: {message}")
+        self.error_type = error_type
+        self.worker_traceback = worker_traceback
+
+class WorkerCrashedError(RuntimeError):
+    """工作行程在執行任務期間意外結束"""
+
+def _worker_main(conn, warmup: bool) -> None:
+    """工作行程主迴圈：預熱後持續接收並執行任務"""
+    # 中斷訊號交由主行程處理，避免 Ctrl+C 時工作行程各自印出錯誤
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    ready_info: Dict[str, Any] = {"pid": os.getpid(), "warmup": None}
+    if warmup:
+        from services import warmup_service
+        ready_info["warmup"] = dict(warmup_service.warm_up())
+    conn.send(("ready", None, ready_info))
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+
+        job_id, func, args, kwargs, wants_progress = message
+        sink = (lambda data, _job_id=job_id: conn.send(("progress", _job_id, data))) if wants_progress else None
+        token = _PROGRESS_SINK.set(sink)
+        try:
+            result = func(*args, **kwargs)
+            if inspect.isgenerator(result):
+                # 產生器函式：每產出一項就立即傳回，主行程可以邊收邊處理
+                for item in result:
+                    conn.send(("item", job_id, item))
+                result = None
+            conn.send(("result", job_id, result))
+        except Exception as e:
+            conn.send(("error", job_id, (type(e).__name__, str(e), traceback.format_exc())))
+        finally:
+            _PROGRESS_SINK.reset(token)
+
+def _call_with_sink(sink: Optional[Callable], func: Callable, args: tuple, kwargs: dict) -> Any:
+    """執行緒模式：設定進度回報函式後執行任務"""
+    token = _PROGRESS_SINK.set(sink)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _PROGRESS_SINK.reset(token)
+
+class _WorkerHandle:
+    """主行程持有的工作行程控制代碼"""
+
+    def __init__(self, ctx, index: int, warmup: bool):
+        parent_conn, child_conn = ctx.Pipe(duplex=True)
+        self.index = index
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, warmup),
+            name=f"docling-worker-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.ready_info: Optional[Dict[str, Any]] = None
+        self.jobs_done = 0
+
+    def close(self) -> None:
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.conn.close()
+
+class ConversionExecutor:
+    """以固定數量的工作行程執行轉換任務"""
+
+    def __init__(self, max_workers: int, warmup: bool = True):
+        self.max_workers = max(0, max_workers)
+        self.warmup = warmup
+        self._ctx = multiprocessing.get_context("spawn")
+        self._workers: List[_WorkerHandle] = []
+        self._idle: Optional[asyncio.Queue] = None
+        # 啟動時各工作行程的就緒等待 (供 wait_ready)；替代行程的等待完成後即移除
+        self._ready_tasks: List[asyncio.Task] = []
+        self._respawn_tasks: Set[asyncio.Task] = set()
+        # 各工作行程位置連續啟動失敗的次數，以及已放棄重啟的位置
+        self._spawn_failures: Dict[int, int] = {}
+        self._failed_indexes: Set[int] = set()
+        self._job_ids = itertools.count(1)
+        self._started = False
+
+    @property
+    def uses_processes(self) -> bool:
+        return self.max_workers > 0
+
+    async def start(self) -> None:
+        """啟動工作行程 (不等待預熱完成)"""
+        if self._started:
+            return
+        self._started = True
+        if not self.uses_processes:
+            return
+        self._idle = asyncio.Queue()
+        for index in range(self.max_workers):
+            self._ready_tasks.append(asyncio.create_task(self._await_ready(self._spawn(index, self.warmup))))
+        print(f"[conversion_executor] 已啟動 {self.max_workers} 個轉換工作行程")
+
+    def _spawn(self, index: int, warmup: bool) -> _WorkerHandle:
+        worker = _WorkerHandle(self._ctx, index, warmup)
+        self._workers.append(worker)
+        return worker
+
+    def _respawn(self, index: int, delay: float = 0.0, retired: Optional[_WorkerHandle] = None) -> None:
+        """啟動替代行程 (不執行完整預熱，轉換器於第一次任務時建立)
+
+        retired 為被取代的工作行程：在背景等待其結束並關閉連線後才啟動替代行程，不阻塞事件迴圈。
+        """
+        async def respawn() -> None:
+            if retired is not None:
+                await asyncio.to_thread(retired.process.join, 5)
+                try:
+                    retired.conn.close()
+                except OSError:
+                    pass
+                print(f"[conversion_executor] 工作行程 {index} 已結束 (exitcode={retired.process.exitcode})，啟動替代行程")
+            if delay:
+                await asyncio.sleep(delay)
+            await self._await_ready(self._spawn(index, False))
+
+        task = asyncio.create_task(respawn())
+        self._respawn_tasks.add(task)
+        task.add_done_callback(self._respawn_tasks.discard)
+
+    async def _await_ready(self, worker: _WorkerHandle) -> Dict[str, Any]:
+        """等待工作行程完成預熱後加入閒置佇列；啟動失敗時延遲後重試，連續失敗過多則停用該位置"""
+        try:
+            kind, _, info = await asyncio.to_thread(worker.conn.recv)
+        except (EOFError, OSError) as e:
+            if worker in self._workers:
+                self._workers.remove(worker)
+            await asyncio.to_thread(worker.process.join, 5)
+            failures = self._spawn_failures[worker.index] = self._spawn_failures.get(worker.index, 0) + 1
+            if failures <= _MAX_SPAWN_FAILURES:
+                delay = min(2 ** failures, 60)
+                print(f"[conversion_executor] 工作行程 {worker.index} 在就緒前結束 ({e})，{delay} 秒後重試 ({failures}/{_MAX_SPAWN_FAILURES})")
+                self._respawn(worker.index, delay)
+            else:
+                # 例如模型檔案缺失：不再重啟以免無限循環，容量減少顯示於 stats() 的 failed_workers
+                self._failed_indexes.add(worker.index)
+                print(f"[conversion_executor] 錯誤: 工作行程 {worker.index} 連續 {failures} 次無法啟動，已停用 "
+                      f"(可用工作行程 {self.max_workers - len(self._failed_indexes)}/{self.max_workers})")
+                if len(self._failed_indexes) >= self.max_workers:
+                    # 已沒有任何可用的工作行程，讓等待中的任務收到錯誤而不是永遠等待
+                    self._idle.put_nowait(None)
+            return {"pid": worker.process.pid, "warmup": {"status": "error", "error": f"工作行程在就緒前結束: {e}"}}
+        worker.ready_info = info
+        self._spawn_failures.pop(worker.index, None)
+        print(f"[conversion_executor] 工作行程 {worker.index} (pid {info.get('pid')}) 已就緒")
+        self._idle.put_nowait(worker)
+        return info
+
+    async def wait_ready(self) -> List[Dict[str, Any]]:
+        """等待所有工作行程就緒，返回各行程的預熱資訊"""
+        if not self._started:
+            await self.start()
+        if not self._ready_tasks:
+            return []
+        return list(await asyncio.gather(*self._ready_tasks))
+
+    async def _acquire_worker(self) -> _WorkerHandle:
+        """取得閒置的工作行程；所有工作行程都已停用時引發 WorkerCrashedError"""
+        if len(self._failed_indexes) >= self.max_workers:
+            raise WorkerCrashedError("沒有可用的轉換工作行程 (所有工作行程都無法啟動)")
+        worker = await self._idle.get()
+        if worker is None:
+            self._idle.put_nowait(None)  # 讓其他等待中的任務也收到錯誤
+            raise WorkerCrashedError("沒有可用的轉換工作行程 (所有工作行程都無法啟動)")
+        return worker
+
+    def _replace(self, worker: _WorkerHandle) -> None:
+        """移除失效的工作行程並啟動替代行程 (等待行程結束的部分在背景進行)"""
+        if worker in self._workers:
+            self._workers.remove(worker)
+        # 先結束行程，讓仍在等待回覆的讀取執行緒收到 EOF 後結束
+        if worker.process.is_alive():
+            worker.process.kill()
+        self._respawn(worker.index, retired=worker)
+
+    async def _recv_reply(self, worker: _WorkerHandle, on_progress: Optional[Callable]) -> tuple:
+        """持續讀取工作行程的訊息，轉交進度訊息，直到收到結果或錯誤"""
+        while True:
+            kind, _, payload = await asyncio.to_thread(worker.conn.recv)
+            if kind != "progress":
+                return kind, payload
+            if on_progress is not None:
+                try:
+                    on_progress(payload)
+                except Exception as e:
+                    print(f"[conversion_executor] 進度回呼失敗: {e}")
+
+    async def run(self, func: Callable, *args, on_progress: Optional[Callable[[Dict[str, Any]], None]] = None, **kwargs) -> Any:
+        """在工作行程中執行 func(*args, **kwargs) 並等待結果
+
+        func 與其參數、返回值都必須可以被 pickle。
+        on_progress 會在主行程 (事件迴圈) 中以工作回報的進度字典呼叫。
+        呼叫端被取消 (逾時或使用者取消) 時會直接結束該工作行程並啟動替代行程，
+        確保工作行程立即釋放；執行緒模式無法中止執行中的執行緒，只會放棄其結果。
+        """
+        if not self._started:
+            await self.start()
+        if not self.uses_processes:
+            sink = None
+            if on_progress is not None:
+                loop = asyncio.get_running_loop()
+                sink = lambda data: loop.call_soon_threadsafe(on_progress, data)
+            return await asyncio.to_thread(_call_with_sink, sink, func, args, kwargs)
+
+        worker = await self._acquire_worker()
+        job_id = next(self._job_ids)
+        try:
+            worker.conn.send((job_id, func, args, kwargs, on_progress is not None))
+        except (OSError, BrokenPipeError) as e:
+            self._replace(worker)
+            raise WorkerCrashedError(f"無法傳送任務至工作行程 {worker.index}: {e}")
+
+        reply = asyncio.ensure_future(self._recv_reply(worker, on_progress))
+        try:
+            kind, payload = await asyncio.shield(reply)
+        except asyncio.CancelledError:
+            print(f"[conversion_executor] 任務 {job_id} 已取消，結束工作行程 {worker.index}")
+            reply.cancel()
+            self._replace(worker)
+            raise
+        except (EOFError, OSError) as e:
+            self._replace(worker)
+            raise WorkerCrashedError(f"工作行程 {worker.index} 在執行任務時結束: {e}")
+
+        worker.jobs_done += 1
+        self._idle.put_nowait(worker)
+        if kind == "error":
+            raise ConversionWorkerError(*payload)
+        return payload
+
+    async def stream(self, func: Callable, *args, on_progress: Optional[Callable[[Dict[str, Any]], None]] = None, **kwargs) -> AsyncIterator[Any]:
+        """在工作行程中執行產生器函式 func，逐項返回其產出
+
+        工作行程產出下一項的同時，呼叫端可以處理前一項 (例如匯出)。
+        呼叫端提前結束迭代、被取消或逾時時，與 run() 相同會結束該工作行程。
+        """
+        if not self._started:
+            await self.start()
+        if not self.uses_processes:
+            async for item in self._stream_in_thread(func, args, kwargs, on_progress):
+                yield item
+            return
+
+        worker = await self._acquire_worker()
+        job_id = next(self._job_ids)
+        try:
+            worker.conn.send((job_id, func, args, kwargs, on_progress is not None))
+        except (OSError, BrokenPipeError) as e:
+            self._replace(worker)
+            raise WorkerCrashedError(f"無法傳送任務至工作行程 {worker.index}: {e}")
+
+        while True:
+            reply = asyncio.ensure_future(self._recv_reply(worker, on_progress))
+            try:
+                kind, payload = await asyncio.shield(reply)
+            except asyncio.CancelledError:
+                print(f"[conversion_executor] 串流任務 {job_id} 已取消，結束工作行程 {worker.index}")
+                reply.cancel()
+                self._replace(worker)
+                raise
+            except (EOFError, OSError) as e:
+                self._replace(worker)
+                raise WorkerCrashedError(f"工作行程 {worker.index} 在執行任務時結束: {e}")
+
+            if kind == "item":
+                try:
+                    yield payload
+                except GeneratorExit:
+                    # 呼叫端不再需要後續結果，工作行程仍在產出，直接結束
+                    self._replace(worker)
+                    raise
+                continue
+
+            worker.jobs_done += 1
+            self._idle.put_nowait(worker)
+            if kind == "error":
+                raise ConversionWorkerError(*payload)
+            return
+
+    async def _stream_in_thread(self, func: Callable, args: tuple, kwargs: dict, on_progress: Optional[Callable]) -> AsyncIterator[Any]:
+        """執行緒模式的 stream()：呼叫端結束迭代後，產生器在產出下一項時停止"""
+        loop = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        sink = None
+        if on_progress is not None:
+            sink = lambda data: loop.call_soon_threadsafe(on_progress, data)
+
+        def produce() -> None:
+            token = _PROGRESS_SINK.set(sink)
+            try:
+                for item in func(*args, **kwargs):
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(items.put_nowait, ("item", item))
+                loop.call_soon_threadsafe(items.put_nowait, ("done", None))
+            except Exception as e:
+                loop.call_soon_threadsafe(items.put_nowait, ("error", e))
+            finally:
+                _PROGRESS_SINK.reset(token)
+
+        producer = asyncio.ensure_future(asyncio.to_thread(produce))
+        try:
+            while True:
+                kind, payload = await items.get()
+                if kind == "item":
+                    yield payload
+                elif kind == "error":
+                    raise payload
+                else:
+                    break
+            await producer
+        finally:
+            stop.set()
+
+    async def shutdown(self) -> None:
+        """通知所有工作行程結束並等待退出"""
+        for task in [*self._ready_tasks, *self._respawn_tasks]:
+            task.cancel()
+        for worker in self._workers:
+            worker.close()
+        for worker in self._workers:
+            await asyncio.to_thread(worker.process.join, 10)
+            if worker.process.is_alive():
+                worker.process.kill()
+        self._workers.clear()
+        self._started = False
+
+    def stats(self) -> Dict[str, Any]:
+        """返回執行器狀態"""
+        return {
+            "mode": "process" if self.uses_processes else "thread",
+            "max_workers": self.max_workers,
+            "idle": self._idle.qsize() if self._idle is not None else None,
+            "failed_workers": sorted(self._failed_indexes),
+            "respawning": len(self._respawn_tasks),
+            "workers": [
+                {
+                    "index": w.index,
+                    "pid": w.process.pid,
+                    "alive": w.process.is_alive(),
+                    "ready": w.ready_info is not None,
+                    "jobs_done": w.jobs_done,
+                }
+                for w in self._workers
+            ],
+        }
+
+# 全域執行器，於 app lifespan 中啟動
+EXECUTOR = ConversionExecutor(Config.CONVERSION_WORKERS, warmup=Config.WARMUP_ENABLED)
@@ -1,13 +1,17 @@
+import asyncio
+import hashlib
+import io
 import re
 import sys
-from typing import Optional, List
+import time
+from typing import Callable, Dict, Iterator, Optional, List, Tuple, Union
 from pathlib import Path
 
 from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
 from docling.backend.docling_parse_backend import DoclingParseDocumentBackend
 from docling.backend.docling_parse_v2_backend import DoclingParseV2DocumentBackend
 from docling.backend.docling_parse_v4_backend import DoclingParseV4DocumentBackend
-from docling.datamodel.base_models import InputFormat
+from docling.datamodel.base_models import DocumentStream, InputFormat
 from docling.datamodel.pipeline_options import (
     AcceleratorOptions,
     OcrOptions,
@@ -29,9 +33,13 @@ from docling.models.factories import get_ocr_factory
 from docling.pipeline.simple_pipeline import SimplePipeline
 from docling.pipeline.vlm_pipeline import VlmPipeline
 from docling_core.types.doc import ImageRefMode
+import pypdfium2 as pdfium
 
 # 從其他模組匯入
 from models import ConversionOptions
+from config import Config
+from services.converter_pool import ConverterPool
+from services import document_merge, ocr_selection, pipeline_hooks
 
 # 添加輔助函數來分割語言列表
 def _split_list(raw: Optional[str]) -> Optional[List[str]]:
@@ -43,9 +51,11 @@ def create_converter_with_options(options: ConversionOptions) -> DocumentConvert
     """根據選項建立文件轉換器"""
     
     ocr_factory = get_ocr_factory(allow_external_plugins=False)
+    # ocr_mode="auto" 由 pipeline 掛鉤逐頁決定是否 (整頁) OCR，此處不強制整頁
+    auto_ocr = options.ocr_mode == "auto"
     ocr_options: OcrOptions = ocr_factory.create_options(
         kind=options.ocr_engine,
-        force_full_page_ocr=options.force_ocr,
+        force_full_page_ocr=options.force_ocr and not auto_ocr,
     )
     
     if options.ocr_lang:
@@ -64,7 +74,7 @@ def create_converter_with_options(options: ConversionOptions) -> DocumentConvert
             allow_external_plugins=False,
             enable_remote_services=False,
             accelerator_options=accelerator_options,
-            do_ocr=options.ocr,
+            do_ocr=options.ocr or auto_ocr,
             ocr_options=ocr_options,
             do_table_structure=True,
             do_code_enrichment=options.enrich_code,
@@ -75,6 +85,10 @@ def create_converter_with_options(options: ConversionOptions) -> DocumentConvert
         pipeline_options.table_structure_options.do_cell_matching = True  
         pipeline_options.table_structure_options.mode = options.table_mode
 
+        # 使用本地模型檔案 (離線部署)
+        if Config.DOCLING_ARTIFACTS_PATH:
+            pipeline_options.artifacts_path = Config.DOCLING_ARTIFACTS_PATH
+
         if options.image_export_mode != ImageRefMode.PLACEHOLDER:
             pipeline_options.generate_page_images = True
             pipeline_options.generate_picture_images = True
@@ -96,6 +110,8 @@ def create_converter_with_options(options: ConversionOptions) -> DocumentConvert
         )
     elif options.pipeline == PdfPipeline.VLM:
         pipeline_options = VlmPipelineOptions()
+        if Config.DOCLING_ARTIFACTS_PATH:
+            pipeline_options.artifacts_path = Config.DOCLING_ARTIFACTS_PATH
 
         if options.vlm_model == VlmModelType.GRANITE_VISION:
             pipeline_options.vlm_options = granite_vision_vlm_conversion_options
@@ -153,77 +169,454 @@ def create_converter_with_options(options: ConversionOptions) -> DocumentConvert
         },
     )
 
-def run_conversion(file_path: Path, options: ConversionOptions):
-    """執行文件轉換"""
+def _build_pooled_converter(options: ConversionOptions) -> DocumentConverter:
+    """建立轉換器並安裝逐頁進度掛鉤 (供轉換器池使用)"""
+    converter = create_converter_with_options(options)
+    pipeline_hooks.install(converter, selective_ocr=options.ocr_mode == "auto")
+    return converter
+
+# 依選項指紋共用已初始化的轉換器 (每個行程各自持有一個池)
+CONVERTER_POOL = ConverterPool(_build_pooled_converter, max_size=Config.CONVERTER_POOL_SIZE)
+
+def get_converter(options: ConversionOptions) -> DocumentConverter:
+    """從轉換器池取得 (或建立) 對應選項的轉換器"""
+    return CONVERTER_POOL.get(options)
+
+def conversion_source(file_path: Path, data: Optional[bytes] = None) -> Union[str, DocumentStream]:
+    """docling 的轉換來源：提供 data 時以 DocumentStream 直接由記憶體轉換 (file_path 只用於名稱與副檔名)"""
+    if data is not None:
+        return DocumentStream(name=Path(file_path).name, stream=io.BytesIO(data))
+    return str(Path(file_path).absolute())
+
+def run_conversion(
+    file_path: Path,
+    options: ConversionOptions,
+    page_range: Optional[Tuple[int, int]] = None,
+    data: Optional[bytes] = None,
+):
+    """執行文件轉換 (page_range 為 1 起算、包含兩端的頁碼範圍，None 表示全部頁面)
+
+    data 為檔案內容時直接由記憶體轉換，不需從磁碟讀取 file_path。
+    """
     try:
-        # 使用提供的選項建立轉換器
-        custom_converter = create_converter_with_options(options)
+        # 從轉換器池取得對應選項的轉換器，相同選項共用已載入的模型
+        custom_converter = get_converter(options)
         
         # 使用 DocumentConverter 轉換
-        print(f"開始轉換檔案: {file_path}")
-        result = custom_converter.convert(str(file_path.absolute()))
+        print(f"開始轉換檔案: {file_path}" + (" (記憶體)" if data is not None else "") + (f" (頁 {page_range[0]}-{page_range[1]})" if page_range else ""))
+        source = conversion_source(file_path, data)
+        if page_range is not None:
+            result = custom_converter.convert(source, page_range=page_range)
+        else:
+            result = custom_converter.convert(source)
         print(f"檔案轉換完成: {file_path}")
         return result
     except Exception as e:
         print(f"執行轉換時發生錯誤 ({file_path}): {e}")
         raise # 重新引發錯誤，讓上層處理
 
-import httpx
-import tempfile
+class ConversionOutput:
+    """可跨行程傳遞的轉換結果
+
+    docling 的 ConversionResult 持有輸入檔案的後端物件 (無法 pickle)，
+    因此工作行程只回傳 DoclingDocument 與必要的狀態資訊。
+    介面與 ConversionResult 相容 (具有 document 屬性)，可直接交給 file_service.export_document。
+    """
+
+    def __init__(
+        self,
+        document,
+        status: str,
+        errors: List[str],
+        page_count: int,
+        conversion_time: float,
+        ocr_decisions: Optional[Dict[int, dict]] = None,
+    ):
+        self.document = document
+        self.status = status
+        self.errors = errors
+        self.page_count = page_count
+        self.conversion_time = conversion_time
+        self.ocr_decisions = ocr_decisions or {}  # ocr_mode="auto" 的逐頁判斷 (頁碼 -> 判斷資訊)
+
+def _to_output(result, conversion_time: float, ocr_decisions: Optional[Dict[int, dict]] = None) -> ConversionOutput:
+    return ConversionOutput(
+        document=result.document,
+        status=str(getattr(result.status, "value", result.status)),
+        errors=[str(getattr(err, "error_message", err)) for err in getattr(result, "errors", [])],
+        page_count=len(getattr(result, "pages", []) or []),
+        conversion_time=conversion_time,
+        ocr_decisions=ocr_decisions,
+    )
+
+def convert_to_output(
+    file_path: str,
+    options: ConversionOptions,
+    page_range: Optional[Tuple[int, int]] = None,
+    data: Optional[bytes] = None,
+) -> ConversionOutput:
+    """執行轉換並包裝為 ConversionOutput (於工作行程中執行)"""
+    start = time.perf_counter()
+    # 呼叫端要求進度時，pipeline 掛鉤會逐頁回報 (已節流)
+    with pipeline_hooks.track_progress(conversion_executor.progress_sink()), pipeline_hooks.collect_ocr_decisions() as ocr_decisions:
+        result = run_conversion(Path(file_path), options, page_range=page_range, data=data)
+    return _to_output(result, time.perf_counter() - start, ocr_decisions)
+
+# docling 視為成功的狀態 (部分成功仍有可匯出的內容)
+_SUCCESS_STATUSES = {"success", "partial_success"}
+
+def convert_all_to_outputs(file_paths: List[str], options: ConversionOptions) -> Iterator[Tuple[int, Optional[ConversionOutput], Optional[str]]]:
+    """以同一個轉換器透過 docling 的 convert_all 依序轉換多個檔案 (於工作行程中執行)
+
+    每轉換完一個檔案就產出 (索引, ConversionOutput 或 None, 錯誤訊息或 None)，
+    呼叫端可以在下一個檔案轉換時先匯出前一個結果。convert_all 依輸入順序產出結果，索引即為產出順序
+    (上傳依內容雜湊存放，同一批次中內容相同的檔案路徑相同，不能以路徑對應索引)。
+    """
+    converter = get_converter(options)
+    sink = conversion_executor.progress_sink()
+    sources = [str(Path(p).absolute()) for p in file_paths]
+    print(f"開始批次轉換 {len(sources)} 個檔案")
+    results = converter.convert_all(sources, raises_on_error=False)
+
+    for position in range(len(sources)):
+        start = time.perf_counter()
+        item_sink = (lambda info, _i=position: sink({**info, "index": _i})) if sink is not None else None
+        with pipeline_hooks.track_progress(item_sink), pipeline_hooks.collect_ocr_decisions() as ocr_decisions:
+            result = next(results, None)
+        if result is None:
+            break
+        output = _to_output(result, time.perf_counter() - start, ocr_decisions)
+        if output.status not in _SUCCESS_STATUSES:
+            yield position, None, "; ".join(output.errors) or f"轉換失敗 ({output.status})"
+        else:
+            yield position, output, None
+
+def count_pdf_pages(file_path: Path, data: Optional[bytes] = None) -> Optional[int]:
+    """以 pypdfium2 快速計算 PDF 頁數 (不解析內容)，非 PDF 或無法開啟時返回 None"""
+    try:
+        if data is not None:
+            header = data[:5]
+        else:
+            with open(file_path, "rb") as f:
+                header = f.read(5)
+        if header != b"%PDF-":
+            return None
+        pdf = pdfium.PdfDocument(data if data is not None else str(file_path))
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    except Exception as e:
+        print(f"無法計算 PDF 頁數 ({file_path}): {e}")
+        return None
+
+def plan_page_shards(page_count: int, shard_size: int) -> List[Tuple[int, int]]:
+    """將頁數切分為連續的頁碼範圍 (1 起算、包含兩端)"""
+    shard_size = max(1, shard_size)
+    return [(start, min(start + shard_size - 1, page_count)) for start in range(1, page_count + 1, shard_size)]
+
+async def _run_sharded_conversion(
+    file_path: Path,
+    options: ConversionOptions,
+    shards: List[Tuple[int, int]],
+    on_progress: Optional[Callable[[dict], None]] = None,
+    data: Optional[bytes] = None,
+) -> ConversionOutput:
+    """將各頁碼範圍分送至工作行程平行轉換，再依頁序合併"""
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(max(1, Config.SHARD_MAX_PARALLEL))
+    pages_total = shards[-1][1] - shards[0][0] + 1
+    shard_progress: dict = {}
+
+    def shard_progress_callback(index: int) -> Optional[Callable[[dict], None]]:
+        if on_progress is None:
+            return None
+
+        def report(info: dict) -> None:
+            # 彙總各分片的進度為整份文件的進度
+            shard_progress[index] = info
+            pages_done = sum(p["pages_done"] for p in shard_progress.values())
+            pages_per_sec = sum(p["pages_per_sec"] for p in shard_progress.values())
+            remaining = max(pages_total - pages_done, 0)
+            on_progress({
+                "pages_done": pages_done,
+                "pages_total": pages_total,
+                "stage": info["stage"],
+                "pages_per_sec": round(pages_per_sec, 3),
+                "eta_seconds": round(remaining / pages_per_sec, 1) if pages_per_sec > 0 else None,
+            })
+        return report
+
+    async def convert_shard(index: int, page_range: Tuple[int, int]) -> ConversionOutput:
+        async with semaphore:
+            return await conversion_executor.EXECUTOR.run(
+                convert_to_output, str(file_path), options, page_range, data,
+                on_progress=shard_progress_callback(index),
+            )
+
+    print(f"分頁平行轉換 {file_path}: {len(shards)} 個分片 {shards}")
+    outputs = await asyncio.gather(*(convert_shard(i, page_range) for i, page_range in enumerate(shards)))
+
+    # 合併大型文件屬 CPU 工作，移至執行緒執行
+    merged_document = await asyncio.to_thread(document_merge.merge_documents, [o.document for o in outputs])
+    statuses = {o.status for o in outputs}
+    return ConversionOutput(
+        document=merged_document,
+        status=outputs[0].status if len(statuses) == 1 else "partial_success",
+        errors=[err for o in outputs for err in o.errors],
+        page_count=sum(o.page_count for o in outputs),
+        conversion_time=time.perf_counter() - start,
+        ocr_decisions={page: info for o in outputs for page, info in o.ocr_decisions.items()},
+    )
+
+class ConversionTimeoutError(RuntimeError):
+    """轉換超過期限而被中止"""
+
+    def __init__(self, timeout: float, elapsed: float):
+        super().__init__(f"轉換超過 {timeout:g} 秒的期限，已中止")
+        self.timeout = timeout
+        self.elapsed = elapsed
+
+def resolve_timeout(options: ConversionOptions) -> float:
+    """取得本次轉換的期限：請求指定的逾時 (不超過上限) 或全域預設值"""
+    timeout = options.timeout if options.timeout and options.timeout > 0 else Config.DOCLING_TIMEOUT
+    return min(timeout, Config.DOCLING_MAX_TIMEOUT)
+
+async def run_conversion_async(
+    file_path: Path,
+    options: ConversionOptions,
+    on_progress: Optional[Callable[[dict], None]] = None,
+    data: Optional[bytes] = None,
+) -> ConversionOutput:
+    """在轉換工作行程中執行轉換，不阻塞事件迴圈
+
+    options.shard_pages 啟用且 PDF 頁數超過一個分片時，改為分頁平行轉換。
+    on_progress 會收到逐頁進度 (pages_done、pages_total、stage、pages_per_sec、eta_seconds)。
+    超過 resolve_timeout() 的期限時，執行中的工作行程會被結束並引發 ConversionTimeoutError。
+    data 為檔案內容時直接傳給工作行程以 DocumentStream 轉換，不經過磁碟。
+    """
+    timeout = resolve_timeout(options)
+    start = time.perf_counter()
+    try:
+        return await asyncio.wait_for(_run_conversion_unbounded(file_path, options, on_progress, data), timeout)
+    except asyncio.TimeoutError:
+        elapsed = time.perf_counter() - start
+        print(f"轉換逾時 {file_path}: 已執行 {elapsed:.1f} 秒 (期限 {timeout:g} 秒)")
+        raise ConversionTimeoutError(timeout, elapsed)
+
+async def _run_conversion_unbounded(
+    file_path: Path,
+    options: ConversionOptions,
+    on_progress: Optional[Callable[[dict], None]],
+    data: Optional[bytes] = None,
+) -> ConversionOutput:
+    if options.shard_pages:
+        page_count = await asyncio.to_thread(count_pdf_pages, file_path, data)
+        if page_count and page_count > Config.SHARD_PAGE_SIZE:
+            shards = plan_page_shards(page_count, Config.SHARD_PAGE_SIZE)
+            return await _run_sharded_conversion(file_path, options, shards, on_progress=on_progress, data=data)
+    return await conversion_executor.EXECUTOR.run(convert_to_output, str(file_path), options, None, data, on_progress=on_progress)
+
+async def run_light_conversion(file_path: Path, options: ConversionOptions, data: Optional[bytes] = None) -> ConversionOutput:
+    """以輕量線道的轉換器轉換 DOCX、HTML、Markdown 等格式 (不使用 PDF 轉換選項)
+
+    輕量線道在執行緒中轉換，逾時只讓此處不再等待並回報逾時，轉換本身會在背景跑完 (見 light_lane)。
+    """
+    timeout = resolve_timeout(options)
+    start = time.perf_counter()
+    try:
+        result, elapsed = await asyncio.wait_for(light_lane.convert(file_path, data), timeout)
+    except asyncio.TimeoutError:
+        raise ConversionTimeoutError(timeout, time.perf_counter() - start)
+    return _to_output(result, elapsed)
+
+async def convert_and_export(
+    file_path: Optional[Path],
+    options: ConversionOptions,
+    format: Union[str, List[str]],
+    output_path: Path,
+    on_progress: Optional[Callable[[dict], None]] = None,
+    input_hash: Optional[str] = None,
+    data: Optional[bytes] = None,
+) -> Optional[dict]:
+    """轉換並匯出文件；結果快取命中時直接複製快取內容，略過轉換
+
+    input_hash 為已知的檔案內容 SHA-256 (例如下載時已計算)，提供時不再重新讀取檔案計算。
+    file_path 為 None 時 (例如遠端文件未變更而未下載) 只由結果快取取得，未全部命中時返回 None。
+    data 為檔案內容 (保留在記憶體中的上傳) 時直接由記憶體轉換，file_path 只用於名稱與副檔名。
+
+    format 可為格式列表：文件只轉換一次，所有格式都從同一份 DoclingDocument 匯出，
+    共用 output_path 的主檔名與圖片目錄。只有部分格式命中快取時，仍只匯出未命中的格式。
+
+    返回:
+        {"cached": 是否所有格式都命中快取, "paths": 匯出的檔案路徑, "conversion_time": 轉換耗時 (秒),
+         "cost": 准入控制估算的成本 (等效頁數，快取命中時為 0),
+         "ocr_decisions": ocr_mode="auto" 的逐頁 OCR 判斷 (未使用或快取命中時為 None)}
+    """
+    formats = file_service.normalize_formats(format)
+    targets = file_service.format_output_paths(output_path, formats)
+    image_base_name = output_path.stem
+    img_export_mode_value = options.image_export_mode.value
+
+    cache_keys: Dict[str, str] = {}
+    paths: Dict[str, str] = {}
+    missing = list(formats)
+    if Config.RESULT_CACHE_ENABLED and (file_path is not None or input_hash is not None):
+        if input_hash is None:
+            if data is not None:
+                input_hash = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+            else:
+                input_hash = await asyncio.to_thread(result_cache.hash_file, file_path)
+        missing = []
+        for fmt in formats:
+            cache_keys[fmt] = result_cache.make_key(input_hash, options, fmt)
+            target_path = file_service.sanitized_output_path(targets[fmt])
+            if await asyncio.to_thread(result_cache.RESULT_CACHE.materialize, cache_keys[fmt], target_path, image_base_name):
+                paths[_path_key(fmt)] = str(target_path)
+            else:
+                missing.append(fmt)
+        if not missing:
+            await asyncio.to_thread(adopt_cached_document, cache_keys.values(), image_base_name)
+            return {"cached": True, "paths": paths, "conversion_time": 0.0, "cost": 0.0, "ocr_decisions": None}
+    if file_path is None:
+        return None
+
+    export_kwargs = dict(
+        format=missing,
+        image_export_mode=img_export_mode_value,
+        out_dir_path=str(OUTPUT_DIR),
+        out_path=str(targets[missing[0]]),
+    )
+    if light_lane.is_light_document(file_path):
+        # 輕量格式不需要模型，略過准入控制與轉換工作行程
+        cost = 0.0
+        conversion_result = await run_light_conversion(file_path, options, data)
+        export_result = await file_service.export_document(result=conversion_result, **export_kwargs)
+    else:
+        # 先探測文件估算成本，在准入預算內才開始轉換 (預算不足時在此等待)
+        probe = await asyncio.to_thread(admission_service.probe_document, file_path, data)
+        cost = admission_service.estimate_cost(probe, options)
+        async with admission_service.ADMISSION.admit(cost):
+            conversion_result = await run_conversion_async(file_path, options, on_progress=on_progress, data=data)
+
+            export_result = await file_service.export_document(result=conversion_result, **export_kwargs)
+    exported = export_result.get("paths", {})
+    paths.update(exported)
+    # 保存標準的 DoclingDocument，之後其他格式可直接由此產生
+    await asyncio.to_thread(persist_document, conversion_result, image_base_name)
+
+    for fmt in missing:
+        if fmt in cache_keys and _path_key(fmt) in exported:
+            await asyncio.to_thread(
+                result_cache.RESULT_CACHE.store,
+                cache_keys[fmt],
+                Path(exported[_path_key(fmt)]),
+                IMAGES_DIR / image_base_name,
+                image_base_name,
+                conversion_result.conversion_time,
+                doclingservice.document_file(image_base_name),
+            )
+    return {
+        "cached": False,
+        "paths": paths,
+        "conversion_time": conversion_result.conversion_time,
+        "cost": cost,
+        "ocr_decisions": _ocr_summary(conversion_result),
+    }
+
+def _has_cached_results(input_hash: str, options: ConversionOptions, format: Union[str, List[str]]) -> bool:
+    """此內容在這組選項下的所有格式是否都在結果快取中"""
+    if not Config.RESULT_CACHE_ENABLED:
+        return False
+    return all(
+        result_cache.RESULT_CACHE.contains(result_cache.make_key(input_hash, options, fmt))
+        for fmt in file_service.normalize_formats(format)
+    )
+
+def persist_document(output, document_id: str) -> None:
+    """將轉換結果的 DoclingDocument 存入文件儲存；失敗時只記錄，不影響已完成的匯出"""
+    try:
+        doclingservice.save_document(output.document, document_id)
+    except Exception as e:
+        print(f"[conversion_service] 無法保存文件 {document_id}: {e}")
+
+def adopt_cached_document(keys, document_id: str) -> None:
+    """結果快取全部命中時不會重新轉換：以快取項目保存的文件作為 document_id 的文件，
+    讓 /output/{filename}?format=... 仍能產生其他格式"""
+    if doclingservice.has_document(document_id):
+        return
+    for key in keys:
+        document_file = result_cache.RESULT_CACHE.document_file(key)
+        if document_file is not None and doclingservice.adopt_document_file(document_file, document_id):
+            return
+
+def _path_key(format: str) -> str:
+    """export_document 返回的 paths 中對應此格式的鍵"""
+    return file_service.EXPORT_FORMATS.get(format, (format,))[0]
+
+def _output_filenames(paths: Dict[str, str]) -> Dict[str, str]:
+    return {key: Path(path).name for key, path in paths.items()}
+
+def _ocr_summary(output: ConversionOutput) -> Optional[dict]:
+    return ocr_selection.summarize(output.ocr_decisions) if output.ocr_decisions else None
+
 import os
 import time
 import json
 from urllib.parse import urlparse
-from fastapi import HTTPException # 需要處理下載錯誤等
 
 # 從其他服務匯入
-from services import file_service, progress_service
-from config import OUTPUT_DIR
+from services import file_service, progress_service, conversion_executor, job_queue, result_cache, admission_service, light_lane, doclingservice, download_service, url_cache, upload_service
+from config import OUTPUT_DIR, IMAGES_DIR
 from docling_core.types.doc import ImageRefMode # 需要匯入
 from docling.datamodel.pipeline_options import EasyOcrOptions # 需要匯入
 
-async def process_url_conversion_task(task_id: str, source_url: str, output_filename: str, format: str, conversion_options_dict: dict):
-    """背景任務：處理 URL 文件轉換"""
-    temp_file = None
-    file_path = None
-    try:
-        progress_service.update_progress(task_id, 10, "downloading", f"下載檔案中: {source_url}")
+async def fetch_url_source(
+    source_url: str,
+    options: ConversionOptions,
+    format: Union[str, List[str]],
+    output_path: Path,
+    on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+) -> Tuple[Optional["download_service.DownloadedFile"], Optional[dict]]:
+    """取得 URL 來源，返回 (下載的檔案, 快取的匯出結果) 其中之一
 
-        # 下載文件
-        async with httpx.AsyncClient(follow_redirects=True, timeout=60.0) as client:
-            try:
-                response = await client.get(source_url)
-                response.raise_for_status() 
-            except httpx.RequestError as exc:
-                print(f"[Task {task_id}] 下載時發生錯誤 {source_url}: {exc}")
-                raise HTTPException(status_code=400, detail=f"無法下載 URL: {exc}")
-            except httpx.HTTPStatusError as exc:
-                 print(f"[Task {task_id}] 下載時收到錯誤狀態碼 {source_url}: {exc.response.status_code}")
-                 raise HTTPException(status_code=exc.response.status_code, detail=f"下載 URL 時伺服器錯誤: {exc.response.status_code}")
-
-            # 確定檔案類型和副檔名 (這部分可以提取到 file_service)
-            content_type = response.headers.get("content-type", "")
-            file_extension = ".bin" # Default
-            if "pdf" in content_type: file_extension = ".pdf"
-            elif "image/jpeg" in content_type or "image/jpg" in content_type: file_extension = ".jpg"
-            elif "image/png" in content_type: file_extension = ".png"
-            elif "image" in content_type: file_extension = ".img" # Generic image
-            elif "html" in content_type: file_extension = ".html"
-            elif "text" in content_type: file_extension = ".txt"
-            elif "msword" in content_type or "officedocument" in content_type: file_extension = ".docx"
-            else:
-                url_p = urlparse(source_url).path
-                if url_p: _, ext = os.path.splitext(url_p); file_extension = ext if ext else ".bin"
-            
-            # 建立暫存檔案並儲存內容
-            # 使用 with 陳述式確保檔案即使出錯也能關閉
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_f:
-                temp_f.write(response.content)
-                file_path = Path(temp_f.name)
-            print(f"[Task {task_id}] 檔案已下載至暫存路徑: {file_path}")
+    此 URL 上次下載的內容仍有轉換結果快取時，先以條件式請求確認遠端文件是否變更；
+    遠端回應 304 時直接將快取結果複製到 output_path，返回 (None, 匯出結果)，略過下載與轉換。
+    其餘情況以共用的連線池串流下載 (邊下載邊計算雜湊，類型由檔頭判斷)，返回 (下載的檔案, None)。
+    """
+    cached_source = url_cache.lookup(source_url)
+    conditional = None
+    if cached_source and _has_cached_results(cached_source["sha256"], options, format):
+        conditional = url_cache.conditional_headers(cached_source) or None
 
-        progress_service.update_progress(task_id, 30, "converting", "轉換檔案中...")
+    client = download_service.get_client()
+    download = await download_service.download_to_file(client, source_url, on_progress=on_progress, conditional_headers=conditional)
+    if conditional:
+        url_cache.record_revalidation(download is None)
+    if download is None:
+        export_result = await convert_and_export(None, options, format, output_path, input_hash=cached_source["sha256"])
+        if export_result is not None:
+            return None, export_result
+        # 結果快取在確認期間已被移除，重新下載
+        download = await download_service.download_to_file(client, source_url, on_progress=on_progress)
+    url_cache.record(source_url, download)
+    return download, None
 
+def _report_download(task_id: str, source_url: str, received: int, total: Optional[int]) -> None:
+    """下載進度對應到 10% ~ 30% 的進度區間 (未知總大小時只更新訊息)"""
+    progress = 10 + int(20 * received / total) if total else 10
+    size = f"{received / 1024 ** 2:.1f} MB" + (f" / {total / 1024 ** 2:.1f} MB" if total else "")
+    progress_service.update_progress(task_id, min(progress, 30), "downloading", f"下載檔案中 ({size}): {source_url}")
+
+async def process_url_conversion_task(task_id: str, source_url: str, output_filename: str, format: Union[str, List[str]], conversion_options_dict: dict) -> dict:
+    """背景任務：處理 URL 文件轉換，返回該 URL 的轉換結果 (format 為列表時一次轉換匯出多種格式)"""
+    temp_file = None
+    file_path = None
+    url_result = {"source": source_url, "status": "pending", "output_filename": output_filename}
+    # 各階段耗時，逾時或失敗時保留已完成的部分
+    timings = url_result["timings"] = {}
+    task_start = time.perf_counter()
+    try:
         # 從字典重建 ConversionOptions
         # 注意：需要處理枚舉類型的值轉換
         try:
@@ -235,25 +628,46 @@ async def process_url_conversion_task(task_id: str, source_url: str, output_file
              print(f"[Task {task_id}] 無法從字典建立 ConversionOptions: {e}")
              # 可以使用預設選項或引發錯誤
              options_obj = ConversionOptions() # 使用預設值
-             progress_service.update_progress(task_id, 30, "converting", "警告：使用預設轉換選項")
-
-        # 執行轉換
-        conversion_result = run_conversion(file_path, options_obj)
-
-        progress_service.update_progress(task_id, 70, "processing", "處理轉換結果...")
+             progress_service.update_progress(task_id, 10, "downloading", "警告：使用預設轉換選項")
 
         # 決定最終輸出路徑
         output_path = OUTPUT_DIR / output_filename # 檔名已在路由處理過
-        
-        # 匯出文件
-        img_export_mode_value = options_obj.image_export_mode.value
-        export_result = await file_service.export_document(
-            result=conversion_result,
-            format=format,
-            image_export_mode=img_export_mode_value,
-            out_dir_path=str(OUTPUT_DIR),
-            out_path=str(output_path)
+
+        progress_service.update_progress(task_id, 10, "downloading", f"下載檔案中: {source_url}")
+
+        # 串流下載至暫存檔 (遠端未變更且結果仍在快取中時略過下載與轉換)
+        download, export_result = await fetch_url_source(
+            source_url, options_obj, format, output_path,
+            on_progress=lambda received, total: _report_download(task_id, source_url, received, total),
         )
+        input_hash = download.sha256 if download is not None else None
+        if download is not None:
+            file_path = download.path
+            url_result["download"] = download.to_dict()
+            print(f"[Task {task_id}] 檔案已下載至暫存路徑: {file_path}")
+        else:
+            url_result["not_modified"] = True
+        timings["download_seconds"] = round(time.perf_counter() - task_start, 3)
+
+        progress_service.update_progress(task_id, 30, "converting", "轉換檔案中...")
+
+        # 在工作行程中執行轉換並匯出 (結果快取命中時略過轉換)
+        img_export_mode_value = options_obj.image_export_mode.value
+        if export_result is None:
+            export_result = await convert_and_export(
+                file_path, options_obj, format, output_path,
+                on_progress=lambda info: progress_service.update_page_progress(task_id, info, 30, 70, "轉換檔案中"),
+                input_hash=input_hash,
+            )
+        url_result["cached"] = export_result["cached"]
+        url_result["cost"] = export_result["cost"]
+        if len(file_service.normalize_formats(format)) > 1:
+            url_result["output_filenames"] = _output_filenames(export_result["paths"])
+        if export_result["ocr_decisions"]:
+            url_result["ocr_decisions"] = export_result["ocr_decisions"]
+        timings["conversion_seconds"] = round(export_result["conversion_time"], 3)
+
+        progress_service.update_progress(task_id, 70, "processing", "處理轉換結果...")
         
         # 儲存元數據
         file_service.save_metadata(
@@ -265,12 +679,22 @@ async def process_url_conversion_task(task_id: str, source_url: str, output_file
 
         progress_service.update_progress(task_id, 100, "complete", "轉換完成")
         print(f"[Task {task_id}] URL 轉換成功完成: {source_url}")
+        url_result["status"] = "success"
 
+    except ConversionTimeoutError as e:
+        print(f"[Task {task_id}] URL 轉換逾時: {source_url}")
+        progress_service.update_progress(task_id, 100, "timeout", str(e))
+        url_result["status"] = "timeout"
+        url_result["error"] = str(e)
+        timings["conversion_seconds"] = round(e.elapsed, 3)
     except Exception as e:
         error_message = f"URL轉換失敗: {str(e)}"
         print(f"[Task {task_id}] {error_message}")
         progress_service.update_progress(task_id, 100, "error", error_message)
+        url_result["status"] = "error"
+        url_result["error"] = error_message
     finally:
+        timings["elapsed_seconds"] = round(time.perf_counter() - task_start, 3)
         # 清理暫存檔案
         if file_path and file_path.exists():
             try:
@@ -278,3 +702,497 @@ async def process_url_conversion_task(task_id: str, source_url: str, output_file
                 print(f"[Task {task_id}] 已刪除暫存檔案: {file_path}")
             except Exception as e:
                 print(f"[Task {task_id}] 無法刪除暫存檔案 {file_path}: {e}")
+    return url_result
+
+async def process_file_conversion_task(
+    task_id: str,
+    file_path: str,
+    original_filename: str,
+    format: Union[str, List[str]],
+    conversion_options_dict: dict,
+    index: int = 0,
+    total: int = 1,
+    input_hash: Optional[str] = None,
+    memory_key: Optional[str] = None,
+    retained: bool = True,
+) -> dict:
+    """佇列工作：轉換批次中的單一上傳檔案，返回該檔案的轉換結果
+
+    上傳內容保留在記憶體中時 (memory_key) 直接由記憶體轉換；結束後釋放記憶體，未保存的上傳檔案一併刪除。
+    """
+    file_result = {"original_filename": original_filename, "status": "pending", "output_filename": None}
+    timings = file_result["timings"] = {}
+    task_start = time.perf_counter()
+
+    # 以已結束的工作數計算批次進度
+    counts = job_queue.JOB_QUEUE.task_counts(task_id)
+    finished = sum(counts[state] for state in job_queue.JOB_FINISHED_STATES)
+    current_progress = int(((finished + 0.5) / max(total, 1)) * 100)
+    progress_service.update_progress(task_id, current_progress, "processing", f"處理檔案 {index + 1}/{total}: {original_filename}")
+
+    try:
+        options = ConversionOptions(**conversion_options_dict)
+        img_export_mode_value = options.image_export_mode.value
+
+        # 1. Determine output path (provide None for output_filename to generate unique)
+        #    多格式時以第一個格式決定主檔名，其他格式只替換副檔名
+        output_path = file_service.determine_output_path(
+            original_filename=original_filename,
+            format=file_service.normalize_formats(format)[0],
+            output_filename=None
+        )
+
+        # 2. Convert in a worker process and export (skipped entirely on a result cache hit)
+        data = upload_service.memory_data(memory_key)
+        if data is None and not Path(file_path).is_file():
+            raise FileNotFoundError(f"上傳內容已不存在 (服務可能已重啟): {original_filename}")
+        # 逐頁進度對應到此檔案在批次中所佔的進度區間
+        file_start = finished / max(total, 1) * 100
+        file_end = (finished + 1) / max(total, 1) * 100
+        export_result = await convert_and_export(
+            Path(file_path), options, format, output_path,
+            on_progress=lambda info: progress_service.update_page_progress(
+                task_id, info, file_start, file_end, f"處理檔案 {index + 1}/{total}: {original_filename}"
+            ),
+            input_hash=input_hash,
+            data=data,
+        )
+        file_result["cached"] = export_result["cached"]
+        file_result["cost"] = export_result["cost"]
+        if export_result["ocr_decisions"]:
+            file_result["ocr_decisions"] = export_result["ocr_decisions"]
+        timings["conversion_seconds"] = round(export_result["conversion_time"], 3)
+        paths = export_result.get("paths", {})
+        for path in paths.values():
+            print(f"文件已匯出至: {path}")
+        if len(file_service.normalize_formats(format)) > 1:
+            file_result["output_filenames"] = _output_filenames(paths)
+
+        # 4. Save metadata
+        file_service.save_metadata(
+            output_path=output_path,
+            source_identifier=original_filename,
+            format=format,
+            image_export_mode=img_export_mode_value
+        )
+
+        file_result["status"] = "success"
+        file_result["output_filename"] = output_path.name
+        print(f"[Task {task_id}] 成功處理檔案: {original_filename} -> {output_path.name}")
+    except ConversionTimeoutError as e:
+        file_result["status"] = "timeout"
+        file_result["error"] = str(e)
+        timings["conversion_seconds"] = round(e.elapsed, 3)
+        print(f"[Task {task_id}] 處理檔案逾時: {original_filename} - {e}")
+    except Exception as e:
+        error_message = str(e)
+        file_result["status"] = "error"
+        file_result["error"] = error_message
+        print(f"[Task {task_id}] 處理檔案失敗: {original_filename} - {error_message}")
+    finally:
+        data = None
+        upload_service.discard(file_path, memory_key, retained)
+
+    timings["elapsed_seconds"] = round(time.perf_counter() - task_start, 3)
+    return file_result
+
+def _url_basename(source_url: str) -> str:
+    url_path = urlparse(source_url).path
+    return os.path.basename(url_path) if url_path and os.path.basename(url_path) else "document_from_url"
+
+async def process_url_batch_download_task(
+    task_id: str,
+    urls: List[dict],
+    format: Union[str, List[str]],
+    conversion_options_dict: dict,
+    total: int = 1,
+) -> dict:
+    """佇列工作：並行下載批次中的 URL，每個下載完成就排入轉換工作
+
+    urls 中每項為 {"source_url", "index"}。同時下載數由 `Config.URL_BATCH_CONCURRENCY` 限制，
+    同一主機另受 `Config.HTTP_MAX_CONNECTIONS_PER_HOST` 限制。下載完成的檔案立即以 "url_file" 工作排入佇列
+    (輕量格式走輕量線道)，網路等待與轉換重疊進行。此工作本身在下載線道執行，不佔用轉換 worker。
+    返回下載失敗與遠端未變更 (直接使用快取結果) 的 URL 結果；其餘 URL 的結果由各自的轉換工作記錄。
+    """
+    options = ConversionOptions(**conversion_options_dict)
+    formats = file_service.normalize_formats(format)
+    # 服務重啟後重新執行時，略過已排入轉換工作的 URL
+    enqueued = job_queue.JOB_QUEUE.job_seqs(task_id, "url_file")
+    pending = [item for item in urls if item["index"] not in enqueued]
+    semaphore = asyncio.Semaphore(max(1, Config.URL_BATCH_CONCURRENCY))
+    url_results: Dict[int, dict] = {}
+    progress_service.set_batch_counter(task_id, "downloaded", len(urls) - len(pending))
+
+    def report_download(converted: bool = False) -> None:
+        # 下載失敗或遠端未變更的 URL 不會再排入轉換，同時計為已處理
+        finished = progress_service.advance_batch_counter(task_id, "downloaded")
+        if converted:
+            progress_service.advance_batch_counter(task_id, "converted")
+        progress_service.update_url_batch_progress(task_id, total, "downloading", f"已下載 {finished}/{total} 個 URL")
+
+    async def fetch_one(item: dict) -> None:
+        source_url = item["source_url"]
+        output_path = file_service.determine_output_path(_url_basename(source_url), formats[0], None)
+        url_result = {"source": source_url, "status": "pending", "output_filename": output_path.name, "timings": {}}
+        start = time.perf_counter()
+        try:
+            async with semaphore:
+                download, export_result = await fetch_url_source(source_url, options, formats, output_path)
+        except Exception as e:
+            url_result.update(status="error", error=f"下載失敗: {e}")
+            url_result["timings"]["download_seconds"] = round(time.perf_counter() - start, 3)
+            url_results[item["index"]] = url_result
+            print(f"[Task {task_id}] 下載失敗: {source_url} - {e}")
+            report_download(converted=True)
+            return
+        download_seconds = round(time.perf_counter() - start, 3)
+
+        if download is None:
+            # 遠端未變更，已直接使用快取的轉換結果
+            file_service.save_metadata(output_path, source_url, format, options.image_export_mode.value)
+            url_result.update(status="success", cached=True, not_modified=True, cost=0.0)
+            url_result["timings"]["download_seconds"] = download_seconds
+            if len(formats) > 1:
+                url_result["output_filenames"] = _output_filenames(export_result["paths"])
+            url_results[item["index"]] = url_result
+            report_download(converted=True)
+            return
+
+        light = light_lane.is_light_document(download.path)
+        job_queue.JOB_QUEUE.enqueue(
+            task_id,
+            kind="url_file",
+            payload={
+                "source_url": source_url,
+                "file_path": str(download.path),
+                "input_hash": download.sha256,
+                "output_filename": output_path.name,
+                "format": formats,
+                "conversion_options_dict": conversion_options_dict,
+                "download": download.to_dict(),
+                "download_seconds": download_seconds,
+                "index": item["index"],
+                "total": total,
+            },
+            priority=job_queue.PRIORITY_INTERACTIVE if light else job_queue.PRIORITY_BULK,
+            seq=item["index"],
+            lane=job_queue.LANE_LIGHT if light else job_queue.LANE_STANDARD,
+        )
+        report_download()
+
+    await asyncio.gather(*(fetch_one(item) for item in pending))
+    return _chunk_result(url_results)
+
+async def process_url_file_task(
+    task_id: str,
+    source_url: str,
+    file_path: str,
+    output_filename: str,
+    format: Union[str, List[str]],
+    conversion_options_dict: dict,
+    input_hash: Optional[str] = None,
+    download: Optional[dict] = None,
+    download_seconds: float = 0.0,
+    index: int = 0,
+    total: int = 1,
+) -> dict:
+    """佇列工作：轉換批次 URL 中已下載的檔案，完成後刪除暫存檔"""
+    url_result = {"source": source_url, "status": "pending", "output_filename": output_filename, "download": download}
+    timings = url_result["timings"] = {"download_seconds": download_seconds}
+    task_start = time.perf_counter()
+    message = f"轉換 URL {index + 1}/{total}: {source_url}"
+    progress_service.update_url_batch_progress(task_id, total, "processing", message)
+    try:
+        options = ConversionOptions(**conversion_options_dict)
+        output_path = OUTPUT_DIR / output_filename
+        export_result = await convert_and_export(
+            Path(file_path), options, format, output_path,
+            on_progress=lambda info: progress_service.update_url_batch_progress(task_id, total, "converting", message, info),
+            input_hash=input_hash,
+        )
+        url_result["cached"] = export_result["cached"]
+        url_result["cost"] = export_result["cost"]
+        if len(file_service.normalize_formats(format)) > 1:
+            url_result["output_filenames"] = _output_filenames(export_result["paths"])
+        if export_result["ocr_decisions"]:
+            url_result["ocr_decisions"] = export_result["ocr_decisions"]
+        timings["conversion_seconds"] = round(export_result["conversion_time"], 3)
+        file_service.save_metadata(output_path, source_url, format, options.image_export_mode.value)
+        url_result["status"] = "success"
+        print(f"[Task {task_id}] URL 轉換成功完成: {source_url}")
+    except ConversionTimeoutError as e:
+        url_result.update(status="timeout", error=str(e))
+        timings["conversion_seconds"] = round(e.elapsed, 3)
+        print(f"[Task {task_id}] URL 轉換逾時: {source_url}")
+    except Exception as e:
+        url_result.update(status="error", error=f"URL轉換失敗: {e}")
+        print(f"[Task {task_id}] URL 轉換失敗: {source_url} - {e}")
+    finally:
+        Path(file_path).unlink(missing_ok=True)
+        progress_service.advance_batch_counter(task_id, "converted")
+        progress_service.update_url_batch_progress(task_id, total, "processing", message)
+    timings["elapsed_seconds"] = round(time.perf_counter() - task_start, 3)
+    return url_result
+
+async def _convert_batch_chunk(
+    task_id: str,
+    files: List[dict],
+    format: Union[str, List[str]],
+    conversion_options_dict: dict,
+    total: int = 1,
+    file_results: Optional[Dict[int, dict]] = None,
+) -> dict:
+    """佇列工作：以單一轉換器串流轉換批次中的一組檔案
+
+    files 中每項為 {"file_path", "original_filename", "input_hash", "index"}。
+    file_results 由呼叫端傳入時，每個檔案的結果會隨轉換進度寫入其中，工作被取消時仍可取得已完成的部分。
+    結果快取命中的檔案直接略過；其餘檔案在工作行程中以 convert_all 依序轉換，
+    每產出一個結果就交由執行緒匯出，與下一個檔案的轉換重疊進行。
+    單一檔案逾時或使工作行程失效時，只標記該檔案，其餘檔案以新的串流繼續轉換。
+    format 為列表時每個檔案只轉換一次，再從同一份文件匯出所有格式。
+    """
+    options = ConversionOptions(**conversion_options_dict)
+    img_export_mode_value = options.image_export_mode.value
+    timeout = resolve_timeout(options)
+    formats = file_service.normalize_formats(format)
+    file_results = {} if file_results is None else file_results
+    output_paths: Dict[int, Dict[str, Path]] = {}
+    cache_keys: Dict[int, Dict[str, str]] = {}
+    # 每個檔案尚未由快取取得、需要匯出的格式
+    missing_formats: Dict[int, List[str]] = {}
+    pending: List[dict] = []
+
+    def file_message(entry: dict) -> str:
+        return f"處理檔案 {entry['index'] + 1}/{total}: {entry['original_filename']}"
+
+    # 1. 決定輸出路徑並查詢結果快取
+    for entry in files:
+        file_result = {"original_filename": entry["original_filename"], "status": "pending", "output_filename": None, "timings": {}}
+        file_results[entry["index"]] = file_result
+        output_path = file_service.determine_output_path(entry["original_filename"], formats[0], None)
+        targets = output_paths[entry["index"]] = file_service.format_output_paths(output_path, formats)
+        missing = missing_formats[entry["index"]] = list(formats)
+        if len(formats) > 1:
+            file_result["output_filenames"] = {}
+        if Config.RESULT_CACHE_ENABLED:
+            # 上傳時已計算內容雜湊 (舊版佇列工作沒有時才重新讀取)
+            input_hash = entry.get("input_hash") or await asyncio.to_thread(result_cache.hash_file, Path(entry["file_path"]))
+            keys = cache_keys[entry["index"]] = {fmt: result_cache.make_key(input_hash, options, fmt) for fmt in formats}
+            missing.clear()
+            for fmt in formats:
+                target_path = file_service.sanitized_output_path(targets[fmt])
+                if await asyncio.to_thread(result_cache.RESULT_CACHE.materialize, keys[fmt], target_path, output_path.stem):
+                    if len(formats) > 1:
+                        file_result["output_filenames"][_path_key(fmt)] = target_path.name
+                else:
+                    missing.append(fmt)
+            if not missing:
+                await asyncio.to_thread(adopt_cached_document, keys.values(), output_path.stem)
+                file_service.save_metadata(output_path, entry["original_filename"], format, img_export_mode_value)
+                file_result.update(status="success", output_filename=output_path.name, cached=True, cost=0.0)
+                continue
+        file_result["cached"] = False
+        pending.append(entry)
+
+    if not pending:
+        return _chunk_result(file_results)
+
+    # 2. 以整組檔案的成本取得准入預算
+    costs = {}
+    for entry in pending:
+        probe = await asyncio.to_thread(admission_service.probe_document, Path(entry["file_path"]))
+        costs[entry["index"]] = admission_service.estimate_cost(probe, options)
+        file_results[entry["index"]]["cost"] = costs[entry["index"]]
+
+    export_semaphore = asyncio.Semaphore(max(1, Config.BATCH_EXPORT_CONCURRENCY))
+    export_tasks: List[asyncio.Task] = []
+
+    async def export_one(entry: dict, output: ConversionOutput) -> None:
+        file_result = file_results[entry["index"]]
+        targets = output_paths[entry["index"]]
+        output_path = targets[formats[0]]
+        missing = missing_formats[entry["index"]]
+        try:
+            async with export_semaphore:
+                # export_document 在執行緒中產生內容與寫檔，各檔案的匯出在同一個事件迴圈中重疊進行
+                export_result = await file_service.export_document(
+                    result=output,
+                    format=missing,
+                    image_export_mode=img_export_mode_value,
+                    out_dir_path=str(OUTPUT_DIR),
+                    out_path=str(targets[missing[0]]),
+                )
+            paths = export_result.get("paths", {})
+            await asyncio.to_thread(persist_document, output, output_path.stem)
+            for fmt in missing:
+                if fmt in cache_keys.get(entry["index"], {}) and _path_key(fmt) in paths:
+                    await asyncio.to_thread(
+                        result_cache.RESULT_CACHE.store,
+                        cache_keys[entry["index"]][fmt],
+                        Path(paths[_path_key(fmt)]),
+                        IMAGES_DIR / output_path.stem,
+                        output_path.stem,
+                        output.conversion_time,
+                        doclingservice.document_file(output_path.stem),
+                    )
+            file_service.save_metadata(output_path, entry["original_filename"], format, img_export_mode_value)
+            file_result.update(status="success", output_filename=output_path.name)
+            if len(formats) > 1:
+                file_result["output_filenames"].update(_output_filenames(paths))
+            if output.ocr_decisions:
+                file_result["ocr_decisions"] = _ocr_summary(output)
+            print(f"[Task {task_id}] 成功處理檔案: {entry['original_filename']} -> {output_path.name}")
+        except Exception as e:
+            file_result.update(status="error", error=str(e))
+            print(f"[Task {task_id}] 匯出檔案失敗: {entry['original_filename']} - {e}")
+
+    def mark_failed(entry: dict, status: str, message: str, elapsed: float) -> None:
+        file_results[entry["index"]].update(status=status, error=message)
+        file_results[entry["index"]]["timings"]["conversion_seconds"] = round(elapsed, 3)
+        print(f"[Task {task_id}] 處理檔案失敗: {entry['original_filename']} - {message}")
+
+    # 3. 串流轉換：每個結果一產出就開始匯出，同時轉換下一個檔案
+    remaining = list(pending)
+    try:
+        async with admission_service.ADMISSION.admit(sum(costs.values())):
+            while remaining:
+                stream_entries = remaining
+                produced = set()
+
+                def on_progress(info: dict, _entries=stream_entries) -> None:
+                    entry = _entries[min(info.get("index", 0), len(_entries) - 1)]
+                    progress_service.update_page_progress(
+                        task_id, info,
+                        entry["index"] / max(total, 1) * 100, (entry["index"] + 1) / max(total, 1) * 100,
+                        file_message(entry),
+                    )
+
+                progress_service.update_progress(
+                    task_id, int(stream_entries[0]["index"] / max(total, 1) * 100), "processing", file_message(stream_entries[0])
+                )
+                stream = conversion_executor.EXECUTOR.stream(
+                    convert_all_to_outputs, [entry["file_path"] for entry in stream_entries], options, on_progress=on_progress
+                )
+                item_start = time.perf_counter()
+                try:
+                    async for position, output, error in _with_item_timeout(stream, timeout):
+                        entry = stream_entries[position]
+                        produced.add(position)
+                        elapsed = time.perf_counter() - item_start
+                        item_start = time.perf_counter()
+                        if error is not None:
+                            mark_failed(entry, "error", error, elapsed)
+                            continue
+                        file_results[entry["index"]]["timings"]["conversion_seconds"] = round(elapsed, 3)
+                        export_tasks.append(asyncio.create_task(export_one(entry, output)))
+                    # 串流正常結束卻未產出結果的檔案視為失敗
+                    for position, entry in enumerate(stream_entries):
+                        if position not in produced:
+                            mark_failed(entry, "error", "轉換器未產出結果", 0.0)
+                    remaining = []
+                except Exception as e:
+                    # 目前轉換中的檔案逾時或使工作行程失效：標記該檔案，其餘檔案以新的串流繼續
+                    left = [entry for position, entry in enumerate(stream_entries) if position not in produced]
+                    elapsed = time.perf_counter() - item_start
+                    if not left:
+                        print(f"[Task {task_id}] 批次轉換結束時發生錯誤: {e}")
+                        remaining = []
+                        continue
+                    if isinstance(e, asyncio.TimeoutError):
+                        mark_failed(left[0], "timeout", str(ConversionTimeoutError(timeout, elapsed)), elapsed)
+                    else:
+                        mark_failed(left[0], "error", str(e), elapsed)
+                    remaining = left[1:]
+                finally:
+                    await stream.aclose()
+
+            # 4. 等待最後的匯出完成
+            await asyncio.gather(*export_tasks)
+    finally:
+        for export_task in export_tasks:
+            export_task.cancel()
+
+    return _chunk_result(file_results)
+
+async def process_batch_chunk_task(
+    task_id: str,
+    files: List[dict],
+    format: Union[str, List[str]],
+    conversion_options_dict: dict,
+    total: int = 1,
+) -> dict:
+    """佇列工作：轉換批次中的一組檔案 (見 _convert_batch_chunk)，結束後刪除未保存的上傳檔案
+
+    工作被取消時，已完成的檔案保留其結果，其餘檔案標記為已取消後回報給佇列。
+    """
+    file_results: Dict[int, dict] = {}
+    try:
+        return await _convert_batch_chunk(task_id, files, format, conversion_options_dict, total, file_results)
+    except asyncio.CancelledError:
+        for entry in files:
+            file_result = file_results.setdefault(entry["index"], {
+                "original_filename": entry["original_filename"], "status": "pending", "output_filename": None, "timings": {},
+            })
+            if file_result["status"] == "pending":
+                file_result.update(status="cancelled", error="使用者已取消")
+        job_queue.JOB_QUEUE.record_partial_result(_chunk_result(file_results))
+        raise
+    finally:
+        for entry in files:
+            upload_service.discard(entry["file_path"], entry.get("memory_key"), entry.get("retained", True))
+
+async def _with_item_timeout(stream, timeout: float):
+    """逐項讀取非同步迭代器，任一項等待超過 timeout 秒時引發 asyncio.TimeoutError"""
+    while True:
+        try:
+            yield await asyncio.wait_for(stream.__anext__(), timeout)
+        except StopAsyncIteration:
+            return
+
+def _chunk_result(file_results: Dict[int, dict]) -> dict:
+    results = [file_results[index] for index in sorted(file_results)]
+    success_count = len([r for r in results if r["status"] == "success"])
+    if success_count == len(results):
+        status = "success"
+    elif success_count == 0:
+        status = "error"
+    else:
+        status = "partial_error"
+    return {"status": status, "results": results}
+
+def finalize_batch_task(task_id: str, results: List[dict]) -> None:
+    """批次任務所有檔案結束後更新最終進度"""
+    total_files = len(results)
+    success_count = len([r for r in results if r.get("status") == "success"])
+    cancelled_count = len([r for r in results if r.get("status") == "cancelled"])
+    timeout_count = len([r for r in results if r.get("status") == "timeout"])
+    if cancelled_count:
+        final_status = "cancelled"
+    else:
+        final_status = "complete" if success_count == total_files else "partial_error"
+    final_message = f"檔案轉換完成: 成功 {success_count}/{total_files} 檔案"
+    failed_count = total_files - success_count - cancelled_count - timeout_count
+    if failed_count:
+        final_message += f", 失敗 {failed_count}"
+    if timeout_count:
+        final_message += f", 逾時 {timeout_count}"
+    if cancelled_count:
+        final_message += f", 已取消 {cancelled_count}"
+    progress_service.update_progress(task_id, 100, final_status, final_message)
+    progress_service.clear_batch_counters(task_id)
+
+def discard_job_uploads(payload: dict) -> None:
+    """工作未執行即被取消時，釋放其記憶體中的上傳內容並刪除未保存的上傳檔案"""
+    for entry in payload.get("files") or [payload]:
+        upload_service.discard(entry["file_path"], entry.get("memory_key"), entry.get("retained", True))
+
+# 註冊佇列工作處理函式
+job_queue.JOB_QUEUE.register_handler("url", process_url_conversion_task)
+job_queue.JOB_QUEUE.register_handler("file", process_file_conversion_task)
+job_queue.JOB_QUEUE.register_handler("batch_chunk", process_batch_chunk_task)
+job_queue.JOB_QUEUE.register_handler("url_batch_download", process_url_batch_download_task)
+job_queue.JOB_QUEUE.register_handler("url_file", process_url_file_task)
+job_queue.JOB_QUEUE.register_cancel_hook("file", discard_job_uploads)
+job_queue.JOB_QUEUE.register_cancel_hook("batch_chunk", discard_job_uploads)
+job_queue.JOB_QUEUE.register_task_finalizer("batch", finalize_batch_task)
+job_queue.JOB_QUEUE.register_task_finalizer("url_batch", finalize_batch_task)
@@ -0,0 +1,130 @@
+"""DocumentConverter 池
+
+依 ConversionOptions 的正規化指紋快取已初始化的 DocumentConverter，
+相同選項的轉換可以共用已載入模型的 pipeline，避免每次轉換都重新初始化。
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Set
+
+from docling.document_converter import DocumentConverter
+
+from models import ConversionOptions
+
+# 不影響轉換器建構的欄位 (僅作用於單次請求)，不列入指紋
+_NON_CONVERTER_FIELDS: Set[str] = {"shard_pages", "timeout"}
+# 只影響轉換的執行方式 (執行緒數、運算裝置)、不影響輸出內容的欄位，結果快取的指紋不列入
+EXECUTION_ONLY_FIELDS: Set[str] = {"num_threads", "device"}
+
+def fingerprint_options(options: ConversionOptions, exclude: Set[str] = frozenset()) -> str:
+    """計算 ConversionOptions 的正規化指紋
+
+    以 JSON 模式匯出 (枚舉轉為值)，並依鍵排序後計算 SHA-256，
+    確保欄位順序或枚舉型別不同但語意相同的選項得到相同的指紋。
+    exclude 為額外不列入指紋的欄位。
+    """
+    data = options.model_dump(mode="json", exclude=_NON_CONVERTER_FIELDS | set(exclude))
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+class _PoolEntry:
+    """池中的單一轉換器及其統計資料"""
+
+    def __init__(self, converter: DocumentConverter, build_time: float):
+        self.converter = converter
+        self.build_time = build_time
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.hits = 0
+
+class ConverterPool:
+    """有容量上限的 LRU 轉換器池"""
+
+    def __init__(self, factory: Callable[[ConversionOptions], DocumentConverter], max_size: int = 4):
+        self._factory = factory
+        self._max_size = max(1, max_size)
+        self._entries: "OrderedDict[str, _PoolEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 每個指紋一把建構鎖，避免同一組選項被同時建構兩次
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._misses: Dict[str, int] = {}
+        self.total_hits = 0
+        self.evictions = 0
+
+    def get(self, options: ConversionOptions) -> DocumentConverter:
+        """取得對應選項的轉換器，若不存在則建立並放入池中"""
+        key = fingerprint_options(options)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.hits += 1
+                entry.last_used = time.time()
+                self.total_hits += 1
+                return entry.converter
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        with build_lock:
+            # 等待建構鎖期間，可能已由其他執行緒建好
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.hits += 1
+                    entry.last_used = time.time()
+                    self.total_hits += 1
+                    return entry.converter
+
+            start = time.perf_counter()
+            converter = self._factory(options)
+            build_time = time.perf_counter() - start
+            print(f"[converter_pool] 建立新轉換器 {key[:12]} (耗時 {build_time:.2f}s)")
+
+            with self._lock:
+                self._misses[key] = self._misses.get(key, 0) + 1
+                self._entries[key] = _PoolEntry(converter, build_time)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self._max_size:
+                    evicted_key, _ = self._entries.popitem(last=False)
+                    self._build_locks.pop(evicted_key, None)
+                    self.evictions += 1
+                    print(f"[converter_pool] 移除最久未使用的轉換器 {evicted_key[:12]}")
+            return converter
+
+    def contains(self, options: ConversionOptions) -> bool:
+        """檢查池中是否已有對應選項的轉換器"""
+        with self._lock:
+            return fingerprint_options(options) in self._entries
+
+    def clear(self) -> None:
+        """清空池中所有轉換器"""
+        with self._lock:
+            self._entries.clear()
+            self._build_locks.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回池的整體與個別項目統計資料"""
+        with self._lock:
+            entries = []
+            for key, entry in self._entries.items():
+                entries.append({
+                    "fingerprint": key,
+                    "hits": entry.hits,
+                    "misses": self._misses.get(key, 0),
+                    "build_time": round(entry.build_time, 4),
+                    "created_at": entry.created_at,
+                    "last_used": entry.last_used,
+                })
+            total_misses = sum(self._misses.values())
+            return {
+                "size": len(self._entries),
+                "max_size": self._max_size,
+                "hits": self.total_hits,
+                "misses": total_misses,
+                "evictions": self.evictions,
+                "entries": entries,
+            }
@@ -1,151 +1,289 @@
 """與 Docling 核心通訊的服務模組
 
-提供與 Docling 核心通訊的函式，包括獲取文件內容、轉換格式等。
+每次轉換產生的 DoclingDocument 以 JSON (圖片以 base64 內嵌) 保存於 `Config.DOCUMENT_STORE_DIR`，
+作為該文件的標準產物；其他格式 (HTML、Markdown、YAML、純文字、DocTags...) 都從此文件產生，不需要重新轉換。
+最近使用的文件以反序列化後的物件保留在記憶體中 (LRU，上限 `Config.DOCUMENT_CACHE_SIZE`)。
+`Config.DOCUMENT_STORE_FORMAT="binary"` 時改以 services/document_codec.py 的精簡二進位格式保存，
+圖片以原始位元組存放並透過 mmap 存取；兩種格式的文件可同時存在，讀取時依檔案判斷。
 """
-from docling_core.types.doc import ImageRefMode
-import json
-from typing import Optional, Dict, Any, Union
+import asyncio
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Dict, Any, Tuple
 
-# 這是一個模擬功能的簡單實現，實際應用中需要通過 docling 核心 API 獲取文件
-# 在真實環境中，這些函數應該通過 API 或直接調用 docling 庫來實現
+import yaml
+from docling_core.types.doc import DoclingDocument, ImageRefMode
+
+from config import Config
+from services import document_codec
+
+# 文件 ID 只允許可安全作為檔名的字元
+_SAFE_ID_PATTERN = re.compile(r"[^\w.\-]")
+
+_BINARY_SUFFIX = ".dlbin"
+# 不需要圖片內容的格式，從二進位文件載入時略過圖片區段
+_TEXT_ONLY_FORMATS = {"text", "doctags"}
+
+# (文件 ID, 是否含圖片) -> 已反序列化的文件
+_cache: "OrderedDict[Tuple[str, bool], DoclingDocument]" = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "saved": 0}
+
+class DocumentNotFoundError(KeyError):
+    """文件儲存中沒有指定 ID 的文件"""
+
+def _document_path(document_id: str, suffix: str = ".json") -> Path:
+    safe_id = _SAFE_ID_PATTERN.sub("_", str(document_id)).lstrip(".")
+    if not safe_id:
+        raise ValueError(f"無效的文件 ID: {document_id!r}")
+    return Config.DOCUMENT_STORE_DIR / f"{safe_id}{suffix}"
+
+def _stored_path(document_id: str) -> Optional[Path]:
+    """已保存的文件檔案 (二進位或 JSON)，不存在時返回 None"""
+    for suffix in (_BINARY_SUFFIX, ".json"):
+        path = _document_path(document_id, suffix)
+        if path.is_file():
+            return path
+    return None
+
+def _remember(key: Tuple[str, bool], document: DoclingDocument) -> None:
+    with _cache_lock:
+        _cache[key] = document
+        _cache.move_to_end(key)
+        while len(_cache) > max(0, Config.DOCUMENT_CACHE_SIZE):
+            _cache.popitem(last=False)
+
+def _forget(document_id: str) -> None:
+    with _cache_lock:
+        for with_images in (True, False):
+            _cache.pop((document_id, with_images), None)
+
+def save_document(document: DoclingDocument, document_id: str) -> Optional[Path]:
+    """保存轉換產生的 DoclingDocument (圖片以 EMBEDDED 模式內嵌，之後任何格式都能由此產生)"""
+    if not Config.DOCUMENT_STORE_ENABLED:
+        return None
+    binary = Config.DOCUMENT_STORE_FORMAT == "binary"
+    path = _document_path(document_id, _BINARY_SUFFIX if binary else ".json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        if binary:
+            document_codec.write_document(document.export_to_dict(), tmp_path, Config.DOCUMENT_STORE_COMPRESSION_LEVEL)
+        else:
+            document.save_as_json(tmp_path, image_mode=ImageRefMode.EMBEDDED)
+        os.replace(tmp_path, path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    # 移除以另一種格式保存的舊版本
+    _document_path(document_id, ".json" if binary else _BINARY_SUFFIX).unlink(missing_ok=True)
+    _forget(document_id)
+    _remember((document_id, True), document)
+    _stats["saved"] += 1
+    print(f"[doclingservice] 已保存文件 {document_id} -> {path}")
+    return path
+
+def document_file(document_id: str) -> Optional[Path]:
+    """已保存的文件檔案路徑 (供結果快取保存)；不存在或文件 ID 無效時返回 None"""
+    try:
+        return _stored_path(document_id)
+    except ValueError:
+        return None
+
+def adopt_document_file(source: Path, document_id: str) -> bool:
+    """以既有的文件檔案 (例如結果快取中保存的文件) 作為 document_id 的文件，優先使用硬連結
+
+    結果快取命中時不會重新轉換，以此讓 /output/{filename}?format=... 仍能由保存的文件產生其他格式。
+    """
+    if not Config.DOCUMENT_STORE_ENABLED:
+        return False
+    source = Path(source)
+    suffix = _BINARY_SUFFIX if source.suffix == _BINARY_SUFFIX else ".json"
+    path = _document_path(document_id, suffix)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        tmp_path.unlink(missing_ok=True)
+        print(f"[doclingservice] 無法由 {source} 建立文件 {document_id}: {e}")
+        return False
+    _document_path(document_id, ".json" if suffix == _BINARY_SUFFIX else _BINARY_SUFFIX).unlink(missing_ok=True)
+    _forget(document_id)
+    print(f"[doclingservice] 已由快取的文件建立 {document_id}")
+    return True
+
+def has_document(document_id: str) -> bool:
+    with _cache_lock:
+        if (document_id, True) in _cache or (document_id, False) in _cache:
+            return True
+    try:
+        return _stored_path(document_id) is not None
+    except ValueError:
+        return False
+
+def load_document(document_id: str, with_images: bool = True) -> DoclingDocument:
+    """取得已保存的文件，優先使用記憶體中的 LRU 快取
+
+    with_images=False 時可略過二進位文件的圖片區段 (圖片欄位為 None)，適用於不需要圖片的格式。
+    """
+    keys = [(document_id, True)] if with_images else [(document_id, False), (document_id, True)]
+    with _cache_lock:
+        for key in keys:
+            document = _cache.get(key)
+            if document is not None:
+                _cache.move_to_end(key)
+                _stats["hits"] += 1
+                return document
+    path = _stored_path(document_id)
+    if path is None:
+        raise DocumentNotFoundError(document_id)
+    if path.suffix == _BINARY_SUFFIX:
+        document = DoclingDocument.model_validate(document_codec.read_document(path, with_images=with_images))
+    else:
+        # JSON 格式的圖片與文件內容無法分開讀取
+        document = DoclingDocument.load_from_json(path)
+        with_images = True
+    _stats["misses"] += 1
+    _remember((document_id, with_images), document)
+    return document
+
+def load_document_with_picture_uris(
+    document_id: str,
+    picture_uri: Callable[[memoryview, str], str],
+) -> Optional[DoclingDocument]:
+    """讀取二進位格式保存的文件，圖片原始位元組 (mmap 的 memoryview) 直接交給 picture_uri，
+    以其返回值作為圖片 URI；不經 base64 編碼，也不放入記憶體快取。以 JSON 保存或不存在時返回 None"""
+    path = _stored_path(document_id)
+    if path is None or path.suffix != _BINARY_SUFFIX:
+        return None
+    with document_codec.BinaryDocument(path) as binary:
+        document_dict = binary.to_dict(picture_uri=picture_uri)
+    return DoclingDocument.model_validate(document_dict)
+
+def delete_document(document_id: str) -> bool:
+    """刪除已保存的文件，返回是否有刪除檔案"""
+    _forget(document_id)
+    try:
+        paths = [_document_path(document_id, suffix) for suffix in (_BINARY_SUFFIX, ".json")]
+    except ValueError:
+        return False
+    deleted = False
+    for path in paths:
+        if path.is_file():
+            path.unlink()
+            deleted = True
+    if deleted:
+        print(f"[doclingservice] 已刪除文件 {document_id}")
+    return deleted
+
+def render_document(
+    document: DoclingDocument,
+    format: str,
+    image_mode: ImageRefMode = ImageRefMode.EMBEDDED,
+) -> Any:
+    """從 DoclingDocument 產生指定格式的內容；json 返回字典，其餘格式返回字串"""
+    if format == "json":
+        return document.export_to_dict()
+    if format == "yaml":
+        return yaml.safe_dump(document.export_to_dict(), allow_unicode=True, sort_keys=False)
+    if format in ("html", "html-single"):
+        return document.export_to_html(image_mode=image_mode)
+    if format == "markdown":
+        return document.export_to_markdown(image_mode=image_mode)
+    if format == "text":
+        return document.export_to_text()
+    if format == "doctags":
+        # 舊版 docling-core 只有 export_to_document_tokens
+        export_doctags = getattr(document, "export_to_doctags", None) or document.export_to_document_tokens
+        return export_doctags()
+    raise ValueError(f"不支援的匯出格式: {format}")
+
+async def _render(document_id: str, format: str, image_mode: ImageRefMode = ImageRefMode.EMBEDDED) -> Any:
+    def load_and_render():
+        document = load_document(document_id, with_images=format not in _TEXT_ONLY_FORMATS)
+        return render_document(document, format, image_mode)
+    return await asyncio.to_thread(load_and_render)
 
 async def get_document_as_json(document_id: str) -> Dict[str, Any]:
     """獲取文件的 JSON 表示
-    
+
     參數:
         document_id: 文件 ID
-        
+
     返回:
         包含文件內容的 JSON 物件
     """
-    # 實際使用中應該呼叫 docling 核心庫或 API 來獲取文件
-    # 這裡僅提供一個簡單的模擬實現
     print(f"[doclingservice] 獲取文件 JSON 格式: {document_id}")
-    
-    # 假設文件內容在這裡從 docling 核心獲取
-    # 這裡返回一個簡單的 JSON 物件作為範例
-    return {
-        "id": document_id,
-        "type": "document",
-        "content": f"Document content for {document_id}",
-        "meta": {
-            "created_at": "2023-04-01T00:00:00Z"
-        }
-    }
+    return await _render(document_id, "json")
 
 async def get_document_as_html(
-    document_id: str, 
-    image_mode: ImageRefMode = ImageRefMode.REFERENCED, 
+    document_id: str,
+    image_mode: ImageRefMode = ImageRefMode.REFERENCED,
     single_file: bool = False
 ) -> str:
     """獲取文件的 HTML 表示
-    
+
     參數:
         document_id: 文件 ID
         image_mode: 圖片處理模式，可為 EMBEDDED (內嵌), REFERENCED (引用) 或 PLACEHOLDER (佔位符)
         single_file: 是否生成單一檔案 HTML
-        
+
     返回:
         HTML 字串
     """
     print(f"[doclingservice] 獲取文件 HTML 格式: {document_id}, image_mode: {image_mode}, single_file: {single_file}")
-    
-    # 根據 image_mode 生成不同的 HTML
-    if image_mode == ImageRefMode.EMBEDDED:
-        # 假設這是一個帶有 base64 編碼圖片的 HTML
-        return f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Document {document_id}</title>
-        </head>
-        <body>
-            <h1>Document {document_id}</h1>
-            <p>This is a sample document with embedded image:</p>
-            <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==" alt="Sample image">
-            <p>End of document.</p>
-        </body>
-        </html>
-        """
-    elif image_mode == ImageRefMode.PLACEHOLDER:
-        # 使用佔位符代替圖片
-        return f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Document {document_id}</title>
-        </head>
-        <body>
-            <h1>Document {document_id}</h1>
-            <p>This is a sample document with placeholder image:</p>
-            <!-- image -->
-            <p>End of document.</p>
-        </body>
-        </html>
-        """
-    else:  # ImageRefMode.REFERENCED
-        # 預設相對路徑引用
-        return f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Document {document_id}</title>
-        </head>
-        <body>
-            <h1>Document {document_id}</h1>
-            <p>This is a sample document with referenced image:</p>
-            <img src="images/sample.png" alt="Sample image">
-            <p>End of document.</p>
-        </body>
-        </html>
-        """
+    return await _render(document_id, "html-single" if single_file else "html", image_mode)
 
 async def get_document_as_markdown(
-    document_id: str, 
+    document_id: str,
     image_mode: ImageRefMode = ImageRefMode.REFERENCED
 ) -> str:
     """獲取文件的 Markdown 表示
-    
+
     參數:
         document_id: 文件 ID
         image_mode: 圖片處理模式，可為 EMBEDDED (內嵌), REFERENCED (引用) 或 PLACEHOLDER (佔位符)
-        
+
     返回:
         Markdown 字串
     """
     print(f"[doclingservice] 獲取文件 Markdown 格式: {document_id}, image_mode: {image_mode}")
-    
-    # 根據 image_mode 生成不同的 Markdown
-    if image_mode == ImageRefMode.EMBEDDED:
-        # 假設這是帶有 base64 編碼圖片的 Markdown
-        return f"""
-# Document {document_id}
+    return await _render(document_id, "markdown", image_mode)
 
-This is a sample document with embedded image:
+async def get_document_as_yaml(document_id: str) -> str:
+    """獲取文件的 YAML 表示 (內容與 JSON 相同)"""
+    print(f"[doclingservice] 獲取文件 YAML 格式: {document_id}")
+    return await _render(document_id, "yaml")
 
-![Sample image](data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==)
+async def get_document_as_text(document_id: str) -> str:
+    """獲取文件的純文字表示"""
+    print(f"[doclingservice] 獲取文件純文字格式: {document_id}")
+    return await _render(document_id, "text")
 
-End of document.
-"""
-    elif image_mode == ImageRefMode.PLACEHOLDER:
-        # 使用佔位符代替圖片
-        return f"""
-# Document {document_id}
-
-This is a sample document with placeholder image:
-
-<!-- image -->
-
-End of document.
-"""
-    else:  # ImageRefMode.REFERENCED
-        # 預設相對路徑引用
-        return f"""
-# Document {document_id}
+async def get_document_as_doctags(document_id: str) -> str:
+    """獲取文件的 DocTags 表示"""
+    print(f"[doclingservice] 獲取文件 DocTags 格式: {document_id}")
+    return await _render(document_id, "doctags")
 
-This is a sample document with referenced image:
-
-![Sample image](images/sample.png)
-
-End of document.
-""" 
\ No newline at end of file
+def stats() -> Dict[str, Any]:
+    with _cache_lock:
+        cached = len(_cache)
+    return {
+        "enabled": Config.DOCUMENT_STORE_ENABLED,
+        "format": Config.DOCUMENT_STORE_FORMAT,
+        "cached_documents": cached,
+        "cache_size": Config.DOCUMENT_CACHE_SIZE,
+        "cache_hits": _stats["hits"],
+        "cache_misses": _stats["misses"],
+        "saved": _stats["saved"],
+    }
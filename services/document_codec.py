@@ -0,0 +1,151 @@
+"""DoclingDocument 的精簡二進位儲存格式
+
+檔案結構:
+    MAGIC (8 bytes) | 標頭長度 (uint64, big-endian) | zlib 壓縮的 JSON 標頭 | 圖片原始位元組...
+
+標頭為 {"version", "document", "blobs"}：document 是 export_to_dict() 的結果，
+其中內嵌的 data URI 圖片被取出、以原始位元組 (不經 base64) 依序存放在標頭之後，
+原位置改為 "blob:<索引>"；blobs 記錄每張圖片的位移、長度、MIME 類型與在 document 中的位置。
+讀取時只解壓標頭，圖片區段以 mmap 存取：需要內嵌圖片時才還原為 data URI，
+以引用模式重新匯出時則直接將原始位元組寫入圖片目錄 (不經 base64)。
+"""
+import base64
+import json
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+MAGIC = b"DLDOCBN1"
+FORMAT_VERSION = 1
+_HEADER_LENGTH = struct.Struct(">Q")
+_BLOB_PREFIX = "blob:"
+
+def _extract_images(node: Any, path: List[Any], blobs: List[Dict[str, Any]], payloads: List[bytes]) -> None:
+    """遞迴尋找 ImageRef 的 data URI，取出為原始位元組並以 blob 參照取代"""
+    if isinstance(node, dict):
+        uri = node.get("uri")
+        if isinstance(uri, str) and uri.startswith("data:") and ";base64," in uri:
+            header, encoded = uri.split(",", 1)
+            try:
+                payload = base64.b64decode(encoded)
+            except ValueError:
+                payload = None
+            if payload is not None:
+                node["uri"] = f"{_BLOB_PREFIX}{len(blobs)}"
+                blobs.append({"mimetype": header[len("data:"):-len(";base64")], "length": len(payload), "path": path + ["uri"]})
+                payloads.append(payload)
+        for key, value in node.items():
+            if key != "uri":
+                _extract_images(value, path + [key], blobs, payloads)
+    elif isinstance(node, list):
+        for index, value in enumerate(node):
+            _extract_images(value, path + [index], blobs, payloads)
+
+def write_document(document_dict: Dict[str, Any], path: Union[str, Path], compression_level: int = 6) -> int:
+    """將 export_to_dict() 的結果寫為二進位格式 (會就地改寫傳入的字典)，返回寫入的位元組數"""
+    blobs: List[Dict[str, Any]] = []
+    payloads: List[bytes] = []
+    _extract_images(document_dict, [], blobs, payloads)
+    offset = 0
+    for blob in blobs:
+        blob["offset"] = offset
+        offset += blob["length"]
+
+    header = json.dumps(
+        {"version": FORMAT_VERSION, "document": document_dict, "blobs": blobs},
+        ensure_ascii=False, separators=(",", ":"),
+    ).encode("utf-8")
+    header = zlib.compress(header, compression_level)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        for payload in payloads:
+            f.write(payload)
+    return len(MAGIC) + _HEADER_LENGTH.size + len(header) + offset
+
+def is_binary_document(path: Union[str, Path]) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class BinaryDocument:
+    """以 mmap 開啟的二進位文件；圖片內容在需要時才讀取
+
+    blob() 返回指向 mmap 的 memoryview，使用完畢需先 release() 才能 close()。
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = open(self.path, "rb")
+        try:
+            if self._file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"不是二進位文件格式: {self.path}")
+            (header_length,) = _HEADER_LENGTH.unpack(self._file.read(_HEADER_LENGTH.size))
+            header = json.loads(zlib.decompress(self._file.read(header_length)).decode("utf-8"))
+            if header.get("version") != FORMAT_VERSION:
+                raise ValueError(f"不支援的二進位文件版本: {header.get('version')}")
+            self._data_offset = len(MAGIC) + _HEADER_LENGTH.size + header_length
+            self.document: Dict[str, Any] = header["document"]
+            self.blobs: List[Dict[str, Any]] = header["blobs"]
+            self._mmap: Optional[mmap.mmap] = None
+            if self.blobs and os.fstat(self._file.fileno()).st_size > self._data_offset:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+
+    def blob(self, index: int) -> memoryview:
+        """第 index 張圖片的原始位元組 (零複製)"""
+        info = self.blobs[index]
+        start = self._data_offset + info["offset"]
+        return memoryview(self._mmap)[start:start + info["length"]]
+
+    def to_dict(
+        self,
+        with_images: bool = True,
+        picture_uri: Optional[Callable[[memoryview, str], str]] = None,
+    ) -> Dict[str, Any]:
+        """還原為 export_to_dict() 格式的字典
+
+        with_images=False 時不讀取圖片區段，圖片欄位設為 None (純文字、DocTags 等不需要圖片的格式)。
+        提供 picture_uri 時，pictures 的圖片以 picture_uri(原始位元組, MIME 類型) 的返回值作為 URI
+        (例如寫入圖片目錄後的引用路徑)，其餘圖片 (頁面影像) 設為 None。
+        """
+        document = self.document
+        for index, info in enumerate(self.blobs):
+            *parents, image_key, _ = info["path"]
+            owner = document
+            for key in parents:
+                owner = owner[key]
+            if picture_uri is not None:
+                if parents and parents[0] == "pictures":
+                    with self.blob(index) as payload:
+                        owner[image_key]["uri"] = picture_uri(payload, info["mimetype"])
+                else:
+                    owner[image_key] = None
+            elif with_images:
+                with self.blob(index) as payload:
+                    owner[image_key]["uri"] = f"data:{info['mimetype']};base64,{base64.b64encode(payload).decode('ascii')}"
+            else:
+                owner[image_key] = None
+        return document
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self) -> "BinaryDocument":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def read_document(path: Union[str, Path], with_images: bool = True) -> Dict[str, Any]:
+    """讀取二進位文件，返回 export_to_dict() 格式的字典"""
+    with BinaryDocument(path) as document:
+        return document.to_dict(with_images=with_images)
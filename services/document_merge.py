@@ -0,0 +1,61 @@
+"""DoclingDocument 合併工具
+
+分頁平行轉換 (page sharding) 時，每個分片各自產生一份 DoclingDocument，
+這裡依頁序將它們合併回單一文件：各項目清單依序串接，並位移所有 JSON 參照 ($ref / self_ref)，
+頁面與 provenance 使用原始頁碼 (docling 以 page_range 轉換時保留絕對頁碼)，因此不需調整。
+"""
+import re
+from typing import Any, Dict, List
+
+from docling_core.types.doc import DoclingDocument
+
+# DoclingDocument 中以索引參照的項目清單
+_LIST_FIELDS = ("groups", "texts", "pictures", "tables", "key_value_items", "form_items")
+_REF_PATTERN = re.compile(r"^#/(" + "|".join(_LIST_FIELDS) + r")/(\d+)$")
+
+def _shift_ref(ref: str, offsets: Dict[str, int]) -> str:
+    match = _REF_PATTERN.match(ref)
+    if not match:
+        return ref  # 例如 "#/body"、"#/furniture"
+    field, index = match.group(1), int(match.group(2))
+    return f"#/{field}/{index + offsets[field]}"
+
+def _shift_refs(node: Any, offsets: Dict[str, int]) -> Any:
+    """遞迴位移節點中所有的 $ref 與 self_ref"""
+    if isinstance(node, dict):
+        shifted = {}
+        for key, value in node.items():
+            if key in ("$ref", "self_ref") and isinstance(value, str):
+                shifted[key] = _shift_ref(value, offsets)
+            else:
+                shifted[key] = _shift_refs(value, offsets)
+        return shifted
+    if isinstance(node, list):
+        return [_shift_refs(item, offsets) for item in node]
+    return node
+
+def merge_documents(documents: List[DoclingDocument]) -> DoclingDocument:
+    """依傳入順序 (即頁序) 合併多份 DoclingDocument"""
+    if not documents:
+        raise ValueError("沒有可合併的文件")
+    if len(documents) == 1:
+        return documents[0]
+
+    merged = documents[0].export_to_dict()
+    for field in _LIST_FIELDS:
+        merged.setdefault(field, [])
+
+    for document in documents[1:]:
+        data = document.export_to_dict()
+        offsets = {field: len(merged[field]) for field in _LIST_FIELDS}
+        data = _shift_refs(data, offsets)
+
+        for field in _LIST_FIELDS:
+            merged[field].extend(data.get(field, []))
+        # 最上層的 body / furniture 子節點依序接在後面
+        for root in ("body", "furniture"):
+            if root in data and root in merged:
+                merged[root].setdefault("children", []).extend(data[root].get("children", []))
+        merged.setdefault("pages", {}).update(data.get("pages", {}))
+
+    return DoclingDocument.model_validate(merged)
@@ -0,0 +1,323 @@
+"""URL 文件下載
+
+以串流方式將遠端檔案分塊寫入磁碟 (不會把整個檔案放在記憶體中)，同時計算 SHA-256：
+- 超過 `Config.DOWNLOAD_MAX_BYTES` 時立即中止 (Content-Length 已超過時不開始下載)
+- 連線逾時、區塊間的閒置逾時與整體期限分別設定
+- 連線中斷、逾時或 5xx 等暫時性錯誤時重試，伺服器支援時以 Range 從中斷處續傳
+- 檔案類型由內容的 magic bytes 判斷，標頭與 URL 副檔名只作為輔助
+
+所有下載共用同一個 HTTP 用戶端 (連線重用，安裝 h2 時啟用 HTTP/2)，
+並以每個主機的 semaphore 限制同時對同一主機進行的下載數。
+"""
+import asyncio
+import hashlib
+import importlib.util
+import os
+import tempfile
+import time
+import zipfile
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from config import Config
+
+# 可重試的 HTTP 狀態碼
+_RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# 檔頭讀取長度 (判斷類型用)
+_SNIFF_BYTES = 512
+
+class DownloadError(RuntimeError):
+    """下載失敗；status_code 為遠端回應的狀態碼 (連線錯誤時為 None)"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class DownloadTooLargeError(DownloadError):
+    """遠端檔案超過大小上限"""
+
+class DownloadedFile:
+    """下載完成的暫存檔案與其資訊"""
+
+    def __init__(
+        self,
+        path: Path,
+        size: int,
+        sha256: str,
+        content_type: str,
+        extension: str,
+        attempts: int,
+        resumed: bool,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256  # 檔案內容雜湊，可直接作為結果快取的輸入雜湊
+        self.content_type = content_type
+        self.extension = extension
+        self.attempts = attempts
+        self.resumed = resumed
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def to_dict(self) -> dict:
+        return {
+            "size": self.size,
+            "sha256": self.sha256,
+            "content_type": self.content_type,
+            "extension": self.extension,
+            "attempts": self.attempts,
+            "resumed": self.resumed,
+        }
+
+def _extension_from_content_type(content_type: str) -> Optional[str]:
+    content_type = content_type.lower()
+    if "pdf" in content_type: return ".pdf"
+    if "image/jpeg" in content_type or "image/jpg" in content_type: return ".jpg"
+    if "image/png" in content_type: return ".png"
+    if "html" in content_type: return ".html"
+    if "markdown" in content_type: return ".md"
+    if "csv" in content_type: return ".csv"
+    if "wordprocessingml" in content_type or "msword" in content_type: return ".docx"
+    if "presentationml" in content_type: return ".pptx"
+    if "spreadsheetml" in content_type: return ".xlsx"
+    return None
+
+def _zip_office_extension(path: Path) -> str:
+    """OOXML 文件都是 zip，依內部檔案判斷為 docx / pptx / xlsx"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            names = set(archive.namelist())
+    except zipfile.BadZipFile:
+        return ".bin"
+    if "word/document.xml" in names:
+        return ".docx"
+    if "ppt/presentation.xml" in names:
+        return ".pptx"
+    if "xl/workbook.xml" in names:
+        return ".xlsx"
+    return ".zip"
+
+def detect_extension(path: Path, content_type: str = "", url: str = "") -> str:
+    """依檔頭的 magic bytes 判斷副檔名；純文字內容再參考 URL 副檔名與 Content-Type"""
+    with open(path, "rb") as f:
+        head = f.read(_SNIFF_BYTES)
+
+    if head.startswith(b"%PDF-"):
+        return ".pdf"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return ".tiff"
+    if head.startswith(b"BM"):
+        return ".bmp"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return ".gif"
+    if head.startswith(b"PK\x03\x04"):
+        return _zip_office_extension(path)
+
+    # 純文字格式沒有 magic bytes：先看 URL 副檔名，再看 Content-Type，最後檢查是否為 HTML
+    url_extension = os.path.splitext(urlparse(url).path)[1].lower()
+    if url_extension in {".md", ".markdown", ".csv", ".adoc", ".asciidoc", ".html", ".htm", ".txt"}:
+        return url_extension
+    content_type_extension = _extension_from_content_type(content_type)
+    if content_type_extension in {".html", ".md", ".csv"}:
+        return content_type_extension
+    text = head.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if text.startswith((b"<!doctype html", b"<html")):
+        return ".html"
+    if "text" in content_type.lower():
+        return ".txt"
+    return url_extension or ".bin"
+
+def _write_chunk(f, digest, chunk: bytes) -> None:
+    f.write(chunk)
+    digest.update(chunk)
+
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+@asynccontextmanager
+async def host_slot(url: str):
+    """限制同一主機同時進行的下載數"""
+    host = (urlparse(url).hostname or "").lower()
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(max(1, Config.HTTP_MAX_CONNECTIONS_PER_HOST))
+    async with semaphore:
+        yield
+
+async def download_to_file(
+    client: httpx.AsyncClient,
+    url: str,
+    max_bytes: Optional[int] = None,
+    on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+    conditional_headers: Optional[Dict[str, str]] = None,
+) -> Optional[DownloadedFile]:
+    """串流下載 URL 至暫存檔，返回 DownloadedFile；失敗時刪除暫存檔並引發 DownloadError
+
+    on_progress(已下載位元組, 總位元組或 None) 於每個區塊寫入後呼叫。
+    conditional_headers (If-None-Match / If-Modified-Since) 只用於第一次請求；
+    遠端回應 304 Not Modified 時返回 None。
+    """
+    max_bytes = max_bytes or Config.DOWNLOAD_MAX_BYTES
+    deadline = time.monotonic() + Config.DOWNLOAD_TOTAL_TIMEOUT
+    fd, tmp_name = tempfile.mkstemp(suffix=".download")
+    tmp_path = Path(tmp_name)
+    digest = hashlib.sha256()
+    received = 0
+    total: Optional[int] = None
+    content_type = ""
+    validator: Optional[str] = None  # ETag / Last-Modified，續傳時確認遠端檔案未變更
+    attempts = 0
+    resumed = False
+    not_modified = False
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    last_error: Optional[Exception] = None
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while attempts <= Config.DOWNLOAD_MAX_RETRIES:
+                attempts += 1
+                if time.monotonic() >= deadline:
+                    raise DownloadError(f"下載超過 {Config.DOWNLOAD_TOTAL_TIMEOUT:g} 秒的期限")
+                headers = dict(conditional_headers) if conditional_headers and attempts == 1 else {}
+                if received and validator:
+                    headers["Range"] = f"bytes={received}-"
+                    headers["If-Range"] = validator
+                try:
+                    async with host_slot(url), client.stream("GET", url, headers=headers) as response:
+                        if response.status_code == 304 and conditional_headers and attempts == 1:
+                            print(f"[download_service] 遠端文件未變更 (304): {url}")
+                            not_modified = True
+                            break
+                        if response.status_code in _RETRY_STATUS:
+                            raise DownloadError(f"下載 URL 時伺服器錯誤: {response.status_code}", response.status_code)
+                        if response.status_code >= 400:
+                            # 其他 4xx 錯誤不重試
+                            attempts = Config.DOWNLOAD_MAX_RETRIES + 1
+                            raise DownloadError(f"下載 URL 時伺服器錯誤: {response.status_code}", response.status_code)
+
+                        if response.status_code == 206 and received:
+                            resumed = True
+                            print(f"[download_service] 從 {received} bytes 續傳: {url}")
+                        else:
+                            # 伺服器不支援 Range 或檔案已變更：從頭開始
+                            if received:
+                                print(f"[download_service] 無法續傳，重新下載: {url}")
+                            f.seek(0)
+                            f.truncate()
+                            digest = hashlib.sha256()
+                            received = 0
+                            content_type = response.headers.get("content-type", "")
+                            etag = response.headers.get("etag")
+                            last_modified = response.headers.get("last-modified")
+                            length = response.headers.get("content-length")
+                            total = int(length) if length and length.isdigit() else None
+                            if total is not None and total > max_bytes:
+                                raise DownloadTooLargeError(f"遠端檔案大小 {total} bytes 超過上限 {max_bytes} bytes", 413)
+                            if response.headers.get("accept-ranges", "").lower() == "bytes":
+                                validator = response.headers.get("etag") or response.headers.get("last-modified")
+                            else:
+                                validator = None
+
+                        chunks = response.aiter_bytes(Config.DOWNLOAD_CHUNK_SIZE)
+                        while True:
+                            idle_timeout = min(Config.DOWNLOAD_IDLE_TIMEOUT, max(0.0, deadline - time.monotonic()))
+                            try:
+                                chunk = await asyncio.wait_for(chunks.__anext__(), idle_timeout)
+                            except StopAsyncIteration:
+                                break
+                            except asyncio.TimeoutError:
+                                raise DownloadError(f"超過 {idle_timeout:g} 秒沒有收到資料")
+                            if received + len(chunk) > max_bytes:
+                                raise DownloadTooLargeError(f"下載內容超過上限 {max_bytes} bytes", 413)
+                            await asyncio.to_thread(_write_chunk, f, digest, chunk)
+                            received += len(chunk)
+                            if on_progress is not None:
+                                on_progress(received, total)
+
+                    if total is not None and received < total:
+                        raise DownloadError(f"連線提前結束 ({received}/{total} bytes)")
+                    break
+                except DownloadTooLargeError:
+                    raise
+                except (DownloadError, httpx.TransportError) as e:
+                    last_error = e
+                    if attempts > Config.DOWNLOAD_MAX_RETRIES:
+                        raise
+                    delay = min(2 ** (attempts - 1), 10)
+                    print(f"[download_service] 下載失敗 (第 {attempts} 次)，{delay} 秒後重試: {url} - {e}")
+                    await asyncio.sleep(delay)
+            else:
+                raise DownloadError(f"下載失敗: {last_error}")
+
+        if not_modified:
+            tmp_path.unlink(missing_ok=True)
+            return None
+
+        extension = detect_extension(tmp_path, content_type, url)
+        final_path = tmp_path.with_suffix(extension)
+        os.replace(tmp_path, final_path)
+        print(f"[download_service] 已下載 {received} bytes ({extension}) 至 {final_path}: {url}")
+        return DownloadedFile(
+            final_path, received, digest.hexdigest(), content_type, extension, attempts, resumed,
+            etag=etag, last_modified=last_modified,
+        )
+    except httpx.TransportError as e:
+        tmp_path.unlink(missing_ok=True)
+        raise DownloadError(f"無法下載 URL: {e}") from e
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+_client: Optional[httpx.AsyncClient] = None
+
+def http2_available() -> bool:
+    return Config.HTTP2_ENABLED and importlib.util.find_spec("h2") is not None
+
+def create_client() -> httpx.AsyncClient:
+    """建立下載用的 HTTP 用戶端 (連線逾時與讀取閒置逾時分開設定)"""
+    timeout = httpx.Timeout(
+        connect=Config.DOWNLOAD_CONNECT_TIMEOUT,
+        read=Config.DOWNLOAD_IDLE_TIMEOUT,
+        write=Config.DOWNLOAD_IDLE_TIMEOUT,
+        pool=Config.DOWNLOAD_CONNECT_TIMEOUT,
+    )
+    limits = httpx.Limits(
+        max_connections=Config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=Config.HTTP_MAX_CONNECTIONS,
+        keepalive_expiry=Config.HTTP_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(follow_redirects=True, timeout=timeout, limits=limits, http2=http2_available())
+
+def get_client() -> httpx.AsyncClient:
+    """取得全域共用的 HTTP 用戶端 (第一次使用時建立)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    return _client
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def stats() -> Dict[str, object]:
+    return {
+        "http2": http2_available(),
+        "max_connections": Config.HTTP_MAX_CONNECTIONS,
+        "max_connections_per_host": Config.HTTP_MAX_CONNECTIONS_PER_HOST,
+        "hosts": len(_host_semaphores),
+        "client_open": _client is not None and not _client.is_closed,
+    }
@@ -1,19 +1,18 @@
+import asyncio
 import json
 import yaml
-import shutil
 import uuid
 import time
 import os
 from pathlib import Path
-from typing import Optional, Dict
-from fastapi import UploadFile
+from typing import Optional, Dict, Iterable, List, Union
 import re
 
 # 從其他服務或 utils 匯入
 from services.image_service import process_markdown_images, process_html_images
 from docling_core.types.doc import ImageRefMode
 from services import image_service, doclingservice
-from config import UPLOADS_DIR, OUTPUT_DIR, Config
+from config import OUTPUT_DIR, Config
 
 # 新增檔名清理函數
 def sanitize_filename(filename: str, max_length: int = 200) -> str:
@@ -51,18 +50,6 @@ def sanitize_filename(filename: str, max_length: int = 200) -> str:
 
     return sanitized
 
-def save_uploaded_file(file: UploadFile) -> Path:
-    """儲存上傳的檔案到 uploads 目錄"""
-    try:
-        file_path = UPLOADS_DIR / file.filename
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        print(f"檔案已儲存至: {file_path}")
-        return file_path
-    except Exception as e:
-        print(f"儲存上傳檔案時發生錯誤: {e}")
-        raise # 重新引發錯誤，讓上層處理
-
 def get_file_extension(format: str) -> str:
     """根據格式獲取檔案副檔名"""
     if format == "markdown":
@@ -89,6 +76,11 @@ def determine_output_path(original_filename: str, format: str, output_filename:
     print(f"輸出檔案路徑設定為: {output_path}")
     return output_path
 
+def sanitized_output_path(output_path: Path) -> Path:
+    """返回 export_document 實際寫入的路徑 (檔名經過 sanitize_filename 清理)"""
+    output_path = Path(output_path)
+    return output_path.parent / sanitize_filename(output_path.name)
+
 def save_metadata(output_path: Path, source_identifier: str, format: str, image_export_mode: str) -> None:
     """儲存轉換的元數據"""
     meta_path = output_path.with_suffix('.meta.json')
@@ -108,6 +100,113 @@ def save_metadata(output_path: Path, source_identifier: str, format: str, image_
 # 用於從 UUID 中截取短識別符
 UUID_SHORT_PATTERN = re.compile(r"^(.{8})[0-9a-f-]+$")
 
+# export_document 支援的匯出格式 -> (返回的 paths/content 鍵, 副檔名)
+EXPORT_FORMATS = {
+    "json": ("json", ".json"),
+    "html": ("html", ".html"),
+    "html-single": ("html", ".html"),
+    "markdown": ("markdown", ".md"),
+    "yaml": ("yaml", ".yaml"),
+    "text": ("text", ".txt"),
+    "doctags": ("doctags", ".doctags"),
+}
+# 內容含有圖片、referenced 模式下需要把內嵌圖片轉為引用的格式
+_IMAGE_FORMATS = {"html", "html-single", "markdown"}
+
+def normalize_formats(format: Union[str, Iterable[str], None]) -> List[str]:
+    """將單一格式、逗號分隔的字串或格式列表整理為不重複的格式列表 (保留順序)"""
+    if format is None:
+        return []
+    items = format.split(",") if isinstance(format, str) else [f for item in format for f in str(item).split(",")]
+    formats = []
+    for item in items:
+        item = item.strip()
+        if item and item not in formats:
+            formats.append(item)
+    return formats
+
+def format_output_paths(output_path: Path, formats: List[str]) -> Dict[str, Path]:
+    """多格式匯出時各格式的輸出路徑：共用 output_path 的主檔名，只替換副檔名"""
+    output_path = Path(output_path)
+    if len(formats) == 1:
+        return {formats[0]: output_path}
+    return {fmt: output_path.parent / f"{output_path.stem}{get_file_extension(fmt)}" for fmt in formats}
+
+def _resolve_export_path(export_format: str, out_path, output_dir: Path, file_basename: str, multiple: bool) -> Path:
+    """決定單一格式的輸出路徑 (檔名經過 sanitize_filename 清理並補上副檔名)"""
+    extension = EXPORT_FORMATS[export_format][1]
+    if not out_path:
+        # 使用已清理的 file_basename
+        return output_dir / f"{file_basename}{extension}"
+    original_path = Path(out_path)
+    # 多格式時共用 out_path 的主檔名，各格式使用自己的副檔名
+    name = f"{original_path.stem}{extension}" if multiple else original_path.name
+    sanitized_name = sanitize_filename(name)
+    # 如果清理後名稱不含副檔名，補上
+    if not sanitized_name.endswith(extension):
+        sanitized_name += extension
+    return original_path.parent / sanitized_name
+
+def _render_from_document(docling_document, export_format: str, image_mode: ImageRefMode = ImageRefMode.EMBEDDED):
+    """從 DoclingDocument 產生單一格式的內容 (預設圖片以 EMBEDDED 模式內嵌)"""
+    return doclingservice.render_document(docling_document, export_format, image_mode)
+
+async def _render_from_document_id(document_id: str, export_format: str):
+    """從文件儲存中以文件 ID 取得單一格式的內容 (圖片一律以 EMBEDDED 模式內嵌)"""
+    if export_format == "json":
+        return await doclingservice.get_document_as_json(document_id)
+    if export_format in ["html", "html-single"]:
+        return await doclingservice.get_document_as_html(
+            document_id, ImageRefMode.EMBEDDED, single_file=export_format == "html-single"
+        )
+    if export_format == "markdown":
+        return await doclingservice.get_document_as_markdown(document_id, ImageRefMode.EMBEDDED)
+    if export_format == "yaml":
+        return await doclingservice.get_document_as_yaml(document_id)
+    if export_format == "text":
+        return await doclingservice.get_document_as_text(document_id)
+    return await doclingservice.get_document_as_doctags(document_id)
+
+def _finish_export(export_format: str, content, output_path: Path, process_params: dict, in_memory: bool, process_images: bool = True):
+    """將嵌入圖片轉為引用 (referenced 模式)，寫入檔案或返回記憶體中的內容
+
+    process_images=False 表示內容的圖片連結已是最終結果 (由文件直接寫出圖片)，不再處理。
+    """
+    if export_format == "json":
+        if in_memory:
+            return content if isinstance(content, str) else json.dumps(content, ensure_ascii=False, indent=2)
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(content, f, ensure_ascii=False, indent=2)
+        return None
+
+    # 如果需要引用模式，處理嵌入式圖片，將它們轉換為引用
+    if process_images and export_format in _IMAGE_FORMATS and process_params["image_export_mode"] == "referenced":
+        process_images = process_html_images if export_format in ["html", "html-single"] else process_markdown_images
+        content = process_images(content, **process_params)
+
+    # 如果是記憶體模式，直接返回內容
+    if in_memory:
+        return content
+
+    # 寫入檔案
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return None
+
+def _export_from_document(docling_document, export_format: str, output_path: Path, process_params: dict, in_memory: bool, referenced_document=None):
+    """從 DoclingDocument 匯出單一格式
+
+    referenced_document 為圖片已寫入圖片目錄的文件副本 (image_service.save_document_pictures)，
+    含圖片的格式直接以 REFERENCED 模式產生最終連結，不需再掃描與解碼內嵌的 base64 圖片。
+    """
+    if referenced_document is not None and export_format in _IMAGE_FORMATS:
+        content = _render_from_document(referenced_document, export_format, ImageRefMode.REFERENCED)
+        if "data:image/" not in content:
+            return _finish_export(export_format, content, output_path, process_params, in_memory, process_images=False)
+        # 仍有無法直接寫出的內嵌圖片時，改用原本的字串處理
+        print(f"[export_document] {export_format} 內容仍含內嵌圖片，改以字串處理轉為引用")
+    return _finish_export(export_format, _render_from_document(docling_document, export_format), output_path, process_params, in_memory)
+
 async def export_document(
     result=None,
     document_id=None,
@@ -127,20 +226,27 @@ async def export_document(
     
     參數:
         result: 轉換結果 (DoclingConversionResult 物件)
-        document_id: 文件 ID (如果不使用 result 參數)
-        export_format/format: 匯出格式，可為 'html', 'html-single', 'markdown' 或 'json'
+        document_id: 文件 ID (如果不使用 result 參數)，從 doclingservice 的文件儲存載入已保存的 DoclingDocument
+        export_format/format: 匯出格式，可為 'html', 'html-single', 'markdown', 'json', 'yaml', 'text' 或 'doctags'；
+            也可以是格式列表 (或逗號分隔的字串)，所有格式都從同一份文件匯出，
+            result 模式下各格式在執行緒中並行產生，嵌入的圖片只擷取一次並由各格式共用
         image_export_mode: 圖片處理模式，可為 'embedded' (內嵌), 'referenced' (引用) 或 'placeholder' (佔位符)
         out_dir_path: 輸出目錄路徑，如果為 None，則使用設定中的默認路徑
-        out_path/output_path: 輸出檔案完整路徑，如果提供，會覆蓋 out_dir_path
+        out_path/output_path: 輸出檔案完整路徑，如果提供，會覆蓋 out_dir_path；
+            多格式時各格式共用其主檔名並使用各自的副檔名
         task_id: 任務 ID (如果使用 result 參數)
         in_memory: 是否返回記憶體中的內容而非寫入檔案
     
     返回:
-        包含輸出路徑和可選的內容的字典
+        包含輸出路徑和可選的內容的字典，鍵為格式名稱 ('html-single' 的鍵為 'html')
     """
     # 處理向後兼容
     if format is not None and export_format is None:
         export_format = format
+    formats = [fmt for fmt in normalize_formats(export_format) if fmt in EXPORT_FORMATS]
+    if not formats:
+        print(f"[export_document] 沒有可匯出的格式: {export_format}")
+        return {"paths": {}}
     
     if result is not None:
         print(f"[export_document] 使用 conversion_result 物件：{type(result)}")
@@ -189,9 +295,8 @@ async def export_document(
     output_dir.mkdir(parents=True, exist_ok=True)
     
     # 處理圖片匯出模式
-    # 注意：為了處理 docling 中產生的嵌入式圖片，我們改用下面的方法：
-    # 1. 先以 EMBEDDED 模式獲取內容
-    # 2. 如果要求的是 REFERENCED 模式，再將嵌入圖片轉為引用方式
+    # REFERENCED 模式下，含圖片的格式 (Markdown、HTML) 先將 DoclingDocument 的圖片直接寫入圖片目錄，
+    # 再以圖片改為引用路徑的文件副本匯出；其他模式與格式以 EMBEDDED 模式取得內容
     
     # 檢查 image_export_mode 是否有效
     valid_modes = {"embedded", "referenced", "placeholder"}
@@ -201,218 +306,62 @@ async def export_document(
     else:
         image_export_mode = image_export_mode.lower()
     
-    print(f"[export_document] Using image export mode: {image_export_mode}")
+    print(f"[export_document] Using image export mode: {image_export_mode}, formats: {formats}")
     
-    # 始終使用 EMBEDDED 模式從 docling 獲取內容
-    docling_image_mode = ImageRefMode.EMBEDDED
-    print(f"[export_document] Requesting content from docling with mode: {docling_image_mode}")
-    
-    # 創建共享的參數字典
+    # 創建共享的參數字典；各格式共用同一個圖片目錄與圖片擷取結果
+    image_cache = image_service.SharedImageCache()
     process_params = {
         "task_id": task_id,
         "image_export_mode": image_export_mode,
         "output_base_name": Path(out_path).stem if out_path else file_basename,
-        "output_dir_path": output_dir
+        "image_cache": image_cache,
     }
-    
-    # --- 對於 result 模式 ---
-    if result is not None:
-        # JSON 格式不處理圖片
-        if export_format == "json":
-            extension = ".json"
-            if out_path:
-                original_path = Path(out_path)
-                sanitized_name = sanitize_filename(original_path.name)
-                # 如果清理後名稱不含副檔名，補上
-                if not sanitized_name.endswith(extension):
-                     sanitized_name += extension
-                output_path = original_path.parent / sanitized_name
-            else:
-                # 使用已清理的 file_basename
-                output_path = output_dir / f"{file_basename}{extension}"
-            
-            # 直接從 result.document 獲取 JSON
-            json_data = result.document.export_to_dict()
-            
-            if in_memory:
-                output_content["json"] = json.dumps(json_data, ensure_ascii=False, indent=2)
-                output_paths["json"] = str(output_path)
-                return {"paths": output_paths, "content": output_content}
-            
-            with open(output_path, "w", encoding="utf-8") as f:
-                json.dump(json_data, f, ensure_ascii=False, indent=2)
-            
-            return {"paths": {"json": str(output_path)}}
-        
-        # 處理 HTML 匯出
-        if export_format in ["html", "html-single"]:
-            extension = ".html"
-            if out_path:
-                original_path = Path(out_path)
-                sanitized_name = sanitize_filename(original_path.name)
-                if not sanitized_name.endswith(extension):
-                     sanitized_name += extension
-                output_path = original_path.parent / sanitized_name
-            else:
-                # 使用已清理的 file_basename
-                output_path = output_dir / f"{file_basename}{extension}"
-            
-            # 獲取 HTML，以 EMBEDDED 模式
-            html_content = result.document.export_to_html(image_mode=docling_image_mode)
-            
-            # 如果需要引用模式，處理圖片並更新內容
-            if image_export_mode == "referenced":
-                # 處理嵌入式圖片，將它們轉換為引用
-                html_content = process_html_images(
-                    html_content, **process_params
-                )
-            
-            # 如果是記憶體模式，直接返回內容
-            if in_memory:
-                output_content["html"] = html_content
-                output_paths["html"] = str(output_path)
-                return {"paths": output_paths, "content": output_content}
-            
-            # 寫入檔案
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(html_content)
-            
-            output_paths["html"] = str(output_path)
-        
-        # 處理 Markdown 匯出
-        if export_format == "markdown":
-            extension = ".md"
-            if out_path:
-                original_path = Path(out_path)
-                sanitized_name = sanitize_filename(original_path.name)
-                if not sanitized_name.endswith(extension):
-                     sanitized_name += extension
-                output_path = original_path.parent / sanitized_name
-            else:
-                # 使用已清理的 file_basename
-                output_path = output_dir / f"{file_basename}{extension}"
-            
-            # 獲取 Markdown，以 EMBEDDED 模式
-            markdown_content = result.document.export_to_markdown(image_mode=docling_image_mode)
-            
-            # 如果需要引用模式，處理圖片並更新內容
-            if image_export_mode == "referenced":
-                # 處理嵌入式圖片，將它們轉換為引用
-                markdown_content = process_markdown_images(
-                    markdown_content, **process_params
-                )
-            
-            # 如果是記憶體模式，直接返回內容
-            if in_memory:
-                output_content["markdown"] = markdown_content
-                output_paths["markdown"] = str(output_path)
-                return {"paths": output_paths, "content": output_content}
-            
-            # 寫入檔案
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(markdown_content)
-            
-            output_paths["markdown"] = str(output_path)
-        
-        return {"paths": output_paths}
-    
-    # --- 對於 document_id 模式 ---
-    else:
-        # JSON 格式不處理圖片
-        if export_format == "json":
-            extension = ".json"
-            if out_path:
-                original_path = Path(out_path)
-                sanitized_name = sanitize_filename(original_path.name)
-                if not sanitized_name.endswith(extension):
-                     sanitized_name += extension
-                output_path = original_path.parent / sanitized_name
-            else:
-                # 使用已清理的 file_basename
-                output_path = output_dir / f"{file_basename}{extension}"
-
-            document_json = await doclingservice.get_document_as_json(document_id)
-            
-            if in_memory:
-                output_content["json"] = document_json
-                output_paths["json"] = str(output_path)
-                return {"paths": output_paths, "content": output_content}
-            
-            with open(output_path, "w", encoding="utf-8") as f:
-                json.dump(document_json, f, ensure_ascii=False, indent=2)
-            
-            return {"paths": {"json": str(output_path)}}
-        
-        # 處理 HTML 匯出
-        if export_format in ["html", "html-single"]:
-            extension = ".html"
-            if out_path:
-                original_path = Path(out_path)
-                sanitized_name = sanitize_filename(original_path.name)
-                if not sanitized_name.endswith(extension):
-                     sanitized_name += extension
-                output_path = original_path.parent / sanitized_name
-            else:
-                # 使用已清理的 file_basename
-                output_path = output_dir / f"{file_basename}{extension}"
 
-            # 從 docling 獲取 HTML 內容，使用 EMBEDDED 模式
-            html_content = await doclingservice.get_document_as_html(
-                document_id, docling_image_mode, single_file=export_format == "html-single"
+    multiple = len(formats) > 1
+    targets = {fmt: _resolve_export_path(fmt, out_path, output_dir, file_basename, multiple) for fmt in formats}
+    # 圖片只寫入一次，各含圖片的格式共用同一份引用路徑的文件副本
+    referenced_document = None
+    if image_export_mode == "referenced" and any(fmt in _IMAGE_FORMATS for fmt in formats):
+        if result is None:
+            # 二進位格式保存的文件：圖片位元組直接寫入圖片目錄，不還原為 base64
+            referenced_document = await asyncio.to_thread(
+                image_service.save_stored_document_pictures, document_id, task_id, process_params["output_base_name"]
             )
-            
-            # 如果需要引用模式，處理圖片並更新內容
-            if image_export_mode == "referenced":
-                # 處理嵌入式圖片，將它們轉換為引用
-                html_content = process_html_images(
-                    html_content, **process_params
-                )
-            
-            # 如果是記憶體模式，直接返回內容
-            if in_memory:
-                output_content["html"] = html_content
-                output_paths["html"] = str(output_path)
-                return {"paths": output_paths, "content": output_content}
-            
-            # 寫入檔案
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(html_content)
-            
-            output_paths["html"] = str(output_path)
-        
-        # 處理 Markdown 匯出
-        if export_format == "markdown":
-            extension = ".md"
-            if out_path:
-                original_path = Path(out_path)
-                sanitized_name = sanitize_filename(original_path.name)
-                if not sanitized_name.endswith(extension):
-                     sanitized_name += extension
-                output_path = original_path.parent / sanitized_name
+            if referenced_document is not None:
+                docling_document = referenced_document
             else:
-                # 使用已清理的 file_basename
-                output_path = output_dir / f"{file_basename}{extension}"
-
-            # 從 docling 獲取 Markdown 內容，使用 EMBEDDED 模式
-            markdown_content = await doclingservice.get_document_as_markdown(document_id, docling_image_mode)
-            
-            # 如果需要引用模式，處理圖片並更新內容
-            if image_export_mode == "referenced":
-                # 處理嵌入式圖片，將它們轉換為引用
-                markdown_content = process_markdown_images(
-                    markdown_content, **process_params
-                )
-            
-            # 如果是記憶體模式，直接返回內容
-            if in_memory:
-                output_content["markdown"] = markdown_content
-                output_paths["markdown"] = str(output_path)
-                return {"paths": output_paths, "content": output_content}
-            
-            # 寫入檔案
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(markdown_content)
-            
-            output_paths["markdown"] = str(output_path)
-        
-        return {"paths": output_paths}
+                docling_document = await asyncio.to_thread(doclingservice.load_document, document_id)
+        if referenced_document is None:
+            referenced_document = await asyncio.to_thread(
+                image_service.save_document_pictures, docling_document, task_id, process_params["output_base_name"]
+            )
+
+    if result is not None:
+        # 同一份 DoclingDocument 的各格式在執行緒中 (並行) 匯出，產生內容與寫檔不佔用事件迴圈
+        contents = await asyncio.gather(*(
+            asyncio.to_thread(_export_from_document, docling_document, fmt, targets[fmt], process_params, in_memory, referenced_document)
+            for fmt in formats
+        ))
+    else:
+        contents = []
+        for fmt in formats:
+            if referenced_document is not None and fmt in _IMAGE_FORMATS:
+                contents.append(await asyncio.to_thread(
+                    _export_from_document, docling_document, fmt, targets[fmt], process_params, in_memory, referenced_document
+                ))
+                continue
+            content = await _render_from_document_id(document_id, fmt)
+            contents.append(await asyncio.to_thread(_finish_export, fmt, content, targets[fmt], process_params, in_memory))
+
+    for fmt, content in zip(formats, contents):
+        key = EXPORT_FORMATS[fmt][0]
+        output_paths[key] = str(targets[fmt])
+        if in_memory:
+            output_content[key] = content
+    
+    if multiple and image_cache.reused:
+        print(f"[export_document] 圖片擷取共用: 寫入 {image_cache.saved} 張，各格式共重複使用 {image_cache.reused} 次")
+    
+    if in_memory:
+        return {"paths": output_paths, "content": output_content}
+    return {"paths": output_paths}
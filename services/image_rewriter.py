@@ -0,0 +1,228 @@
+"""Markdown / HTML 圖片引用的單次掃描改寫引擎
+
+以一次線性掃描找出內容中所有的圖片引用，並在輸出時直接改寫：
+    - data URI 內嵌圖片 (`![alt](data:image/png;base64,...)`、`<img src="data:image/...">`)
+    - 相對路徑圖片 (`![alt](images/a.png)`、`<img src="images/a.png">`，不含 http(s)、data: 與 / 開頭的路徑)
+    - docling 的圖片佔位註解 `<!-- image -->`
+
+取代原本對整份內容執行多個正規表示式 (其中 `<img[^>]*?src=...[^>]*?alt=...` 在數 MB 的 base64 屬性上大量回溯)
+的做法。掃描只以字面字串搜尋定位，每個搜尋結果都會被記住，內容中的每個位置最多被檢查常數次，
+因此耗時與內容長度成線性關係；輸出以片段串列組合，未改寫的部分 (包括未處理的 base64) 不會被複製。
+
+本模組只依賴標準函式庫 (不匯入 docling 或 config)，可獨立測試與量測效能 (見 benchmarks/image_rewriter_bench.py)。
+"""
+import re
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+PLACEHOLDER = "<!-- image -->"
+
+KIND_DATA = "data"
+KIND_PATH = "path"
+KIND_PLACEHOLDER = "placeholder"
+
+# HTML 屬性：名稱 [= "值" | '值' | 無引號值]；各分支都不會回溯
+_HTML_ATTRIBUTE = re.compile(r"""\s*([^\s=>/"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?""")
+_SKIPPED_PREFIXES = ("http:", "https:", "/")
+
+class ImageReference:
+    """掃描到的一個圖片引用
+
+    kind 為 "data"、"path" 或 "placeholder"；src 與 base64 內容以位移記錄，需要時才切出字串。
+    """
+
+    __slots__ = ("kind", "alt", "_content", "_src_start", "_src_end", "_data_start", "mimetype", "start", "end")
+
+    def __init__(self, kind: str, content: str, start: int, end: int, alt: Optional[str] = None,
+                 src_start: int = -1, src_end: int = -1, data_start: int = -1, mimetype: Optional[str] = None):
+        self.kind = kind
+        self.alt = alt
+        self._content = content
+        self._src_start = src_start
+        self._src_end = src_end
+        self._data_start = data_start
+        self.mimetype = mimetype
+        self.start = start  # 整個引用 (Markdown 語法、<img> 標籤或註解) 在內容中的範圍
+        self.end = end
+
+    @property
+    def src(self) -> Optional[str]:
+        if self._src_start < 0:
+            return None
+        return self._content[self._src_start:self._src_end]
+
+    @property
+    def image_type(self) -> Optional[str]:
+        """data URI 的圖片類型 (例如 "png")"""
+        return self.mimetype.split("/", 1)[-1] if self.mimetype else None
+
+    @property
+    def base64_data(self) -> Optional[str]:
+        """data URI 中的 base64 內容"""
+        if self._data_start < 0:
+            return None
+        return self._content[self._data_start:self._src_end]
+
+    @property
+    def data_length(self) -> int:
+        return self._src_end - self._data_start if self._data_start >= 0 else 0
+
+    @property
+    def text(self) -> str:
+        return self._content[self.start:self.end]
+
+class _Finder:
+    """記住每個字串最近一次的搜尋結果，重複搜尋時不會重新掃描同一段內容"""
+
+    def __init__(self, content: str):
+        self.content = content
+        self._last: Dict[str, Tuple[int, int]] = {}  # 字串 -> (搜尋起點, 結果)
+
+    def find(self, needle: str, pos: int) -> int:
+        cached = self._last.get(needle)
+        if cached is not None:
+            searched_from, found = cached
+            # 從更早的位置搜尋的結果，在 [searched_from, found] 之間的起點都仍然正確
+            if searched_from <= pos and (found == -1 or found >= pos):
+                return found
+        found = self.content.find(needle, pos)
+        self._last[needle] = (pos, found)
+        return found
+
+def _data_uri_parts(content: str, src_start: int, src_end: int) -> Tuple[int, Optional[str]]:
+    """src 為 data:image/...;base64, 時返回 (base64 起點, MIME 類型)，否則返回 (-1, None)"""
+    if not content.startswith("data:image/", src_start, src_end):
+        return -1, None
+    # MIME 類型很短，只在 src 開頭的有限範圍內尋找
+    marker = content.find(";base64,", src_start, min(src_end, src_start + 128))
+    if marker < 0:
+        return -1, None
+    return marker + len(";base64,"), content[src_start + len("data:"):marker]
+
+def _classify(content: str, src_start: int, src_end: int) -> Tuple[Optional[str], int, Optional[str]]:
+    data_start, mimetype = _data_uri_parts(content, src_start, src_end)
+    if data_start >= 0:
+        return KIND_DATA, data_start, mimetype
+    if src_end <= src_start or content.startswith("data:", src_start, src_end):
+        return None, -1, None
+    if any(content.startswith(prefix, src_start, src_end) for prefix in _SKIPPED_PREFIXES):
+        return None, -1, None
+    return KIND_PATH, -1, None
+
+def _next_anchor(finder: _Finder, opener: str, pos: int) -> Tuple[int, bool]:
+    """下一個引用起點與是否為佔位註解；沒有時返回 (-1, False)"""
+    image_at = finder.find(opener, pos)
+    placeholder_at = finder.find(PLACEHOLDER, pos)
+    if placeholder_at >= 0 and (image_at < 0 or placeholder_at < image_at):
+        return placeholder_at, True
+    return image_at, False
+
+def scan_markdown(content: str) -> Iterator[ImageReference]:
+    """依序產出 Markdown 內容中的圖片引用 (`![alt](src)` 與 `<!-- image -->`)"""
+    finder = _Finder(content)
+    pos = 0
+    while True:
+        start, is_placeholder = _next_anchor(finder, "![", pos)
+        if start < 0:
+            return
+        if is_placeholder:
+            end = start + len(PLACEHOLDER)
+            yield ImageReference(KIND_PLACEHOLDER, content, start, end)
+            pos = end
+            continue
+        # 替代文字不跨行，且在第一個 "](" 結束
+        alt_end = finder.find("](", start + 2)
+        newline = finder.find("\n", start + 2)
+        if alt_end < 0 or (0 <= newline < alt_end):
+            pos = start + 2
+            continue
+        src_start = alt_end + 2
+        src_end = finder.find(")", src_start)
+        if src_end < 0:
+            return
+        kind, data_start, mimetype = _classify(content, src_start, src_end)
+        if kind is None:
+            pos = src_end + 1
+            continue
+        yield ImageReference(kind, content, start, src_end + 1, alt=content[start + 2:alt_end],
+                             src_start=src_start, src_end=src_end, data_start=data_start, mimetype=mimetype)
+        pos = src_end + 1
+
+def _parse_attributes(content: str, pos: int, tag_end: int) -> Dict[str, Tuple[int, int]]:
+    """解析 <img> 標籤的屬性，返回 名稱 -> (值起點, 值終點)；沒有值的屬性不記錄"""
+    attributes: Dict[str, Tuple[int, int]] = {}
+    while pos < tag_end:
+        match = _HTML_ATTRIBUTE.match(content, pos, tag_end)
+        if match is None or match.end() == pos:
+            pos += 1
+            continue
+        for group in (2, 3, 4):
+            if match.start(group) >= 0:
+                attributes.setdefault(match.group(1).lower(), (match.start(group), match.end(group)))
+                break
+        pos = match.end()
+    return attributes
+
+def scan_html(content: str) -> Iterator[ImageReference]:
+    """依序產出 HTML 內容中的圖片引用 (`<img src=...>` 與 `<!-- image -->`)"""
+    finder = _Finder(content)
+    pos = 0
+    while True:
+        start, is_placeholder = _next_anchor(finder, "<img", pos)
+        if start < 0:
+            return
+        if is_placeholder:
+            end = start + len(PLACEHOLDER)
+            yield ImageReference(KIND_PLACEHOLDER, content, start, end)
+            pos = end
+            continue
+        name_end = start + len("<img")
+        if name_end < len(content) and not (content[name_end].isspace() or content[name_end] in "/>"):
+            pos = name_end  # 例如 <imgx>
+            continue
+        tag_end = finder.find(">", name_end)
+        if tag_end < 0:
+            return
+        attributes = _parse_attributes(content, name_end, tag_end)
+        src = attributes.get("src")
+        kind, data_start, mimetype = _classify(content, *src) if src else (None, -1, None)
+        if kind is None:
+            pos = tag_end + 1
+            continue
+        alt = content[slice(*attributes["alt"])] if "alt" in attributes else None
+        yield ImageReference(kind, content, start, tag_end + 1, alt=alt,
+                             src_start=src[0], src_end=src[1], data_start=data_start, mimetype=mimetype)
+        pos = tag_end + 1
+
+def rewrite(
+    content: str,
+    references: Iterator[ImageReference],
+    replace: Callable[[ImageReference], Optional[str]],
+    counts: Optional[Dict[str, int]] = None,
+) -> str:
+    """以 replace 的返回值取代每個引用 (返回 None 時保留原文)，單次組合輸出
+
+    counts 提供時記錄各類引用的數量 ("data"、"path"、"placeholder") 與已改寫的數量 ("replaced")。
+    """
+    pieces: List[str] = []
+    pos = 0
+    for reference in references:
+        if counts is not None:
+            counts[reference.kind] = counts.get(reference.kind, 0) + 1
+        replacement = replace(reference)
+        if replacement is None:
+            continue
+        pieces.append(content[pos:reference.start])
+        pieces.append(replacement)
+        pos = reference.end
+        if counts is not None:
+            counts["replaced"] = counts.get("replaced", 0) + 1
+    if not pieces:
+        return content
+    pieces.append(content[pos:])
+    return "".join(pieces)
+
+def rewrite_markdown(content: str, replace: Callable[[ImageReference], Optional[str]], counts: Optional[Dict[str, int]] = None) -> str:
+    return rewrite(content, scan_markdown(content), replace, counts)
+
+def rewrite_html(content: str, replace: Callable[[ImageReference], Optional[str]], counts: Optional[Dict[str, int]] = None) -> str:
+    return rewrite(content, scan_html(content), replace, counts)
@@ -1,301 +1,390 @@
-import re
+import asyncio
 import base64
 import uuid
 import shutil # Import shutil for moving files
 from pathlib import Path
 import os
 import glob
+import hashlib
+import io
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from urllib.parse import quote # 導入 quote 函數
 
-from config import IMAGES_DIR # Destination base directory
+from config import IMAGES_DIR, Config # Destination base directory
+from services import doclingservice, image_rewriter, image_store
 
-def process_markdown_images(content: str, task_id: str, image_export_mode: str, output_base_name: str, output_dir_path: Path) -> str:
-    """處理 Markdown 中的圖片，根據指定的匯出模式處理圖片
-    
-    參數:
-        content: Markdown 內容
-        task_id: 任務 ID，用於生成唯一檔名
-        image_export_mode: 圖片處理模式，可為 'embedded' (內嵌), 'referenced' (引用) 或 'placeholder' (佔位符)
-        output_base_name: 輸出檔案的基本名稱，用於建立圖片子目錄
-        output_dir_path: The directory where the main output file (and potentially docling's image dir) is saved.
+class SharedImageCache:
+    """同一份文件的多個匯出格式 (Markdown、HTML...) 共用的圖片擷取結果
+
+    各格式內嵌的是同一組 base64 圖片，以內容雜湊記錄已寫入的檔名，
+    讓每張圖片只解碼與寫入一次，各格式引用同一個檔案。可由多個匯出執行緒同時使用。
     """
-    print(f"[process_markdown_images] Received image_export_mode: {image_export_mode}")
-    print(f"[process_markdown_images] Output base name: {output_base_name}, Output dir: {output_dir_path}")
-    
-    # --- 三種可能的圖片模式 ---
-    # 1. data URI 格式的圖片 (base64)
-    base64_img_pattern = r'!\[(.*?)\]\((data:image\/([^;]+);base64,([^)]+))\)'
-    
-    # 2. 標準相對路徑圖片連結
-    std_img_pattern = r'!\[(.*?)\]\((?!data:|https?:|/)([^)]+?)\)'
-    
-    # 3. 註解標記圖片
-    comment_img_pattern = r'<!-- image -->'
-    
-    # 輸出前 100 個字元以進行偵錯
-    print(f"[process_markdown_images] Content preview: {content[:100].replace(chr(10), ' ')}")
-    
-    # 尋找各種類型的圖片引用
-    base64_matches = list(re.finditer(base64_img_pattern, content))
-    std_matches = list(re.finditer(std_img_pattern, content))
-    comment_matches = list(re.finditer(comment_img_pattern, content))
-    
-    print(f"[process_markdown_images] Found matches - base64: {len(base64_matches)}, standard: {len(std_matches)}, comments: {len(comment_matches)}")
-    
-    # 顯示找到的匹配
-    for i, m in enumerate(base64_matches[:3]):
-        print(f"  Base64 Match {i+1}: alt={m.group(1)}, type={m.group(3)}, data_len={len(m.group(4))}")
-    
-    for i, m in enumerate(std_matches[:3]):
-        print(f"  Std Match {i+1}: alt={m.group(1)}, path={m.group(2)}")
-    
-    if image_export_mode != "referenced":
-        # 如果不是引用模式，直接返回原始內容
-        return content
-    
-    # 確保目標目錄存在
-    # 對 output_base_name 進行編碼，用於檔案系統路徑（儘管通常檔案系統能處理，但保持一致）
-    # 注意：檔案系統路徑通常不需要 URL 編碼，但 Web 路徑需要
-    # static_image_dest_dir = IMAGES_DIR / quote(output_base_name, safe='') # 檔案系統路徑通常不需要編碼
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files: Dict[str, str] = {}
+        self.saved = 0
+        self.reused = 0
+
+    def get_or_save(self, encoded_data: str, img_type: str, save: Callable[[], str]) -> str:
+        key = hashlib.sha1(f"{img_type}:{encoded_data}".encode("ascii", "ignore")).hexdigest()
+        with self._lock:
+            img_filename = self._files.get(key)
+            if img_filename is not None:
+                self.reused += 1
+                return img_filename
+            img_filename = self._files[key] = save()
+            self.saved += 1
+            return img_filename
+
+def store_image_bytes(img_data: Union[bytes, memoryview], img_type: str, task_id: str, dest_dir: Path) -> str:
+    """將圖片內容寫入 dest_dir，返回檔名
+
+    啟用內容定址儲存時以內容雜湊命名並連結到 image_store (相同內容只保存一份)，否則以任務 ID 產生唯一檔名。
+    """
+    if Config.IMAGE_STORE_ENABLED:
+        img_filename = image_store.save_bytes(img_data, img_type, dest_dir)
+    else:
+        # 生成唯一檔名
+        img_filename = f"{task_id}_{uuid.uuid4().hex}.{img_type}"
+        with open(dest_dir / img_filename, 'wb') as f:
+            f.write(img_data)
+    pregenerate_variant(dest_dir / img_filename)
+    return img_filename
+
+# --- 圖片最佳化：轉檔、限制尺寸與縮圖 ---
+# 匯出的原始圖片 (images_scale=2 的 PNG) 保持不變；最佳化版本與縮圖由 /images/ 端點在首次請求時產生，
+# 以內容雜湊與設定命名快取於 `Config.IMAGE_VARIANT_DIR`，編碼在專用的執行緒池中進行。
+
+VARIANT_OPTIMIZED = "optimized"  # 轉為 webp/jpeg 並限制最長邊為 IMAGE_MAX_DIMENSION
+VARIANT_THUMBNAIL = "thumb"      # 最長邊為 IMAGE_THUMBNAIL_SIZE 的縮圖
+
+# Pillow 可解碼且適合有損轉檔的格式 (svg、gif 等直接提供原檔)
+_OPTIMIZABLE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+_MEDIA_TYPE_SIGNATURES = [
+    (b"\x89PNG", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+]
+
+_optimize_lock = threading.Lock()
+_optimize_pool: Optional[ThreadPoolExecutor] = None
+_pending_variants: Dict[Tuple[str, str], Future] = {}
+_optimize_stats = {"generated": 0, "cache_hits": 0, "kept_original": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+
+def is_optimizable(path: Path) -> bool:
+    return Path(path).suffix.lower() in _OPTIMIZABLE_SUFFIXES
+
+def _get_optimize_pool() -> ThreadPoolExecutor:
+    global _optimize_pool
+    with _optimize_lock:
+        if _optimize_pool is None:
+            _optimize_pool = ThreadPoolExecutor(max_workers=max(1, Config.IMAGE_OPTIMIZE_WORKERS), thread_name_prefix="image-optimize")
+        return _optimize_pool
+
+def _variant_settings(variant: str) -> Tuple[str, int, int]:
+    """(輸出格式, 品質, 最長邊)"""
+    image_format = "jpeg" if Config.IMAGE_OPTIMIZE_FORMAT in ("jpeg", "jpg") else "webp"
+    max_dimension = Config.IMAGE_THUMBNAIL_SIZE if variant == VARIANT_THUMBNAIL else Config.IMAGE_MAX_DIMENSION
+    return image_format, Config.IMAGE_OPTIMIZE_QUALITY, max_dimension
+
+def _variant_path(content_key: str, variant: str) -> Path:
+    # 設定改變時產生新的檔案，不會沿用以舊設定編碼的版本
+    image_format, quality, max_dimension = _variant_settings(variant)
+    return Config.IMAGE_VARIANT_DIR / content_key[:2] / f"{content_key}_{variant}_{image_format}{quality}_{max_dimension}"
+
+def _encode_variant(source: Path, variant: str) -> Optional[Tuple[bytes, bool]]:
+    """以 Pillow 縮小並轉檔，返回 (編碼結果, 是否縮小)；動畫圖片返回 None"""
+    from PIL import Image
+
+    image_format, quality, max_dimension = _variant_settings(variant)
+    with Image.open(source) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        image.load()
+        resized = bool(max_dimension) and max(image.size) > max_dimension
+        if resized:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if image_format == "jpeg":
+            if has_alpha:
+                # JPEG 不支援透明度，以白色背景合成 (與文件頁面一致)
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            save_options = {"quality": quality, "optimize": True, "progressive": True}
+        else:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if has_alpha else "RGB")
+            save_options = {"quality": quality, "method": 4}
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format.upper(), **save_options)
+        return buffer.getvalue(), resized
+
+def _generate_variant(source: Path, variant: str) -> Path:
+    """產生 (或取得已快取的) 圖片版本，返回檔案路徑"""
+    target = _variant_path(image_store.content_key(source), variant)
+    if target.is_file():
+        with _optimize_lock:
+            _optimize_stats["cache_hits"] += 1
+        return target
+    source_size = source.stat().st_size
+    try:
+        encoded = _encode_variant(source, variant)
+    except Exception as e:
+        with _optimize_lock:
+            _optimize_stats["failed"] += 1
+        print(f"[image_optimize] 無法處理圖片 {source}: {e}")
+        encoded = None
+    kept_original = encoded is None or (not encoded[1] and len(encoded[0]) >= source_size)
+    # 無法轉檔，或未縮小且轉檔後反而較大 (例如簡單的線條圖 PNG) 時保留原檔內容
+    data = source.read_bytes() if kept_original else encoded[0]
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, target)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    with _optimize_lock:
+        _optimize_stats["kept_original" if kept_original else "generated"] += 1
+        _optimize_stats["bytes_in"] += source_size
+        _optimize_stats["bytes_out"] += len(data)
+    return target
+
+def _submit_variant(source: Path, variant: str) -> Future:
+    """在最佳化執行緒池中產生圖片版本；同一圖片同時的多個請求共用一個工作"""
+    pending_key = (str(source), variant)
+    with _optimize_lock:
+        future = _pending_variants.get(pending_key)
+        if future is not None:
+            return future
+    pool = _get_optimize_pool()
+    with _optimize_lock:
+        future = _pending_variants.get(pending_key)
+        if future is None:
+            future = _pending_variants[pending_key] = pool.submit(_generate_variant, source, variant)
+            future.add_done_callback(lambda _: _pending_variants.pop(pending_key, None))
+    return future
+
+async def get_image_variant(source: Path, variant: str) -> Path:
+    """取得圖片的最佳化版本或縮圖 (首次請求時在執行緒池中產生)"""
+    return await asyncio.wrap_future(_submit_variant(Path(source), variant))
+
+def pregenerate_variant(path: Path) -> None:
+    """匯出圖片後在背景產生最佳化版本 (不等待完成)"""
+    if not (Config.IMAGE_OPTIMIZE_ENABLED and Config.IMAGE_OPTIMIZE_PREGENERATE and is_optimizable(path)):
+        return
+    try:
+        _submit_variant(Path(path), VARIANT_OPTIMIZED)
+    except RuntimeError as e:  # 執行緒池已關閉 (服務停止中)
+        print(f"[image_optimize] 無法排入背景最佳化 {path}: {e}")
+
+def discard_variants(content_key: str) -> None:
+    """刪除某張圖片 (以內容雜湊表示) 產生的所有版本"""
+    variant_dir = Config.IMAGE_VARIANT_DIR / content_key[:2]
+    if variant_dir.is_dir():
+        for path in variant_dir.glob(f"{content_key}_*"):
+            path.unlink(missing_ok=True)
+
+def variant_media_type(path: Path) -> str:
+    """依檔頭判斷圖片版本的 MIME 類型 (保留原檔內容時可能不是設定的輸出格式)"""
+    with open(path, "rb") as f:
+        header = f.read(12)
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, media_type in _MEDIA_TYPE_SIGNATURES:
+        if header.startswith(signature):
+            return media_type
+    return "application/octet-stream"
+
+def shutdown_optimizer() -> None:
+    global _optimize_pool
+    with _optimize_lock:
+        pool, _optimize_pool = _optimize_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def optimization_stats() -> Dict[str, Any]:
+    with _optimize_lock:
+        return {
+            "enabled": Config.IMAGE_OPTIMIZE_ENABLED,
+            "format": _variant_settings(VARIANT_OPTIMIZED)[0],
+            "quality": Config.IMAGE_OPTIMIZE_QUALITY,
+            "max_dimension": Config.IMAGE_MAX_DIMENSION,
+            "thumbnail_size": Config.IMAGE_THUMBNAIL_SIZE,
+            "pending": len(_pending_variants),
+            **_optimize_stats,
+        }
+
+def save_base64_image(encoded_data: str, img_type: str, task_id: str, dest_dir: Path, image_cache: Optional[SharedImageCache] = None) -> str:
+    """解碼 base64 圖片並寫入 dest_dir，返回檔名；提供 image_cache 時相同圖片只寫入一次"""
+    def save() -> str:
+        return store_image_bytes(base64.b64decode(encoded_data), img_type, task_id, dest_dir)
+
+    if image_cache is None:
+        return save()
+    return image_cache.get_or_save(encoded_data, img_type, save)
+
+def picture_image_bytes(picture) -> Optional[Tuple[bytes, str]]:
+    """取得 PictureItem 圖片的原始位元組與副檔名；沒有圖片時返回 None
+
+    轉換產生的圖片以 data URI 保存，直接解碼該段 base64；沒有 data URI 時才由 PIL 影像編碼為 PNG。
+    """
+    image = getattr(picture, "image", None)
+    if image is None:
+        return None
+    uri = str(image.uri) if image.uri is not None else ""
+    if uri.startswith("data:") and ";base64," in uri:
+        header, encoded_data = uri.split(",", 1)
+        img_type = header[len("data:"):].split(";", 1)[0].split("/")[-1] or "png"
+        return base64.b64decode(encoded_data), img_type
+    pil_image = getattr(image, "pil_image", None)
+    if pil_image is None:
+        return None
+    buffer = io.BytesIO()
+    pil_image.save(buffer, format="PNG")
+    return buffer.getvalue(), "png"
+
+def save_document_pictures(document, task_id: str, output_base_name: str):
+    """將 DoclingDocument 的圖片直接寫入 static/images/<output_base_name>/，返回圖片改為引用路徑的文件副本
+
+    不經過 EMBEDDED 匯出與 base64 字串掃描：以返回的副本搭配 ImageRefMode.REFERENCED 匯出，
+    Markdown / HTML 一次就產生最終的圖片連結。原文件不變 (仍保有內嵌圖片，供文件儲存使用)。
+    """
+    static_image_dest_dir = IMAGES_DIR / output_base_name
+    pictures = []
+    saved_count = 0
+    for picture in document.pictures:
+        try:
+            extracted = picture_image_bytes(picture)
+        except Exception as e:
+            print(f"[save_document_pictures] 無法取得圖片 {getattr(picture, 'self_ref', '')}: {e}")
+            extracted = None
+        if extracted is None:
+            pictures.append(picture)
+            continue
+        img_data, img_type = extracted
+        if not saved_count:
+            static_image_dest_dir.mkdir(parents=True, exist_ok=True)
+        img_filename = store_image_bytes(img_data, img_type, task_id, static_image_dest_dir)
+        saved_count += 1
+        # docling 以 REFERENCED 模式匯出時會對路徑做 URL 編碼，這裡保留原始名稱
+        web_path = Path("/static/images") / output_base_name / img_filename
+        image = picture.image.model_copy(update={"uri": web_path})
+        pictures.append(picture.model_copy(update={"image": image}))
+
+    referenced = document.model_copy(update={"pictures": pictures})
+    print(f"[save_document_pictures] 已直接寫入 {saved_count} 張圖片至 /static/images/{output_base_name}/")
+    return referenced
+
+def save_stored_document_pictures(document_id: str, task_id: str, output_base_name: str):
+    """由二進位格式保存的文件直接寫出圖片至 static/images/<output_base_name>/，返回圖片為引用路徑的文件
+
+    圖片原始位元組由 mmap 直接寫入 (不經 base64 解碼與重新編碼)；文件以 JSON 保存時返回 None，
+    改用 load_document + save_document_pictures。
+    """
+    static_image_dest_dir = IMAGES_DIR / output_base_name
+    saved: List[str] = []
+
+    def write_picture(payload: memoryview, mimetype: str) -> str:
+        if not saved:
+            static_image_dest_dir.mkdir(parents=True, exist_ok=True)
+        img_filename = store_image_bytes(payload, mimetype.split("/")[-1] or "png", task_id, static_image_dest_dir)
+        saved.append(img_filename)
+        return str(Path("/static/images") / output_base_name / img_filename)
+
+    referenced = doclingservice.load_document_with_picture_uris(document_id, write_picture)
+    if referenced is not None:
+        print(f"[save_stored_document_pictures] 已直接寫入 {len(saved)} 張圖片至 /static/images/{output_base_name}/")
+    return referenced
+
+def _rewrite_images(
+    content: str,
+    syntax: str,
+    task_id: str,
+    output_base_name: str,
+    image_cache: Optional[SharedImageCache],
+) -> str:
+    """以 image_rewriter 單次掃描將 Markdown / HTML 中的 data URI 圖片解碼寫入 /static/images/，改寫為引用
+
+    內容由 DoclingDocument 以 EMBEDDED 模式產生，圖片只會以 data URI 出現；
+    相對路徑圖片與 `<!-- image -->` 佔位註解 (沒有圖片內容的圖片) 沒有對應的檔案，保留原文。
+    """
+    log_prefix = f"[process_{syntax}_images]"
     static_image_dest_dir = IMAGES_DIR / output_base_name # 檔案系統路徑保持原樣
     static_image_dest_dir.mkdir(parents=True, exist_ok=True)
-    
     # 編碼用於 Web 路徑的目錄名
     encoded_output_base_name = quote(output_base_name, safe='')
-    
-    processed_images_count = 0
-    
-    # --- 處理 base64 嵌入圖片 ---
-    def replace_base64_img(match):
-        nonlocal processed_images_count
-        alt_text = match.group(1)
-        img_url = match.group(2)
-        img_type = match.group(3)
-        encoded_data = match.group(4)
-        
-        print(f"[process_markdown_images] Processing base64 image (alt: {alt_text})")
-        
-        try:
-            # 解碼 base64 數據
-            img_data = base64.b64decode(encoded_data)
-            
-            # 生成唯一檔名
-            img_filename = f"{task_id}_{uuid.uuid4().hex}.{img_type}"
-            dest_img_path = static_image_dest_dir / img_filename
-            
-            # 儲存圖片
-            with open(dest_img_path, 'wb') as f:
-                f.write(img_data)
-            
-            processed_images_count += 1
-            
-            # 構建 Web 路徑，對檔名進行編碼 (雖然 UUID 生成的通常不需要，但保持健壯性)
-            encoded_img_filename = quote(img_filename, safe='')
-            web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-            
-            print(f"[process_markdown_images] Saved base64 image to {dest_img_path}, web path: {web_path}")
-            
+
+    def web_path_for(img_filename: str) -> str:
+        # 構建 Web 路徑，對檔名進行編碼
+        return f"/static/images/{encoded_output_base_name}/{quote(img_filename, safe='')}"
+
+    def render(web_path: str, alt_text: Optional[str]) -> str:
+        if syntax == "markdown":
             # 確保 alt_text 中的特殊字元不會破壞 Markdown 語法 (例如 ] )
-            safe_alt_text = alt_text.replace(']', '\\]')
+            safe_alt_text = (alt_text or "").replace(']', '\\]')
             return f'![{safe_alt_text}]({web_path})'
-            
-        except base64.binascii.Error as e:
-            print(f"[process_markdown_images] Base64 decode error: {e}")
-            return match.group(0)
-        except Exception as e:
-            print(f"[process_markdown_images] Error processing base64 image: {e}")
-            return match.group(0)
-    
-    # 先處理 base64 圖片
-    processed_content = re.sub(base64_img_pattern, replace_base64_img, content)
-    
-    # --- 查找相關圖片目錄 ---
-    possible_img_dirs = [
-        output_dir_path / output_base_name,
-        output_dir_path / f"{output_base_name}_images",
-        output_dir_path / "images",
-    ]
-    
-    # 還要考慮當前輸出目錄中可能存在的隱式相對目錄
-    possible_img_dirs.extend(
-        p for p in output_dir_path.iterdir() 
-        if p.is_dir() and not p.name.startswith('.')
-    )
-    
-    # 顯示所有可能的圖片目錄
-    print(f"[process_markdown_images] Checking potential image directories:")
-    for img_dir in possible_img_dirs:
-        if img_dir.is_dir():
-            print(f"  Found directory: {img_dir}")
-            # 列出目錄內容
-            files = list(img_dir.glob("*"))
-            if files:
-                print(f"  Contains {len(files)} files: {', '.join(str(f.name) for f in files[:5])}")
-            else:
-                print(f"  Directory is empty")
-    
-    # --- 收集所有可能的圖片檔案 ---
-    all_image_files = []
-    for img_dir in possible_img_dirs:
-        if img_dir.is_dir():
-            for ext in ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg']:
-                all_image_files.extend(img_dir.glob(ext))
-                all_image_files.extend(img_dir.glob(ext.upper()))
-    
-    # 輸出找到的圖片
-    print(f"[process_markdown_images] Found {len(all_image_files)} total image files in all directories")
-    if all_image_files:
-        print(f"  First few images: {', '.join(str(f.name) for f in all_image_files[:5])}")
-    
-    # --- 處理標準相對路徑圖片 ---
-    def replace_std_img(match):
-        nonlocal processed_images_count
-        alt_text = match.group(1)
-        relative_img_path_str = match.group(2)
-        
-        print(f"[process_markdown_images] Processing standard image path: {relative_img_path_str}")
-        
+        # HTML alt 屬性中的引號需要轉義
+        safe_alt_text = (alt_text or "image").replace('"', '&quot;')
+        return f'<img src="{web_path}" alt="{safe_alt_text}">'
+
+    def replace(reference: image_rewriter.ImageReference) -> Optional[str]:
+        if reference.kind != image_rewriter.KIND_DATA:
+            return None
         try:
-            # 嘗試不同的源路徑組合
-            source_paths_to_try = [
-                output_dir_path / relative_img_path_str,  # 直接相對路徑
-                Path(relative_img_path_str).resolve(),    # 嘗試解析絕對路徑
-            ]
-            
-            # 對於可能的圖片目錄，也嘗試在其中查找
-            for img_dir in possible_img_dirs:
-                if img_dir.is_dir():
-                    img_basename = os.path.basename(relative_img_path_str)
-                    source_paths_to_try.append(img_dir / img_basename)
-            
-            source_img_path = None
-            
-            # 嘗試找到存在的圖片檔案
-            for path_to_try in source_paths_to_try:
-                if path_to_try.is_file():
-                    source_img_path = path_to_try
-                    print(f"[process_markdown_images] Found image at: {source_img_path}")
-                    break
-            
-            if not source_img_path:
-                print(f"[process_markdown_images] Warning: Could not find image file for path {relative_img_path_str}")
-                print(f"  Tried paths: {[str(p) for p in source_paths_to_try]}")
-                return match.group(0)
-            
-            # 生成唯一檔名
-            img_filename = f"{task_id}_{uuid.uuid4().hex}{source_img_path.suffix}"
-            dest_img_path = static_image_dest_dir / img_filename
-            
-            # 複製檔案
-            print(f"[process_markdown_images] Copying image from {source_img_path} to {dest_img_path}")
-            shutil.copy2(str(source_img_path), str(dest_img_path))
-            processed_images_count += 1
-            
-            # 構建 Web 路徑，進行編碼
-            encoded_img_filename = quote(img_filename, safe='')
-            web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-            
-            safe_alt_text = alt_text.replace(']', '\\]')
-            return f'![{safe_alt_text}]({web_path})'
-            
+            # 解碼並儲存圖片 (同一文件的其他匯出格式已儲存過的圖片直接沿用)
+            img_filename = save_base64_image(reference.base64_data, reference.image_type, task_id, static_image_dest_dir, image_cache)
+            return render(web_path_for(img_filename), reference.alt)
+        except base64.binascii.Error as e:
+            print(f"{log_prefix} Base64 decode error: {e}")
         except Exception as e:
-            print(f"[process_markdown_images] Error processing image {relative_img_path_str}: {e}")
-            return match.group(0)
-    
-    # 處理標準圖片連結
-    processed_content = re.sub(std_img_pattern, replace_std_img, processed_content)
-    
-    # --- 處理註解標記 ---
-    if comment_matches and all_image_files:
-        print(f"[process_markdown_images] Processing {len(comment_matches)} comment image tags with {len(all_image_files)} available images")
-        
-        # 將圖片文件排序，確保處理順序一致
-        all_image_files.sort(key=lambda p: p.name)
-        
-        img_index = 0
-        
-        def replace_comment_img(match):
-            nonlocal img_index, processed_images_count
-            
-            if img_index >= len(all_image_files):
-                print(f"[process_markdown_images] Warning: Not enough image files for all <!-- image --> tags")
-                return match.group(0)
-            
-            source_img_path = all_image_files[img_index]
-            img_index += 1
-            
-            try:
-                # 生成唯一檔名
-                img_filename = f"{task_id}_{uuid.uuid4().hex}{source_img_path.suffix}"
-                dest_img_path = static_image_dest_dir / img_filename
-                
-                # 複製檔案
-                print(f"[process_markdown_images] Copying comment image {img_index} from {source_img_path} to {dest_img_path}")
-                shutil.copy2(str(source_img_path), str(dest_img_path))
-                processed_images_count += 1
-                
-                # 構建 Web 路徑，進行編碼
-                encoded_img_filename = quote(img_filename, safe='')
-                web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-                
-                # 使用檔名作為替代文字
-                alt_text = source_img_path.stem
-                
-                # 確保 alt_text 中的特殊字元不會破壞 Markdown 語法 (例如 ] )
-                safe_alt_text = alt_text.replace(']', '\\]')
-                return f'![{safe_alt_text}]({web_path})'
-                
-            except Exception as e:
-                print(f"[process_markdown_images] Error processing comment image {source_img_path}: {e}")
-                return match.group(0)
-        
-        # 替換所有註解圖片標記
-        processed_content = re.sub(comment_img_pattern, replace_comment_img, processed_content)
-    
-    # --- 如果沒有找到任何圖片引用，但有圖片檔案，則嘗試添加到文件末尾 ---
-    if processed_images_count == 0 and all_image_files and image_export_mode == "referenced":
-        print(f"[process_markdown_images] No image references processed, but found {len(all_image_files)} images. Adding at end of document.")
-        
-        processed_content += "\n\n## 圖片\n\n"
-        
-        for img_file in all_image_files:
-            try:
-                # 生成唯一檔名
-                img_filename = f"{task_id}_{uuid.uuid4().hex}{img_file.suffix}"
-                dest_img_path = static_image_dest_dir / img_filename
-                
-                # 複製檔案
-                print(f"[process_markdown_images] Copying additional image from {img_file} to {dest_img_path}")
-                shutil.copy2(str(img_file), str(dest_img_path))
-                processed_images_count += 1
-                
-                # 構建 Web 路徑，進行編碼
-                encoded_img_filename = quote(img_filename, safe='')
-                web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-                
-                # 使用檔名作為替代文字
-                alt_text = img_file.stem
-                
-                # 確保 alt_text 中的特殊字元不會破壞 Markdown 語法 (例如 ] )
-                safe_alt_text = alt_text.replace(']', '\\]')
-                
-                processed_content += f'![{safe_alt_text}]({web_path})\n\n'
-                
-            except Exception as e:
-                print(f"[process_markdown_images] Error processing additional image {img_file}: {e}")
-    
+            print(f"{log_prefix} Error processing {reference.kind} image: {e}")
+        return None
+
+    counts: Dict[str, int] = {}
+    if syntax == "markdown":
+        processed_content = image_rewriter.rewrite_markdown(content, replace, counts)
+    else:
+        processed_content = image_rewriter.rewrite_html(content, replace, counts)
+    processed_images_count = counts.get("replaced", 0)
+    print(f"{log_prefix} Found matches - base64: {counts.get('data', 0)}, standard: {counts.get('path', 0)}, "
+          f"comments: {counts.get('placeholder', 0)}; processed: {processed_images_count}")
+
     # --- 輸出處理結果 ---
     if processed_images_count > 0:
-        print(f"[process_markdown_images] Successfully processed {processed_images_count} images to /static/images/{output_base_name}/")
-    elif image_export_mode == "referenced":
-        if base64_matches or std_matches or comment_matches:
-            print(f"[process_markdown_images] Warning: Found image references but failed to process any images")
-        else:
-            print(f"[process_markdown_images] No image references found in the content")
-    
+        print(f"{log_prefix} Successfully processed {processed_images_count} images to /static/images/{output_base_name}/")
+    elif counts.get("data") or counts.get("path") or counts.get("placeholder"):
+        print(f"{log_prefix} Warning: Found image references but failed to process any images")
+    else:
+        print(f"{log_prefix} No image references found in the content")
     return processed_content
 
-def process_html_images(content: str, task_id: str, image_export_mode: str, output_base_name: str, output_dir_path: Path) -> str:
+def process_markdown_images(content: str, task_id: str, image_export_mode: str, output_base_name: str, image_cache: Optional[SharedImageCache] = None) -> str:
+    """處理 Markdown 中的圖片，根據指定的匯出模式處理圖片
+    
+    參數:
+        content: Markdown 內容
+        task_id: 任務 ID，用於生成唯一檔名
+        image_export_mode: 圖片處理模式，可為 'embedded' (內嵌), 'referenced' (引用) 或 'placeholder' (佔位符)
+        output_base_name: 輸出檔案的基本名稱，用於建立圖片子目錄
+        image_cache: 同一文件多個匯出格式共用的 SharedImageCache，相同的圖片只解碼與寫入一次
+    """
+    print(f"[process_markdown_images] Received image_export_mode: {image_export_mode}")
+    if image_export_mode != "referenced":
+        # 如果不是引用模式，直接返回原始內容
+        return content
+    return _rewrite_images(content, "markdown", task_id, output_base_name, image_cache)
+
+def process_html_images(content: str, task_id: str, image_export_mode: str, output_base_name: str, image_cache: Optional[SharedImageCache] = None) -> str:
     """處理 HTML 中的圖片，根據指定的匯出模式處理圖片
     
     參數:
@@ -303,372 +392,10 @@ def process_html_images(content: str, task_id: str, image_export_mode: str, outp
         task_id: 任務 ID，用於生成唯一檔名
         image_export_mode: 圖片處理模式，可為 'embedded' (內嵌), 'referenced' (引用) 或 'placeholder' (佔位符)
         output_base_name: 輸出檔案的基本名稱，用於建立圖片子目錄
-        output_dir_path: The directory where the main output file (and potentially docling's image dir) is saved.
+        image_cache: 同一文件多個匯出格式共用的 SharedImageCache，相同的圖片只解碼與寫入一次
     """
     print(f"[process_html_images] Received image_export_mode: {image_export_mode}")
-    print(f"[process_html_images] Output base name: {output_base_name}, Output dir: {output_dir_path}")
-    
-    # --- 三種可能的圖片模式 ---
-    # 1. data URI 格式的圖片 (base64)
-    base64_img_pattern = r'<img(?:[^>]*?)src="(data:image\/([^;]+);base64,([^"]+))"(?:[^>]*?)alt="([^"]*)"(?:[^>]*?)>'
-    base64_img_pattern_no_alt = r'<img(?:[^>]*?)src="(data:image\/([^;]+);base64,([^"]+))"(?:[^>]*?)>'
-    
-    # 2. 標準相對路徑圖片連結 (非 http, https, / 開頭)
-    std_img_pattern = r'<img(?:[^>]*?)src="(?!data:|https?:|/)([^"]+)"(?:[^>]*?)alt="([^"]*)"(?:[^>]*?)>'
-    std_img_pattern_no_alt = r'<img(?:[^>]*?)src="(?!data:|https?:|/)([^"]+)"(?:[^>]*?)>'
-    
-    # 3. 註解標記圖片
-    comment_img_pattern = r'<!-- image -->'
-    
-    # 輸出前 100 個字元以進行偵錯
-    print(f"[process_html_images] Content preview: {content[:100].replace(chr(10), ' ')}")
-    
-    # 尋找各種類型的圖片引用
-    base64_matches = list(re.finditer(base64_img_pattern, content))
-    base64_matches_no_alt = list(re.finditer(base64_img_pattern_no_alt, content))
-    
-    std_matches = list(re.finditer(std_img_pattern, content))
-    std_matches_no_alt = list(re.finditer(std_img_pattern_no_alt, content))
-    
-    comment_matches = list(re.finditer(comment_img_pattern, content))
-    
-    print(f"[process_html_images] Found matches - base64: {len(base64_matches)} (no alt: {len(base64_matches_no_alt)}), "
-          f"standard: {len(std_matches)} (no alt: {len(std_matches_no_alt)}), comments: {len(comment_matches)}")
-    
-    # 顯示找到的匹配
-    for i, m in enumerate(base64_matches[:3]):
-        print(f"  Base64 Match {i+1}: alt={m.group(4)}, type={m.group(2)}, data_len={len(m.group(3))}")
-    
-    for i, m in enumerate(std_matches[:3]):
-        print(f"  Std Match {i+1}: src={m.group(1)}, alt={m.group(2)}")
-    
     if image_export_mode != "referenced":
         # 如果不是引用模式，直接返回原始內容
         return content
-    
-    # 確保目標目錄存在 (檔案系統路徑保持原樣)
-    static_image_dest_dir = IMAGES_DIR / output_base_name
-    static_image_dest_dir.mkdir(parents=True, exist_ok=True)
-    
-    # 編碼用於 Web 路徑的目錄名
-    encoded_output_base_name = quote(output_base_name, safe='')
-    
-    processed_images_count = 0
-    
-    # --- 處理 base64 嵌入圖片 (帶 alt 文字) ---
-    def replace_base64_img(match):
-        nonlocal processed_images_count
-        img_url = match.group(1)
-        img_type = match.group(2)
-        encoded_data = match.group(3)
-        alt_text = match.group(4)
-        
-        print(f"[process_html_images] Processing base64 image (alt: {alt_text})")
-        
-        try:
-            # 解碼 base64 數據
-            img_data = base64.b64decode(encoded_data)
-            
-            # 生成唯一檔名
-            img_filename = f"{task_id}_{uuid.uuid4().hex}.{img_type}"
-            dest_img_path = static_image_dest_dir / img_filename
-            
-            # 儲存圖片
-            with open(dest_img_path, 'wb') as f:
-                f.write(img_data)
-            
-            processed_images_count += 1
-            
-            # 構建 Web 路徑，進行編碼
-            encoded_img_filename = quote(img_filename, safe='')
-            web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-            
-            print(f"[process_html_images] Saved base64 image to {dest_img_path}, web path: {web_path}")
-            
-            # HTML alt 屬性中的引號需要轉義
-            safe_alt_text = alt_text.replace('"', '&quot;')
-            return f'<img src="{web_path}" alt="{safe_alt_text}">'
-            
-        except base64.binascii.Error as e:
-            print(f"[process_html_images] Base64 decode error: {e}")
-            return match.group(0)
-        except Exception as e:
-            print(f"[process_html_images] Error processing base64 image: {e}")
-            return match.group(0)
-    
-    # --- 處理 base64 嵌入圖片 (無 alt 文字) ---
-    def replace_base64_img_no_alt(match):
-        nonlocal processed_images_count
-        img_url = match.group(1)
-        img_type = match.group(2)
-        encoded_data = match.group(3)
-        alt_text = "image"  # 默認 alt 文字
-        
-        print(f"[process_html_images] Processing base64 image (no alt)")
-        
-        try:
-            # 解碼 base64 數據
-            img_data = base64.b64decode(encoded_data)
-            
-            # 生成唯一檔名
-            img_filename = f"{task_id}_{uuid.uuid4().hex}.{img_type}"
-            dest_img_path = static_image_dest_dir / img_filename
-            
-            # 儲存圖片
-            with open(dest_img_path, 'wb') as f:
-                f.write(img_data)
-            
-            processed_images_count += 1
-            
-            # 構建 Web 路徑，進行編碼
-            encoded_img_filename = quote(img_filename, safe='')
-            web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-            
-            print(f"[process_html_images] Saved base64 image to {dest_img_path}, web path: {web_path}")
-            
-            # alt 屬性中的引號需要轉義
-            safe_alt_text = alt_text.replace('"', '&quot;')
-            return f'<img src="{web_path}" alt="{safe_alt_text}">'
-            
-        except base64.binascii.Error as e:
-            print(f"[process_html_images] Base64 decode error: {e}")
-            return match.group(0)
-        except Exception as e:
-            print(f"[process_html_images] Error processing base64 image: {e}")
-            return match.group(0)
-    
-    # 先處理 base64 圖片
-    processed_content = re.sub(base64_img_pattern, replace_base64_img, content)
-    processed_content = re.sub(base64_img_pattern_no_alt, replace_base64_img_no_alt, processed_content)
-    
-    # --- 查找相關圖片目錄 ---
-    possible_img_dirs = [
-        output_dir_path / output_base_name,
-        output_dir_path / f"{output_base_name}_images",
-        output_dir_path / "images",
-    ]
-    
-    # 還要考慮當前輸出目錄中可能存在的隱式相對目錄
-    possible_img_dirs.extend(
-        p for p in output_dir_path.iterdir() 
-        if p.is_dir() and not p.name.startswith('.')
-    )
-    
-    # 顯示所有可能的圖片目錄
-    print(f"[process_html_images] Checking potential image directories:")
-    for img_dir in possible_img_dirs:
-        if img_dir.is_dir():
-            print(f"  Found directory: {img_dir}")
-            # 列出目錄內容
-            files = list(img_dir.glob("*"))
-            if files:
-                print(f"  Contains {len(files)} files: {', '.join(str(f.name) for f in files[:5])}")
-            else:
-                print(f"  Directory is empty")
-    
-    # --- 收集所有可能的圖片檔案 ---
-    all_image_files = []
-    for img_dir in possible_img_dirs:
-        if img_dir.is_dir():
-            for ext in ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg']:
-                all_image_files.extend(img_dir.glob(ext))
-                all_image_files.extend(img_dir.glob(ext.upper()))
-    
-    # 輸出找到的圖片
-    print(f"[process_html_images] Found {len(all_image_files)} total image files in all directories")
-    if all_image_files:
-        print(f"  First few images: {', '.join(str(f.name) for f in all_image_files[:5])}")
-    
-    # --- 處理標準相對路徑圖片 (帶 alt 文字) ---
-    def replace_std_img(match):
-        nonlocal processed_images_count
-        relative_img_path_str = match.group(1)
-        alt_text = match.group(2)
-        
-        print(f"[process_html_images] Processing standard image path: {relative_img_path_str}")
-        
-        try:
-            # 嘗試不同的源路徑組合
-            source_paths_to_try = [
-                output_dir_path / relative_img_path_str,  # 直接相對路徑
-                Path(relative_img_path_str).resolve(),    # 嘗試解析絕對路徑
-            ]
-            
-            # 對於可能的圖片目錄，也嘗試在其中查找
-            for img_dir in possible_img_dirs:
-                if img_dir.is_dir():
-                    img_basename = os.path.basename(relative_img_path_str)
-                    source_paths_to_try.append(img_dir / img_basename)
-            
-            source_img_path = None
-            
-            # 嘗試找到存在的圖片檔案
-            for path_to_try in source_paths_to_try:
-                if path_to_try.is_file():
-                    source_img_path = path_to_try
-                    print(f"[process_html_images] Found image at: {source_img_path}")
-                    break
-            
-            if not source_img_path:
-                print(f"[process_html_images] Warning: Could not find image file for path {relative_img_path_str}")
-                print(f"  Tried paths: {[str(p) for p in source_paths_to_try]}")
-                return match.group(0)
-            
-            # 生成唯一檔名
-            img_filename = f"{task_id}_{uuid.uuid4().hex}{source_img_path.suffix}"
-            dest_img_path = static_image_dest_dir / img_filename
-            
-            # 複製檔案
-            print(f"[process_html_images] Copying image from {source_img_path} to {dest_img_path}")
-            shutil.copy2(str(source_img_path), str(dest_img_path))
-            processed_images_count += 1
-            
-            # 構建 Web 路徑，進行編碼
-            encoded_img_filename = quote(img_filename, safe='')
-            web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-            
-            safe_alt_text = alt_text.replace('"', '&quot;')
-            return f'<img src="{web_path}" alt="{safe_alt_text}">'
-            
-        except Exception as e:
-            print(f"[process_html_images] Error processing image {relative_img_path_str}: {e}")
-            return match.group(0)
-    
-    # --- 處理標準相對路徑圖片 (無 alt 文字) ---
-    def replace_std_img_no_alt(match):
-        nonlocal processed_images_count
-        relative_img_path_str = match.group(1)
-        alt_text = "image"  # 默認 alt 文字
-        
-        print(f"[process_html_images] Processing standard image path: {relative_img_path_str} (no alt)")
-        
-        try:
-            # 與帶 alt 文字的處理邏輯相同
-            source_paths_to_try = [
-                output_dir_path / relative_img_path_str,
-                Path(relative_img_path_str).resolve(),
-            ]
-            
-            for img_dir in possible_img_dirs:
-                if img_dir.is_dir():
-                    img_basename = os.path.basename(relative_img_path_str)
-                    source_paths_to_try.append(img_dir / img_basename)
-            
-            source_img_path = None
-            
-            for path_to_try in source_paths_to_try:
-                if path_to_try.is_file():
-                    source_img_path = path_to_try
-                    print(f"[process_html_images] Found image at: {source_img_path}")
-                    break
-            
-            if not source_img_path:
-                print(f"[process_html_images] Warning: Could not find image file for path {relative_img_path_str}")
-                return match.group(0)
-            
-            img_filename = f"{task_id}_{uuid.uuid4().hex}{source_img_path.suffix}"
-            dest_img_path = static_image_dest_dir / img_filename
-            
-            print(f"[process_html_images] Copying image from {source_img_path} to {dest_img_path}")
-            shutil.copy2(str(source_img_path), str(dest_img_path))
-            processed_images_count += 1
-            
-            # 構建 Web 路徑，進行編碼
-            encoded_img_filename = quote(img_filename, safe='')
-            web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-            
-            safe_alt_text = alt_text.replace('"', '&quot;')
-            return f'<img src="{web_path}" alt="{safe_alt_text}">'
-            
-        except Exception as e:
-            print(f"[process_html_images] Error processing image {relative_img_path_str}: {e}")
-            return match.group(0)
-    
-    # 處理標準圖片連結
-    processed_content = re.sub(std_img_pattern, replace_std_img, processed_content)
-    processed_content = re.sub(std_img_pattern_no_alt, replace_std_img_no_alt, processed_content)
-    
-    # --- 處理註解標記 ---
-    if comment_matches and all_image_files:
-        print(f"[process_html_images] Processing {len(comment_matches)} comment image tags with {len(all_image_files)} available images")
-        
-        # 將圖片文件排序，確保處理順序一致
-        all_image_files.sort(key=lambda p: p.name)
-        
-        img_index = 0
-        
-        def replace_comment_img(match):
-            nonlocal img_index, processed_images_count
-            
-            if img_index >= len(all_image_files):
-                print(f"[process_html_images] Warning: Not enough image files for all <!-- image --> tags")
-                return match.group(0)
-            
-            source_img_path = all_image_files[img_index]
-            img_index += 1
-            
-            try:
-                # 生成唯一檔名
-                img_filename = f"{task_id}_{uuid.uuid4().hex}{source_img_path.suffix}"
-                dest_img_path = static_image_dest_dir / img_filename
-                
-                # 複製檔案
-                print(f"[process_html_images] Copying comment image {img_index} from {source_img_path} to {dest_img_path}")
-                shutil.copy2(str(source_img_path), str(dest_img_path))
-                processed_images_count += 1
-                
-                # 構建 Web 路徑，進行編碼
-                encoded_img_filename = quote(img_filename, safe='')
-                web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-                
-                alt_text = source_img_path.stem
-                safe_alt_text = alt_text.replace('"', '&quot;')
-                
-                return f'<img src="{web_path}" alt="{safe_alt_text}">'
-                
-            except Exception as e:
-                print(f"[process_html_images] Error processing comment image {source_img_path}: {e}")
-                return match.group(0)
-        
-        # 替換所有註解圖片標記
-        processed_content = re.sub(comment_img_pattern, replace_comment_img, processed_content)
-    
-    # --- 如果沒有找到任何圖片引用，但有圖片檔案，則嘗試添加到文件末尾 ---
-    if processed_images_count == 0 and all_image_files and image_export_mode == "referenced":
-        print(f"[process_html_images] No image references processed, but found {len(all_image_files)} images. Adding at end of document.")
-        
-        processed_content += "\n\n<h2>圖片</h2>\n\n"
-        
-        for img_file in all_image_files:
-            try:
-                # 生成唯一檔名
-                img_filename = f"{task_id}_{uuid.uuid4().hex}{img_file.suffix}"
-                dest_img_path = static_image_dest_dir / img_filename
-                
-                # 複製檔案
-                print(f"[process_html_images] Copying additional image from {img_file} to {dest_img_path}")
-                shutil.copy2(str(img_file), str(dest_img_path))
-                processed_images_count += 1
-                
-                # 構建 Web 路徑，進行編碼
-                encoded_img_filename = quote(img_filename, safe='')
-                web_path = f"/static/images/{encoded_output_base_name}/{encoded_img_filename}"
-                
-                alt_text = img_file.stem
-                safe_alt_text = alt_text.replace('"', '&quot;')
-                
-                processed_content += f'<p><img src="{web_path}" alt="{safe_alt_text}"></p>\n\n'
-                
-            except Exception as e:
-                print(f"[process_html_images] Error processing additional image {img_file}: {e}")
-    
-    # --- 輸出處理結果 ---
-    if processed_images_count > 0:
-        print(f"[process_html_images] Successfully processed {processed_images_count} images to /static/images/{output_base_name}/")
-    elif image_export_mode == "referenced":
-        if base64_matches or std_matches or comment_matches:
-            print(f"[process_html_images] Warning: Found image references but failed to process any images")
-        else:
-            print(f"[process_html_images] No image references found in the content")
-    
-    return processed_content
+    return _rewrite_images(content, "html", task_id, output_base_name, image_cache)
@@ -0,0 +1,186 @@
+"""內容定址的圖片儲存
+
+匯出的圖片依內容的 SHA-256 存放為 `Config.IMAGE_STORE_DIR/<前兩碼>/<第三、四碼>/<雜湊>.<副檔名>`，
+每份文件的圖片目錄 (`static/images/<主檔名>/`) 中只放指向這些檔案的硬連結，檔名同樣是 `<雜湊>.<副檔名>`：
+相同的圖片 (標誌、重複的頁首、重新轉換的文件) 在磁碟上只保存一份，已存在的內容也不會再次寫入。
+
+硬連結數就是引用計數：儲存中的檔案連結數為 1 時表示已沒有任何文件 (或結果快取項目) 使用，
+release_tree() 刪除文件圖片目錄時會一併移除這些檔案。
+檔案系統不支援硬連結 (例如圖片目錄與儲存位於不同磁碟) 時改為複製，仍以內容雜湊命名。
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
+
+from config import Config
+
+_BLOB_NAME_PATTERN = re.compile(r"^([0-9a-f]{64})(\.[A-Za-z0-9]{1,10})?$")
+_CHUNK_SIZE = 1024 * 1024
+
+_STALE_TEMP_SECONDS = 3600  # 超過此時間的暫存檔視為中斷留下的檔案
+
+# 放入儲存並連結、以及刪除沒有連結的檔案都在此鎖內進行 (可重入：統計計數也使用同一個鎖)
+_lock = threading.RLock()
+_stats = {"stored": 0, "deduplicated": 0, "bytes_written": 0, "bytes_deduplicated": 0, "released": 0, "link_fallbacks": 0}
+
+def _normalize_extension(extension: Optional[str]) -> str:
+    extension = (extension or "").lower().lstrip(".")
+    if extension == "jpeg":
+        extension = "jpg"
+    return f".{extension}" if extension and re.match(r"^[a-z0-9]{1,10}$", extension) else ""
+
+def blob_path(sha256: str, extension: Optional[str]) -> Path:
+    return Config.IMAGE_STORE_DIR / sha256[:2] / sha256[2:4] / f"{sha256}{_normalize_extension(extension)}"
+
+def _count(key: str, amount: int = 1) -> None:
+    with _lock:
+        _stats[key] += amount
+
+def _hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _link(source: Path, dest: Path) -> None:
+    """建立硬連結 (已存在則保留)；不支援硬連結時改為複製"""
+    if dest.exists():
+        return
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, dest)
+    except FileExistsError:
+        pass
+    except OSError:
+        _count("link_fallbacks")
+        shutil.copyfile(source, dest)
+
+def _temp_writer(write: Callable[[Any], None]) -> Callable[[Path], str]:
+    """返回在儲存檔案旁建立暫存檔並以 write(檔案物件) 寫入內容的函式"""
+    def write_temp(blob: Path) -> str:
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=blob.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        return tmp_path
+    return write_temp
+
+def _store_and_link(blob: Path, size: int, write_temp: Callable[[Path], str], dest_dir: Path) -> str:
+    """將內容放入儲存 (已存在時不再寫入) 並連結到 dest_dir，返回檔名
+
+    內容在鎖外先寫入暫存檔；放入儲存與建立連結則在同一個鎖內完成，
+    release_tree() / collect_garbage() 不會在兩者之間把尚未連結 (連結數為 1) 的檔案刪除。
+    """
+    tmp_path = None if blob.is_file() else write_temp(blob)
+    try:
+        with _lock:
+            if blob.is_file():
+                _stats["deduplicated"] += 1
+                _stats["bytes_deduplicated"] += size
+            else:
+                if tmp_path is None:
+                    # 檢查之後才被回收，改在鎖內重新寫入
+                    tmp_path = write_temp(blob)
+                os.replace(tmp_path, blob)
+                tmp_path = None
+                _stats["stored"] += 1
+                _stats["bytes_written"] += size
+            _link(blob, Path(dest_dir) / blob.name)
+    finally:
+        if tmp_path is not None:
+            Path(tmp_path).unlink(missing_ok=True)
+    return blob.name
+
+def save_bytes(data: Union[bytes, memoryview], extension: Optional[str], dest_dir: Path) -> str:
+    """將圖片內容存入儲存並連結到 dest_dir，返回檔名 (`<雜湊>.<副檔名>`)"""
+    sha256 = hashlib.sha256(data).hexdigest()
+    return _store_and_link(blob_path(sha256, extension), len(data), _temp_writer(lambda f: f.write(data)), dest_dir)
+
+def link_tree(source_dir: Path, dest_dir: Path) -> None:
+    """以硬連結複製整個圖片目錄 (例如結果快取與文件圖片目錄之間)，不支援硬連結時改為複製"""
+    source_dir = Path(source_dir)
+    with _lock:
+        for source in source_dir.rglob("*"):
+            if source.is_file():
+                _link(source, Path(dest_dir) / source.relative_to(source_dir))
+
+def _stored_blob(path: Path) -> Optional[Path]:
+    """path 為儲存中檔案的連結時返回該檔案"""
+    match = _BLOB_NAME_PATTERN.match(path.name)
+    if not match:
+        return None
+    blob = blob_path(match.group(1), match.group(2))
+    try:
+        return blob if blob.is_file() and os.path.samefile(blob, path) else None
+    except OSError:
+        return None
+
+def content_key(path: Path) -> str:
+    """圖片內容的 SHA-256：儲存中檔案的連結直接取自檔名，其他檔案則計算雜湊"""
+    path = Path(path)
+    blob = _stored_blob(path)
+    return _BLOB_NAME_PATTERN.match(blob.name).group(1) if blob is not None else _hash_file(path)
+
+def release_tree(directory: Path, on_release: Optional[Callable[[str], None]] = None) -> int:
+    """刪除一個圖片目錄，儲存中不再被任何目錄引用的圖片一併刪除；返回移除的儲存檔案數
+
+    on_release 會以每個被移除圖片的內容雜湊呼叫 (例如一併刪除由該圖片產生的縮圖)。
+    """
+    directory = Path(directory)
+    if not directory.is_dir():
+        return 0
+    released = 0
+    with _lock:
+        for path in directory.rglob("*"):
+            if not path.is_file():
+                continue
+            blob = _stored_blob(path)
+            path.unlink(missing_ok=True)
+            # 只剩儲存本身的連結時，已沒有其他文件使用
+            if blob is not None and blob.stat().st_nlink <= 1:
+                blob.unlink(missing_ok=True)
+                released += 1
+                if on_release is not None:
+                    on_release(_BLOB_NAME_PATTERN.match(blob.name).group(1))
+        _stats["released"] += released
+    shutil.rmtree(directory, ignore_errors=True)
+    return released
+
+def collect_garbage(on_release: Optional[Callable[[str], None]] = None) -> int:
+    """掃描整個儲存，移除沒有任何引用的圖片 (例如服務中斷留下的檔案)；返回移除數量"""
+    removed = 0
+    if not Config.IMAGE_STORE_DIR.is_dir():
+        return 0
+    with _lock:
+        for blob in Config.IMAGE_STORE_DIR.glob("*/*/*"):
+            if blob.name.startswith(".tmp-"):
+                # 寫入中的暫存檔尚未放入儲存，只移除中斷留下的舊檔案
+                try:
+                    if time.time() - blob.stat().st_mtime > _STALE_TEMP_SECONDS:
+                        blob.unlink(missing_ok=True)
+                except OSError:
+                    pass
+            elif blob.is_file() and blob.stat().st_nlink <= 1:
+                blob.unlink(missing_ok=True)
+                removed += 1
+                match = _BLOB_NAME_PATTERN.match(blob.name)
+                if on_release is not None and match:
+                    on_release(match.group(1))
+    if removed:
+        print(f"[image_store] 已移除 {removed} 張未被引用的圖片")
+    return removed
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return {"enabled": Config.IMAGE_STORE_ENABLED, **_stats}
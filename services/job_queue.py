@@ -0,0 +1,536 @@
+"""持久化的轉換工作佇列
+
+以本地 SQLite 儲存任務 (task) 與工作 (job)：
+- task: 使用者看到的一筆轉換任務 (一次 URL 轉換或一次批次上傳)
+- job:  task 內的一個執行單位 (例如批次中的單一檔案)
+
+工作依優先等級排入佇列，由固定數量的 asyncio worker 取出執行，
+因此同時進行的轉換數量有上限。服務重新啟動時，中斷的工作會重新排入佇列。
+工作分屬不同的執行線道 (lane)：輕量格式 (DOCX、HTML、Markdown 等) 使用獨立的 worker，
+不會排在大型 PDF 之後等待；批次 URL 的下載工作另有下載線道，不佔用任何轉換 worker。
+"""
+import asyncio
+import contextvars
+import json
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from config import Config
+
+# 優先等級 (數字越小越優先)
+PRIORITY_INTERACTIVE = 0  # 互動式單一檔案轉換
+PRIORITY_BULK = 10        # 批次大量轉換
+
+# 工作狀態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETE = "complete"
+JOB_ERROR = "error"
+JOB_TIMEOUT = "timeout"      # 超過轉換期限而被中止
+JOB_CANCELLED = "cancelled"  # 使用者取消
+JOB_FINISHED_STATES = (JOB_COMPLETE, JOB_ERROR, JOB_TIMEOUT, JOB_CANCELLED)
+
+# 執行線道
+LANE_STANDARD = "standard"  # 需要 PDF 模型的轉換
+LANE_LIGHT = "light"        # 不需要模型的輕量格式
+LANE_DOWNLOAD = "download"  # 只等待網路的批次下載工作
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id     TEXT PRIMARY KEY,
+    kind        TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    finished_at REAL,
+    file_count  INTEGER NOT NULL DEFAULT 0,
+    options     TEXT,
+    status      TEXT NOT NULL DEFAULT 'queued'
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id      TEXT PRIMARY KEY,
+    task_id     TEXT NOT NULL,
+    kind        TEXT NOT NULL,
+    lane        TEXT NOT NULL DEFAULT 'standard',
+    priority    INTEGER NOT NULL,
+    seq         INTEGER NOT NULL DEFAULT 0,
+    payload     TEXT NOT NULL,
+    status      TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    result      TEXT,
+    error       TEXT,
+    created_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, priority, created_at, seq);
+CREATE INDEX IF NOT EXISTS idx_jobs_task ON jobs (task_id);
+"""
+
+JobHandler = Callable[..., Awaitable[Optional[Dict[str, Any]]]]
+TaskFinalizer = Callable[[str, List[Dict[str, Any]]], None]
+CancelHook = Callable[[Dict[str, Any]], None]
+
+# 目前執行中的工作 ID，由 _run_job 設定，handler 內可用 record_partial_result() 回報部分結果
+_current_job_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("job_queue_current_job_id", default=None)
+
+class JobQueue:
+    """SQLite 支援的優先佇列與 worker 管理"""
+
+    def __init__(self, db_path: Path, max_attempts: int = 3):
+        self.db_path = Path(db_path)
+        self.max_attempts = max_attempts
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._handlers: Dict[str, JobHandler] = {}
+        self._finalizers: Dict[str, TaskFinalizer] = {}
+        self._cancel_hooks: Dict[str, CancelHook] = {}
+        self._workers: List[asyncio.Task] = []
+        self._lane_workers: Dict[str, List[asyncio.Task]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task_events: Dict[str, asyncio.Event] = {}
+        # 執行中的工作 (job_id -> asyncio.Task) 與已要求取消的工作
+        self._running: Dict[str, asyncio.Task] = {}
+        self._running_tasks: Dict[str, str] = {}
+        self._cancel_requested: Set[str] = set()
+        # 工作被取消前由 handler 回報的部分結果 (job_id -> result)
+        self._partial_results: Dict[str, Dict[str, Any]] = {}
+        # 仍在加入工作的任務 (尚未 seal_task)，期間即使工作都已結束也不視為完成
+        self._open_tasks: Set[str] = set()
+        # 已取消的任務：之後才加入的工作 (例如批次上傳仍在排入的群組) 直接記錄為已取消
+        self._cancelled_tasks: Set[str] = set()
+
+    # --- 初始化與復原 ---
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            # 舊版資料庫沒有 lane 欄位，補上後再建立依線道取出工作的索引
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "lane" not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN lane TEXT NOT NULL DEFAULT '{LANE_STANDARD}'")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_lane_claim ON jobs (lane, status, priority, created_at, seq)")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connect().execute(sql, params)
+
+    def recover(self) -> int:
+        """將上次執行中斷 (仍為 running) 的工作重新排入佇列，超過重試次數者標記為錯誤"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status = ? AND attempts >= ?",
+                    (JOB_ERROR, "服務中斷且已超過重試次數", now, JOB_RUNNING, self.max_attempts),
+                )
+                requeued = conn.execute(
+                    "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?",
+                    (JOB_QUEUED, JOB_RUNNING),
+                ).rowcount
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if requeued:
+            print(f"[job_queue] 已重新排入 {requeued} 個中斷的工作")
+
+        # 工作已全部結束但任務狀態未更新者 (例如超過重試次數)，補上完成處理
+        pending_tasks = self._execute(
+            "SELECT task_id FROM tasks WHERE status IN (?, ?)", (JOB_QUEUED, JOB_RUNNING)
+        ).fetchall()
+        for row in pending_tasks:
+            self._maybe_finish_task(row["task_id"])
+        return requeued
+
+    def register_handler(self, kind: str, handler: JobHandler) -> None:
+        """註冊工作處理函式：handler(task_id=..., **payload) -> 結果字典"""
+        self._handlers[kind] = handler
+
+    def register_task_finalizer(self, kind: str, finalizer: TaskFinalizer) -> None:
+        """註冊任務完成時的回呼：finalizer(task_id, results)"""
+        self._finalizers[kind] = finalizer
+
+    def register_cancel_hook(self, kind: str, hook: CancelHook) -> None:
+        """註冊工作未執行即被取消時的回呼：hook(payload)，例如釋放工作持有的上傳內容"""
+        self._cancel_hooks[kind] = hook
+
+    def _run_cancel_hook(self, kind: str, payload: Dict[str, Any]) -> None:
+        hook = self._cancel_hooks.get(kind)
+        if hook is None:
+            return
+        try:
+            hook(payload)
+        except Exception as e:
+            print(f"[job_queue] 取消回呼失敗 ({kind}): {e}")
+
+    # --- 任務與工作的建立 ---
+
+    def create_task(
+        self, task_id: str, kind: str, file_count: int, options: Optional[Dict[str, Any]] = None, sealed: bool = True
+    ) -> None:
+        """建立任務；sealed=False 時需在加入所有工作後呼叫 seal_task()"""
+        if not sealed:
+            self._open_tasks.add(task_id)
+        self._execute(
+            "INSERT INTO tasks (task_id, kind, created_at, file_count, options, status) VALUES (?, ?, ?, ?, ?, ?)",
+            (task_id, kind, time.time(), file_count, json.dumps(options or {}, ensure_ascii=False), JOB_QUEUED),
+        )
+
+    def seal_task(self, task_id: str) -> None:
+        """任務的工作已全部加入；若工作都已結束，立即完成任務"""
+        self._open_tasks.discard(task_id)
+        self._maybe_finish_task(task_id)
+
+    def enqueue(
+        self,
+        task_id: str,
+        kind: str,
+        payload: Dict[str, Any],
+        priority: int = PRIORITY_BULK,
+        seq: int = 0,
+        lane: str = LANE_STANDARD,
+    ) -> str:
+        """將工作加入佇列並喚醒 worker (指定的線道沒有 worker 時改排入標準線道)
+
+        任務已取消時，工作直接記錄為已取消而不執行。
+        """
+        if lane != LANE_STANDARD and self._lane_workers and not self.has_lane(lane):
+            lane = LANE_STANDARD
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        if self.is_cancelled(task_id):
+            self._execute(
+                "INSERT INTO jobs (job_id, task_id, kind, lane, priority, seq, payload, status, error, created_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, task_id, kind, lane, priority, seq, json.dumps(payload, ensure_ascii=False), JOB_CANCELLED, "使用者已取消", now, now),
+            )
+            self._run_cancel_hook(kind, payload)
+            self._maybe_finish_task(task_id)
+            return job_id
+        self._execute(
+            "INSERT INTO jobs (job_id, task_id, kind, lane, priority, seq, payload, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, task_id, kind, lane, priority, seq, json.dumps(payload, ensure_ascii=False), JOB_QUEUED, now),
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def is_cancelled(self, task_id: str) -> bool:
+        """任務是否已被取消 (包括服務重啟前已取消的任務)"""
+        if task_id in self._cancelled_tasks:
+            return True
+        row = self._execute("SELECT status FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row is not None and row["status"] == JOB_CANCELLED
+
+    # --- 取出與完成工作 ---
+
+    def claim_next(self, lane: str = LANE_STANDARD) -> Optional[Dict[str, Any]]:
+        """原子性地取出線道中最高優先的待處理工作並標記為執行中"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE lane = ? AND status = ? ORDER BY priority, created_at, seq LIMIT 1",
+                    (lane, JOB_QUEUED),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                now = time.time()
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ? WHERE job_id = ?",
+                    (JOB_RUNNING, now, row["job_id"]),
+                )
+                conn.execute(
+                    "UPDATE tasks SET status = ? WHERE task_id = ? AND status = ?",
+                    (JOB_RUNNING, row["task_id"], JOB_QUEUED),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def _finish_job(self, job: Dict[str, Any], status: str, result: Optional[Dict[str, Any]], error: Optional[str]) -> None:
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(), job["job_id"]),
+        )
+        self._maybe_finish_task(job["task_id"])
+
+    def _maybe_finish_task(self, task_id: str) -> None:
+        """若任務中所有工作都已結束，更新任務狀態並呼叫完成回呼"""
+        if task_id in self._open_tasks:
+            return
+        counts = self.task_counts(task_id)
+        if counts[JOB_QUEUED] or counts[JOB_RUNNING]:
+            return
+        task = self._execute("SELECT kind FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if task is None:
+            return
+        if counts[JOB_CANCELLED]:
+            final_status = JOB_CANCELLED
+        elif counts[JOB_ERROR]:
+            final_status = JOB_ERROR
+        elif counts[JOB_TIMEOUT]:
+            # 失敗的工作都是逾時
+            final_status = JOB_TIMEOUT
+        else:
+            final_status = JOB_COMPLETE
+        self._execute(
+            "UPDATE tasks SET status = ?, finished_at = ? WHERE task_id = ?",
+            (final_status, time.time(), task_id),
+        )
+        finalizer = self._finalizers.get(task["kind"])
+        if finalizer is not None:
+            try:
+                finalizer(task_id, self.task_results(task_id))
+            except Exception as e:
+                print(f"[job_queue] 任務完成回呼失敗 {task_id}: {e}")
+        event = self._task_events.pop(task_id, None)
+        if event is not None:
+            event.set()
+
+    # --- 查詢 ---
+
+    def task_counts(self, task_id: str) -> Dict[str, int]:
+        counts = {JOB_QUEUED: 0, JOB_RUNNING: 0, JOB_COMPLETE: 0, JOB_ERROR: 0, JOB_TIMEOUT: 0, JOB_CANCELLED: 0}
+        rows = self._execute(
+            "SELECT status, COUNT(*) AS n FROM jobs WHERE task_id = ? GROUP BY status", (task_id,)
+        ).fetchall()
+        for row in rows:
+            counts[row["status"]] = row["n"]
+        return counts
+
+    def job_seqs(self, task_id: str, kind: str) -> Set[int]:
+        """任務中指定類型工作的 seq (用於重新執行時略過已排入的工作)"""
+        rows = self._execute("SELECT seq FROM jobs WHERE task_id = ? AND kind = ?", (task_id, kind)).fetchall()
+        return {row["seq"] for row in rows}
+
+    def task_results(self, task_id: str) -> List[Dict[str, Any]]:
+        """返回任務中已結束工作的結果 (依加入順序)"""
+        rows = self._execute(
+            "SELECT status, payload, result, error, started_at, finished_at FROM jobs "
+            "WHERE task_id = ? ORDER BY seq, created_at",
+            (task_id,),
+        ).fetchall()
+        results = []
+        for row in rows:
+            if row["result"]:
+                result = json.loads(row["result"])
+                # 一個工作處理多個檔案時 (批次分組)，展開為各檔案的結果
+                results.extend(result["results"] if "results" in result else [result])
+            elif row["status"] in (JOB_ERROR, JOB_TIMEOUT, JOB_CANCELLED):
+                # 處理函式沒有返回結果 (例如被取消)，以工作記錄組出結果
+                payload = json.loads(row["payload"])
+                base = {"status": row["status"], "error": row["error"]}
+                if row["started_at"] and row["finished_at"]:
+                    base["timings"] = {"elapsed_seconds": round(row["finished_at"] - row["started_at"], 3)}
+                for item in payload.get("files") or payload.get("urls") or [payload]:
+                    result = dict(base)
+                    if "original_filename" in item:
+                        result["original_filename"] = item["original_filename"]
+                    if "source_url" in item:
+                        result["source"] = item["source_url"]
+                    results.append(result)
+        return results
+
+    def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        row = self._execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        task = dict(row)
+        task["options"] = json.loads(task["options"] or "{}")
+        task["counts"] = self.task_counts(task_id)
+        return task
+
+    def list_tasks(self) -> List[Dict[str, Any]]:
+        rows = self._execute("SELECT * FROM tasks ORDER BY created_at DESC").fetchall()
+        tasks = []
+        for row in rows:
+            task = dict(row)
+            task["options"] = json.loads(task["options"] or "{}")
+            tasks.append(task)
+        return tasks
+
+    def delete_task(self, task_id: str) -> bool:
+        """刪除任務及其工作記錄 (呼叫端需確認任務已結束)"""
+        self._open_tasks.discard(task_id)
+        self._cancelled_tasks.discard(task_id)
+        self._execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+        return self._execute("DELETE FROM tasks WHERE task_id = ?", (task_id,)).rowcount > 0
+
+    def queued_count(self, lane: str = LANE_STANDARD) -> int:
+        """返回線道中等待執行的工作數"""
+        row = self._execute(
+            "SELECT COUNT(*) AS n FROM jobs WHERE lane = ? AND status = ?", (lane, JOB_QUEUED)
+        ).fetchone()
+        return row["n"]
+
+    def stats(self) -> Dict[str, Any]:
+        rows = self._execute("SELECT lane, status, COUNT(*) AS n FROM jobs GROUP BY lane, status").fetchall()
+        jobs: Dict[str, int] = {}
+        lanes: Dict[str, Dict[str, int]] = {}
+        for row in rows:
+            jobs[row["status"]] = jobs.get(row["status"], 0) + row["n"]
+            lanes.setdefault(row["lane"], {})[row["status"]] = row["n"]
+        return {
+            "workers": {lane: len(workers) for lane, workers in self._lane_workers.items()},
+            "jobs": jobs,
+            "lanes": lanes,
+        }
+
+    # --- 取消 ---
+
+    def cancel_task(self, task_id: str) -> Dict[str, int]:
+        """取消任務：佇列中的工作直接標記為已取消，執行中的工作會被中止
+
+        返回 {"queued": 取消的待處理工作數, "running": 中止的執行中工作數}
+        """
+        self._cancelled_tasks.add(task_id)
+        cancelled_queued = 0
+        queued = self._execute(
+            "SELECT job_id, kind, payload FROM jobs WHERE task_id = ? AND status = ?", (task_id, JOB_QUEUED)
+        ).fetchall()
+        for row in queued:
+            # 逐一更新，已被 worker 取出的工作改由下方中止
+            if self._execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE job_id = ? AND status = ?",
+                (JOB_CANCELLED, "使用者已取消", time.time(), row["job_id"], JOB_QUEUED),
+            ).rowcount:
+                cancelled_queued += 1
+                self._run_cancel_hook(row["kind"], json.loads(row["payload"]))
+
+        cancelled_running = 0
+        for job_id, job_task_id in list(self._running_tasks.items()):
+            if job_task_id != task_id or job_id in self._cancel_requested:
+                continue
+            self._cancel_requested.add(job_id)
+            self._running[job_id].cancel()
+            cancelled_running += 1
+
+        if cancelled_queued or cancelled_running:
+            print(f"[job_queue] 已取消任務 {task_id}: 佇列中 {cancelled_queued}，執行中 {cancelled_running}")
+        # 沒有執行中的工作時，任務在此即結束
+        self._maybe_finish_task(task_id)
+        return {"queued": cancelled_queued, "running": cancelled_running}
+
+    # --- 等待任務完成 ---
+
+    async def wait_for_task(self, task_id: str) -> None:
+        """等待任務中所有工作結束"""
+        counts = self.task_counts(task_id)
+        if not counts[JOB_QUEUED] and not counts[JOB_RUNNING]:
+            return
+        event = self._task_events.setdefault(task_id, asyncio.Event())
+        await event.wait()
+
+    # --- worker ---
+
+    async def start(self, num_workers: int, light_workers: int = 0, download_workers: int = 0) -> None:
+        """復原中斷的工作並啟動各線道的 worker
+
+        light_workers / download_workers 為 0 時，該線道的工作改由標準線道的 worker 執行。
+        """
+        self.recover()
+        self._wakeup = asyncio.Event()
+        lanes = {LANE_STANDARD: max(1, num_workers)}
+        for lane, count in ((LANE_LIGHT, light_workers), (LANE_DOWNLOAD, download_workers)):
+            if count > 0:
+                lanes[lane] = count
+            else:
+                self._execute("UPDATE jobs SET lane = ? WHERE lane = ? AND status = ?", (LANE_STANDARD, lane, JOB_QUEUED))
+        for lane, count in lanes.items():
+            workers = [asyncio.create_task(self._worker_loop(index, lane)) for index in range(count)]
+            self._lane_workers[lane] = workers
+            self._workers.extend(workers)
+        print(f"[job_queue] 已啟動工作 worker {lanes} ({self.db_path})")
+
+    def has_lane(self, lane: str) -> bool:
+        return bool(self._lane_workers.get(lane))
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        self._lane_workers.clear()
+
+    async def _worker_loop(self, index: int, lane: str = LANE_STANDARD) -> None:
+        while True:
+            job = self.claim_next(lane)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job)
+
+    def record_partial_result(self, result: Dict[str, Any]) -> None:
+        """於 handler 內呼叫：記錄目前工作的部分結果，工作被使用者取消時以此作為結果保存"""
+        job_id = _current_job_id.get()
+        if job_id is not None and job_id in self._running:
+            self._partial_results[job_id] = result
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        handler = self._handlers.get(job["kind"])
+        if handler is None:
+            self._finish_job(job, JOB_ERROR, None, f"未註冊的工作類型: {job['kind']}")
+            return
+        job_id = job["job_id"]
+        # 以獨立的 asyncio.Task 執行，讓 cancel_task() 可以只中止這個工作
+        token = _current_job_id.set(job_id)
+        try:
+            running = asyncio.create_task(handler(task_id=job["task_id"], **job["payload"]))
+        finally:
+            _current_job_id.reset(token)
+        self._running[job_id] = running
+        self._running_tasks[job_id] = job["task_id"]
+        try:
+            result = await running
+        except asyncio.CancelledError:
+            if job_id not in self._cancel_requested:
+                # 服務關閉中：保留 running 狀態，下次啟動時由 recover() 重新排入
+                raise
+            # handler 在取消前回報的部分結果 (例如已轉換完成的檔案) 一併保存
+            self._finish_job(job, JOB_CANCELLED, self._partial_results.get(job_id), "使用者已取消")
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self._finish_job(job, JOB_ERROR, None, str(e))
+            return
+        finally:
+            self._running.pop(job_id, None)
+            self._running_tasks.pop(job_id, None)
+            self._cancel_requested.discard(job_id)
+            self._partial_results.pop(job_id, None)
+        status = (result or {}).get("status")
+        if status == "error":
+            job_status = JOB_ERROR
+        elif status == JOB_TIMEOUT:
+            job_status = JOB_TIMEOUT
+        else:
+            job_status = JOB_COMPLETE
+        self._finish_job(job, job_status, result, (result or {}).get("error"))
+
+# 全域工作佇列，於 app lifespan 中啟動
+JOB_QUEUE = JobQueue(Config.JOB_DB_PATH, max_attempts=Config.JOB_MAX_ATTEMPTS)
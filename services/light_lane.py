@@ -0,0 +1,131 @@
+"""輕量格式轉換線道
+
+DOCX、PPTX、HTML、Markdown、CSV 與 AsciiDoc 由 docling 的 SimplePipeline 處理，不需要 PDF 的
+OCR、layout 或表格模型。這些文件改由一個預先建立、不載入模型的轉換器，在專用的小型執行緒池中轉換，
+並經由佇列的輕量線道排程，不必排在大型 PDF 之後等待。
+
+執行緒無法被強制中止：轉換逾時或工作被取消時，呼叫端立即收到逾時/取消，但該轉換仍會在執行緒中跑完
+(結果捨棄)，期間佔用一個輕量執行緒。stats() 的 "abandoned_running" 顯示這類仍在執行的轉換數；
+需要確實中止的轉換應經由轉換工作行程 (conversion_executor) 執行。
+"""
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+from docling.datamodel.base_models import DocumentStream, InputFormat
+from docling.document_converter import DocumentConverter
+
+from config import Config
+
+# 副檔名 -> docling 輸入格式
+LIGHT_FORMATS: Dict[str, InputFormat] = {
+    ".docx": InputFormat.DOCX,
+    ".pptx": InputFormat.PPTX,
+    ".html": InputFormat.HTML,
+    ".htm": InputFormat.HTML,
+    ".md": InputFormat.MD,
+    ".markdown": InputFormat.MD,
+    ".csv": InputFormat.CSV,
+    ".adoc": InputFormat.ASCIIDOC,
+    ".asciidoc": InputFormat.ASCIIDOC,
+}
+
+def is_light_document(path: Union[str, Path]) -> bool:
+    """依副檔名判斷文件是否可走輕量線道"""
+    return Config.LIGHT_LANE_ENABLED and Path(str(path)).suffix.lower() in LIGHT_FORMATS
+
+def create_light_converter() -> DocumentConverter:
+    """建立只處理輕量格式的轉換器 (各格式使用預設的 SimplePipeline，不載入任何模型)"""
+    return DocumentConverter(allowed_formats=sorted(set(LIGHT_FORMATS.values()), key=lambda f: f.value))
+
+_converter: Optional[DocumentConverter] = None
+_converter_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_stats = {"conversions": 0, "errors": 0, "total_seconds": 0.0, "abandoned": 0, "abandoned_running": 0}
+
+def get_light_converter() -> DocumentConverter:
+    global _converter
+    if _converter is None:
+        with _converter_lock:
+            if _converter is None:
+                converter = create_light_converter()
+                # 預先初始化各格式的 pipeline，第一個請求不需再建立
+                for input_format in set(LIGHT_FORMATS.values()):
+                    converter.initialize_pipeline(input_format)
+                _converter = converter
+    return _converter
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, Config.LIGHT_WORKERS), thread_name_prefix="docling-light")
+    return _executor
+
+def _convert(file_path: Path, data: Optional[bytes] = None) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    if data is not None:
+        source = DocumentStream(name=Path(file_path).name, stream=io.BytesIO(data))
+    else:
+        source = str(Path(file_path).absolute())
+    result = get_light_converter().convert(source)
+    return result, time.perf_counter() - start
+
+async def warm_up() -> None:
+    """於啟動時在背景建立輕量轉換器"""
+    if not Config.LIGHT_LANE_ENABLED:
+        return
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    await loop.run_in_executor(_get_executor(), get_light_converter)
+    print(f"[light_lane] 輕量轉換器已就緒 ({time.perf_counter() - start:.2f} 秒)")
+
+async def convert(file_path: Path, data: Optional[bytes] = None) -> Tuple[Any, float]:
+    """在輕量執行緒池中轉換文件，返回 (docling ConversionResult, 耗時秒數)
+
+    data 為檔案內容時直接由記憶體轉換 (file_path 只用於名稱與副檔名)。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_get_executor(), _convert, Path(file_path), data)
+    try:
+        result, elapsed = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # 逾時或取消：執行緒中的轉換無法中止，記錄直到它在背景結束
+        if not future.done():
+            _stats["abandoned"] += 1
+            _stats["abandoned_running"] += 1
+            future.add_done_callback(_finish_abandoned)
+        raise
+    except Exception:
+        _stats["errors"] += 1
+        raise
+    _stats["conversions"] += 1
+    _stats["total_seconds"] += elapsed
+    return result, elapsed
+
+def _finish_abandoned(future: asyncio.Future) -> None:
+    _stats["abandoned_running"] -= 1
+    if not future.cancelled() and future.exception() is None:
+        print("[light_lane] 已逾時或取消的轉換在背景完成，結果已捨棄")
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def stats() -> Dict[str, Any]:
+    conversions = _stats["conversions"]
+    return {
+        "enabled": Config.LIGHT_LANE_ENABLED,
+        "workers": Config.LIGHT_WORKERS,
+        "ready": _converter is not None,
+        "conversions": conversions,
+        "errors": _stats["errors"],
+        "abandoned": _stats["abandoned"],
+        "abandoned_running": _stats["abandoned_running"],
+        "avg_seconds": round(_stats["total_seconds"] / conversions, 4) if conversions else None,
+    }
@@ -0,0 +1,76 @@
+"""逐頁 OCR 判斷
+
+ocr_mode="auto" 時，於 OCR 階段之前檢查每一頁 PDF 文字層的覆蓋率與字元品質，決定該頁的 OCR 方式：
+- skip:    文字層完整且沒有明顯的點陣區域，不執行 OCR
+- regions: 文字層可用，但頁面含有點陣圖 (例如掃描的插圖)，只對點陣區域 OCR
+- full:    沒有文字層或文字層為亂碼 (例如掃描檔、字型對應錯誤)，整頁 OCR 並取代原有文字
+"""
+import unicodedata
+from typing import Any, Dict, Iterable
+
+from config import Config
+
+OCR_SKIP = "skip"
+OCR_REGIONS = "regions"
+OCR_FULL = "full"
+
+def char_quality(text: str) -> float:
+    """可辨識字元的比例：替代字元 (U+FFFD)、控制字元與私用區字元視為無效"""
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    bad = 0
+    for c in chars:
+        if c == "\ufffd" or unicodedata.category(c) in ("Cc", "Co", "Cn", "Cs"):
+            bad += 1
+    return 1.0 - bad / len(chars)
+
+def _area(bbox: Any) -> float:
+    return max(0.0, abs(bbox.r - bbox.l)) * max(0.0, abs(bbox.b - bbox.t))
+
+def _coverage(rects: Iterable[Any], page_area: float) -> float:
+    if page_area <= 0:
+        return 0.0
+    return min(1.0, sum(_area(rect) for rect in rects) / page_area)
+
+def analyze_page(page: Any) -> Dict[str, Any]:
+    """分析 docling 頁面的文字層，返回判斷結果與依據的指標"""
+    backend = getattr(page, "_backend", None)
+    if backend is None or not backend.is_valid():
+        return {"page": page.page_no + 1, "decision": OCR_FULL, "reason": "no_backend"}
+
+    size = backend.get_size()
+    page_area = size.width * size.height
+    cells = list(backend.get_text_cells())
+    text = "".join(cell.text for cell in cells)
+    chars = len(text.strip())
+    quality = char_quality(text)
+    text_coverage = _coverage((cell.rect.to_bounding_box() if hasattr(cell, "rect") else cell.bbox for cell in cells), page_area)
+    bitmap_coverage = _coverage(backend.get_bitmap_rects(), page_area)
+
+    if chars < Config.OCR_AUTO_MIN_CHARS:
+        decision, reason = OCR_FULL, "no_text_layer"
+    elif quality < Config.OCR_AUTO_MIN_QUALITY:
+        decision, reason = OCR_FULL, "garbled_text_layer"
+    elif bitmap_coverage >= Config.OCR_AUTO_BITMAP_THRESHOLD:
+        decision, reason = OCR_REGIONS, "bitmap_regions"
+    else:
+        decision, reason = OCR_SKIP, "text_layer_ok"
+
+    return {
+        "page": page.page_no + 1,
+        "decision": decision,
+        "reason": reason,
+        "chars": chars,
+        "char_quality": round(quality, 3),
+        "text_coverage": round(text_coverage, 3),
+        "bitmap_coverage": round(bitmap_coverage, 3),
+    }
+
+def summarize(decisions: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    """整理為任務結果中記錄的格式"""
+    pages = [decisions[page_no] for page_no in sorted(decisions)]
+    counts = {OCR_SKIP: 0, OCR_REGIONS: 0, OCR_FULL: 0}
+    for info in pages:
+        counts[info["decision"]] = counts.get(info["decision"], 0) + 1
+    return {"summary": counts, "pages": pages}
@@ -0,0 +1,240 @@
+"""docling pipeline 掛鉤
+
+在已初始化的 PDF pipeline 的每個頁面模型 (build_pipe) 外包一層追蹤器，
+讓每一頁通過各階段 (parse、OCR、layout、table、assemble) 時可以回報進度。
+追蹤器透過 ContextVar 取得目前轉換的回報函式，未設定時直接透傳，不影響共用的轉換器。
+ocr_mode="auto" 時另外包裝 OCR 模型，依 ocr_selection 的逐頁判斷略過或整頁執行 OCR。
+
+掛鉤依賴 docling 的內部介面 (DocumentConverter._get_pipeline 與 pipeline.build_pipe)，
+已在 docling 2.x 驗證；無法安裝時會記錄一次警告 (逐頁進度與 ocr_mode="auto" 的逐頁判斷不會生效)。
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from importlib import metadata
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from docling.datamodel.base_models import InputFormat
+
+from config import Config
+from services import ocr_selection
+
+ProgressCallback = Callable[[Dict[str, Any]], None]
+
+# 已驗證掛鉤可用的 docling 主版本
+SUPPORTED_DOCLING_MAJOR = 2
+_warned: set = set()
+_warn_lock = threading.Lock()
+
+def docling_version() -> Optional[str]:
+    try:
+        return metadata.version("docling")
+    except metadata.PackageNotFoundError:
+        return None
+
+def _warn_once(key: str, message: str) -> None:
+    with _warn_lock:
+        if key in _warned:
+            return
+        _warned.add(key)
+    print(f"[pipeline_hooks] 警告: {message} (docling {docling_version() or '未知版本'})")
+
+def check_docling_version() -> bool:
+    """docling 主版本是否為已驗證的版本；不是時記錄一次警告"""
+    version = docling_version()
+    try:
+        major = int(version.split(".")[0]) if version else None
+    except ValueError:
+        major = None
+    if major == SUPPORTED_DOCLING_MAJOR:
+        return True
+    _warn_once("version", f"未驗證的 docling 版本，逐頁進度與選擇性 OCR 掛鉤可能無法使用 (已驗證 {SUPPORTED_DOCLING_MAJOR}.x)")
+    return False
+
+# 依模型類別名稱對應的階段名稱
+_STAGE_KEYWORDS = (
+    ("Preprocess", "parse"),
+    ("Ocr", "ocr"),
+    ("Layout", "layout"),
+    ("TableStructure", "table"),
+    ("Assemble", "assemble"),
+)
+
+def _stage_name(model: Any) -> str:
+    class_name = type(model).__name__
+    for keyword, stage in _STAGE_KEYWORDS:
+        if keyword in class_name:
+            return stage
+    return class_name
+
+class PageProgressTracker:
+    """記錄單次轉換的頁面進度，並以節流方式回報"""
+
+    def __init__(self, callback: ProgressCallback, min_interval: float):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.pages_total = 0
+        self.pages_done = 0
+        self.stage = "parse"
+        self.started_at = time.monotonic()
+        self._last_report = 0.0
+
+    def set_total(self, conv_res: Any) -> None:
+        """由輸入文件與 page_range 計算本次要處理的頁數 (只計算一次)"""
+        if self.pages_total:
+            return
+        page_count = getattr(conv_res.input, "page_count", 0) or 0
+        limits = getattr(conv_res.input, "limits", None)
+        start, end = getattr(limits, "page_range", (1, page_count)) if limits is not None else (1, page_count)
+        self.pages_total = max(0, min(end, page_count) - max(start, 1) + 1)
+        self.report(force=True)
+
+    def page_passed(self, stage: str, is_last_stage: bool) -> None:
+        self.stage = stage
+        if is_last_stage:
+            self.pages_done += 1
+        self.report(force=is_last_stage and self.pages_done >= self.pages_total)
+
+    def snapshot(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        pages_per_sec = self.pages_done / elapsed
+        remaining = max(self.pages_total - self.pages_done, 0)
+        return {
+            "pages_done": self.pages_done,
+            "pages_total": self.pages_total,
+            "stage": self.stage,
+            "pages_per_sec": round(pages_per_sec, 3),
+            "eta_seconds": round(remaining / pages_per_sec, 1) if pages_per_sec > 0 else None,
+        }
+
+    def report(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_report < self.min_interval:
+            return
+        self._last_report = now
+        try:
+            self.callback(self.snapshot())
+        except Exception as e:
+            print(f"[pipeline_hooks] 回報進度失敗: {e}")
+
+_CURRENT_TRACKER: ContextVar[Optional[PageProgressTracker]] = ContextVar("page_progress_tracker", default=None)
+
+@contextmanager
+def track_progress(callback: Optional[ProgressCallback]):
+    """在此區塊內執行的轉換會將頁面進度回報給 callback"""
+    if callback is None:
+        yield None
+        return
+    tracker = PageProgressTracker(callback, Config.PROGRESS_MIN_INTERVAL)
+    token = _CURRENT_TRACKER.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _CURRENT_TRACKER.reset(token)
+
+_OCR_DECISIONS: ContextVar[Optional[Dict[int, Dict[str, Any]]]] = ContextVar("ocr_decisions", default=None)
+
+@contextmanager
+def collect_ocr_decisions():
+    """收集此區塊內轉換的逐頁 OCR 判斷 (頁碼 -> 判斷資訊)"""
+    decisions: Dict[int, Dict[str, Any]] = {}
+    token = _OCR_DECISIONS.set(decisions)
+    try:
+        yield decisions
+    finally:
+        _OCR_DECISIONS.reset(token)
+
+class _SelectiveOcrStage:
+    """包裝 OCR 模型：逐頁判斷後只對需要的頁面執行 OCR"""
+
+    def __init__(self, model: Any):
+        self.model = model
+        # 整頁 OCR 需暫時切換模型選項，同一轉換器被多個執行緒共用時逐頁序列化
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.model, name)
+
+    def __call__(self, conv_res: Any, page_batch: Iterable[Any]) -> Iterable[Any]:
+        decisions = _OCR_DECISIONS.get()
+        for page in page_batch:
+            try:
+                info = ocr_selection.analyze_page(page)
+            except Exception as e:
+                print(f"[pipeline_hooks] 無法分析頁面文字層，改為執行 OCR: {e}")
+                info = {"page": page.page_no + 1, "decision": ocr_selection.OCR_REGIONS, "reason": "analysis_failed"}
+            if decisions is not None:
+                decisions[info["page"]] = info
+
+            if info["decision"] == ocr_selection.OCR_SKIP:
+                yield page
+                continue
+            with self._lock:
+                options = self.model.options
+                previous = options.force_full_page_ocr
+                options.force_full_page_ocr = info["decision"] == ocr_selection.OCR_FULL
+                try:
+                    processed = list(self.model(conv_res, [page]))
+                finally:
+                    options.force_full_page_ocr = previous
+            yield from processed
+
+class _StageHook:
+    """包裝 build_pipe 中的單一頁面模型"""
+
+    def __init__(self, model: Any, stage: str, is_last_stage: bool):
+        self.model = model
+        self.stage = stage
+        self.is_last_stage = is_last_stage
+
+    def __getattr__(self, name: str) -> Any:
+        # 其餘屬性存取轉交給原始模型
+        return getattr(self.model, name)
+
+    def __call__(self, conv_res: Any, page_batch: Iterable[Any]) -> Iterable[Any]:
+        tracker = _CURRENT_TRACKER.get()
+        if tracker is None:
+            yield from self.model(conv_res, page_batch)
+            return
+        tracker.set_total(conv_res)
+        for page in self.model(conv_res, page_batch):
+            tracker.page_passed(self.stage, self.is_last_stage)
+            yield page
+
+def install(converter: Any, selective_ocr: bool = False) -> bool:
+    """為轉換器的 PDF pipeline 安裝頁面進度掛鉤，成功返回 True
+
+    pipeline 沒有 build_pipe (例如 VLM pipeline 或不同版本的 docling) 時不安裝，
+    轉換仍可正常執行，只是沒有逐頁進度。
+    selective_ocr 為 True 時，OCR 階段改為逐頁判斷是否執行 (ocr_mode="auto")。
+    """
+    check_docling_version()
+    unavailable = "逐頁進度回報" + ("與 ocr_mode=\"auto\" 的逐頁 OCR 判斷 (改為依 OCR 設定處理所有頁面)" if selective_ocr else "") + "停用"
+    get_pipeline = getattr(converter, "_get_pipeline", None)
+    if get_pipeline is None:
+        _warn_once("get_pipeline", f"DocumentConverter 沒有 _get_pipeline，{unavailable}")
+        return False
+    try:
+        pipeline = get_pipeline(InputFormat.PDF)
+    except Exception as e:
+        print(f"[pipeline_hooks] 無法初始化 PDF pipeline: {e}")
+        return False
+
+    if getattr(pipeline, "_page_hooks_installed", False):
+        return True
+    build_pipe = getattr(pipeline, "build_pipe", None)
+    if not build_pipe:
+        _warn_once(f"build_pipe:{type(pipeline).__name__}", f"{type(pipeline).__name__} 沒有 build_pipe，{unavailable}")
+        return False
+
+    last_index = len(build_pipe) - 1
+    hooked = []
+    for index, model in enumerate(build_pipe):
+        stage = _stage_name(model)
+        if selective_ocr and stage == "ocr":
+            model = _SelectiveOcrStage(model)
+        hooked.append(_StageHook(model, stage, index == last_index))
+    pipeline.build_pipe = hooked
+    pipeline._page_hooks_installed = True
+    return True
@@ -1,3 +1,5 @@
+from typing import Dict, Optional
+
 from config import CONVERSION_PROGRESS # 從 config 匯入全域進度字典
 
 def update_progress(task_id: str, progress: int, status: str, message: str):
@@ -8,3 +10,72 @@ def update_progress(task_id: str, progress: int, status: str, message: str):
         "status": status,
         "message": message
     }
+
+
+def update_page_progress(task_id: str, page_info: Dict, start_pct: float, end_pct: float, message_prefix: str):
+    """依逐頁進度更新任務進度
+
+    參數:
+        task_id: 任務 ID
+        page_info: pipeline 回報的進度 (pages_done、pages_total、stage、pages_per_sec、eta_seconds)
+        start_pct / end_pct: 此轉換在整體任務進度中所佔的區間
+        message_prefix: 進度訊息前綴
+    """
+    pages_done = page_info.get("pages_done", 0)
+    pages_total = page_info.get("pages_total", 0)
+    fraction = pages_done / pages_total if pages_total else 0.0
+    eta = page_info.get("eta_seconds")
+
+    message = f"{message_prefix} - 第 {pages_done}/{pages_total} 頁 ({page_info.get('stage')})"
+    if eta is not None:
+        message += f"，預估剩餘 {eta:.0f} 秒"
+
+    # 直接覆寫單一字典項目，寫入成本固定 (回報頻率已由 pipeline 掛鉤節流)
+    CONVERSION_PROGRESS[task_id] = {
+        "progress": int(start_pct + (end_pct - start_pct) * fraction),
+        "status": "converting",
+        "message": message,
+        "pages_done": pages_done,
+        "pages_total": pages_total,
+        "stage": page_info.get("stage"),
+        "pages_per_sec": page_info.get("pages_per_sec"),
+        "eta_seconds": eta,
+    }
+
+
+# 批次 URL 任務的下載與轉換同時進行：兩者各自計數，整體進度由兩個計數合成，彼此的更新不會互相覆寫
+URL_BATCH_DOWNLOAD_SHARE = 30  # 下載佔整體進度的百分比，其餘為轉換
+_batch_counters: Dict[str, Dict[str, int]] = {}
+
+def set_batch_counter(task_id: str, counter: str, value: int) -> None:
+    """設定批次任務的計數 (counter 為 "downloaded" 或 "converted")，例如服務重啟後由佇列復原"""
+    _batch_counters.setdefault(task_id, {"downloaded": 0, "converted": 0})[counter] = value
+
+def advance_batch_counter(task_id: str, counter: str) -> int:
+    counters = _batch_counters.setdefault(task_id, {"downloaded": 0, "converted": 0})
+    counters[counter] += 1
+    return counters[counter]
+
+def clear_batch_counters(task_id: str) -> None:
+    _batch_counters.pop(task_id, None)
+
+def update_url_batch_progress(task_id: str, total: int, status: str, message: str, page_info: Optional[Dict] = None):
+    """依下載與轉換計數更新批次 URL 任務的進度
+
+    page_info 為目前轉換中檔案的逐頁進度，計入該檔案在轉換區段中所佔的比例。
+    """
+    counters = _batch_counters.setdefault(task_id, {"downloaded": 0, "converted": 0})
+    total = max(total, 1)
+    convert_share = 100 - URL_BATCH_DOWNLOAD_SHARE
+    converted = counters["converted"]
+    if page_info is not None and page_info.get("pages_total"):
+        converted += min(page_info.get("pages_done", 0) / page_info["pages_total"], 1.0)
+    progress = min(counters["downloaded"], total) / total * URL_BATCH_DOWNLOAD_SHARE + min(converted, total) / total * convert_share
+    CONVERSION_PROGRESS[task_id] = {
+        "progress": int(progress),
+        "status": status,
+        "message": message,
+        "downloaded": counters["downloaded"],
+        "converted": counters["converted"],
+        "total": total,
+    }
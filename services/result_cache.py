@@ -0,0 +1,250 @@
+"""內容定址的轉換結果快取
+
+以「輸入檔案內容的雜湊 + 正規化的轉換選項 + 輸出格式」作為鍵，
+保存轉換後的輸出檔案與擷取出的圖片。重複提交相同文件時直接複製快取結果，
+完全略過 run_conversion。快取總大小超過上限時，依最近使用時間 (LRU) 移除。
+項目同時保存該次轉換的 DoclingDocument 檔案 (硬連結)，快取命中時可為新的主檔名建立文件。
+啟用內容定址圖片儲存時，快取項目與文件圖片目錄之間以硬連結共用圖片，不另外複製。
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+from urllib.parse import quote
+
+from config import Config, IMAGES_DIR
+from models import ConversionOptions
+from services import image_service, image_store
+from services.converter_pool import EXECUTION_ONLY_FIELDS, fingerprint_options
+
+_ENTRY_FILE = "entry.json"
+_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(file_path: Path) -> str:
+    """以串流方式計算檔案內容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def make_key(input_hash: str, options: ConversionOptions, format: str) -> str:
+    """組合快取鍵：輸入內容雜湊 + 選項指紋 + 輸出格式
+
+    選項指紋不含只影響執行方式的欄位 (num_threads、device)，調整執行緒數或改用 GPU 不會使快取失效。
+    """
+    raw = f"{input_hash}:{fingerprint_options(options, exclude=EXECUTION_ONLY_FIELDS)}:{format}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _copy_images(source: Path, dest: Path) -> None:
+    if Config.IMAGE_STORE_ENABLED:
+        image_store.link_tree(source, dest)
+    else:
+        shutil.copytree(source, dest, dirs_exist_ok=True)
+
+def _link_or_copy(source: Path, dest: Path) -> None:
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+def _remove_entry(entry_dir: Path) -> None:
+    """刪除快取項目；圖片透過 image_store 釋放，不再被引用的圖片一併從儲存移除"""
+    image_store.release_tree(entry_dir / "images", on_release=image_service.discard_variants)
+    shutil.rmtree(entry_dir, ignore_errors=True)
+
+class ResultCache:
+    """以目錄儲存的 LRU 結果快取"""
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> 項目大小 (bytes)，順序即 LRU 順序 (最舊在前)
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def _load_index(self) -> None:
+        """啟動後第一次使用時掃描快取目錄，依 entry.json 的修改時間重建 LRU 順序"""
+        if self._loaded:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry_file in self.cache_dir.glob(f"*/*/{_ENTRY_FILE}"):
+            try:
+                meta = json.loads(entry_file.read_text(encoding="utf-8"))
+                entries.append((entry_file.stat().st_mtime, meta["key"], int(meta["size"])))
+            except Exception as e:
+                print(f"[result_cache] 忽略損壞的快取項目 {entry_file.parent}: {e}")
+                _remove_entry(entry_file.parent)
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        self._loaded = True
+        print(f"[result_cache] 載入 {len(self._index)} 個快取項目 ({self._total_bytes} bytes)")
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            _remove_entry(self._entry_dir(key))
+            print(f"[result_cache] 已移除最久未使用的快取項目 {key[:12]} ({size} bytes)")
+
+    def store(
+        self,
+        key: str,
+        output_file: Path,
+        image_dir: Optional[Path],
+        image_base_name: str,
+        conversion_time: float,
+        document_file: Optional[Path] = None,
+    ) -> None:
+        """保存一次轉換的輸出檔案、圖片目錄與 (提供時) 文件儲存中的 DoclingDocument 檔案"""
+        output_file = Path(output_file)
+        if not output_file.is_file():
+            return
+        entry_dir = self._entry_dir(key)
+        tmp_dir = entry_dir.with_name(f".{key}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            shutil.copy2(output_file, tmp_dir / "output")
+            if image_dir is not None and Path(image_dir).is_dir():
+                _copy_images(image_dir, tmp_dir / "images")
+            document_suffix = None
+            if document_file is not None and Path(document_file).is_file():
+                document_suffix = Path(document_file).suffix
+                _link_or_copy(Path(document_file), tmp_dir / f"document{document_suffix}")
+            size = _dir_size(tmp_dir)
+            meta = {
+                "key": key,
+                "output_suffix": output_file.suffix,
+                "image_base_name": image_base_name,
+                "document_suffix": document_suffix,
+                "size": size,
+                "conversion_time": conversion_time,
+                "created_at": time.time(),
+            }
+            (tmp_dir / _ENTRY_FILE).write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+            with self._lock:
+                self._load_index()
+                if key in self._index:
+                    _remove_entry(tmp_dir)
+                    return
+                _remove_entry(entry_dir)
+                os.replace(tmp_dir, entry_dir)
+                self._index[key] = size
+                self._total_bytes += size
+                self._evict()
+            print(f"[result_cache] 已快取轉換結果 {key[:12]} ({size} bytes)")
+        except Exception as e:
+            print(f"[result_cache] 無法寫入快取 {key[:12]}: {e}")
+            _remove_entry(tmp_dir)
+
+    def contains(self, key: str) -> bool:
+        """快取中是否有此鍵 (不更新 LRU 順序與命中統計)"""
+        with self._lock:
+            self._load_index()
+            return key in self._index
+
+    def document_file(self, key: str) -> Optional[Path]:
+        """快取項目保存的 DoclingDocument 檔案；沒有保存時返回 None"""
+        entry_dir = self._entry_dir(key)
+        try:
+            meta = json.loads((entry_dir / _ENTRY_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        suffix = meta.get("document_suffix")
+        path = entry_dir / f"document{suffix}" if suffix else None
+        return path if path is not None and path.is_file() else None
+
+    def materialize(self, key: str, output_path: Path, image_base_name: str) -> bool:
+        """快取命中時，將快取結果複製到指定的輸出路徑與圖片目錄；未命中返回 False"""
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                self.misses += 1
+                return False
+            self._index.move_to_end(key)
+
+        entry_dir = self._entry_dir(key)
+        try:
+            meta = json.loads((entry_dir / _ENTRY_FILE).read_text(encoding="utf-8"))
+            cached_base = meta["image_base_name"]
+            cached_images = entry_dir / "images"
+            image_bytes = 0
+            if cached_images.is_dir():
+                dest_images = IMAGES_DIR / image_base_name
+                _copy_images(cached_images, dest_images)
+                image_bytes = _dir_size(cached_images)
+
+            output_path = Path(output_path)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            if cached_images.is_dir() and cached_base != image_base_name:
+                # 輸出內容中的圖片連結指向原本的圖片目錄，改寫為新的目錄名稱
+                content = (entry_dir / "output").read_text(encoding="utf-8")
+                content = content.replace(
+                    f"/static/images/{quote(cached_base, safe='')}/",
+                    f"/static/images/{quote(image_base_name, safe='')}/",
+                )
+                output_path.write_text(content, encoding="utf-8")
+            else:
+                shutil.copyfile(entry_dir / "output", output_path)
+            os.utime(entry_dir / _ENTRY_FILE)
+        except Exception as e:
+            print(f"[result_cache] 快取項目無法使用 {key[:12]}: {e}")
+            with self._lock:
+                size = self._index.pop(key, 0)
+                self._total_bytes -= size
+                self.misses += 1
+            _remove_entry(entry_dir)
+            return False
+
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += output_path.stat().st_size + image_bytes
+            self.seconds_saved += float(meta.get("conversion_time") or 0.0)
+        print(f"[result_cache] 快取命中 {key[:12]} -> {output_path}")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": Config.RESULT_CACHE_ENABLED,
+                "entries": len(self._index),
+                "total_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "seconds_saved": round(self.seconds_saved, 3),
+            }
+
+# 全域結果快取
+RESULT_CACHE = ResultCache(Config.RESULT_CACHE_DIR, Config.RESULT_CACHE_MAX_BYTES)
@@ -0,0 +1,387 @@
+"""上傳檔案的非同步儲存
+
+上傳直接從請求串流解析 (receive_form)，不經 Starlette 先行暫存整個請求；
+內容以固定大小的區塊邊寫入暫存檔邊計算 SHA-256 (寫入與雜湊在執行緒中進行，不阻塞事件迴圈)，
+完成後將暫存檔移動 (不複製) 到依內容雜湊命名的 `UPLOADS_DIR/<雜湊前兩碼>/<雜湊><副檔名>`：
+同名檔案同時上傳不會互相覆寫，相同內容只保存一份。
+單一檔案與單次請求的總大小分別受 `Config.UPLOAD_MAX_FILE_BYTES`、`Config.UPLOAD_MAX_REQUEST_BYTES` 限制，
+超過時在讀取過程中即停止並引發 UploadTooLargeError。
+
+呼叫端允許時 (單一檔案的轉換工作)，不超過 `Config.UPLOAD_SPOOL_MAX_BYTES` 的上傳先保留在記憶體中，
+轉換時以 DocumentStream 直接交給 docling，省去寫入後再讀回的磁碟往返；超過門檻才寫入磁碟。
+`Config.UPLOAD_RETAIN=false` 時不保存上傳檔案：記憶體中的上傳不寫入磁碟，寫入磁碟的上傳在轉換後刪除
+(服務在轉換前重啟時，只存在記憶體中的上傳會遺失，該工作以錯誤結束)。
+"""
+import asyncio
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request
+
+from config import UPLOADS_DIR, Config
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.multipart import parse_options_header
+
+# 副檔名只保留安全字元 (docling 依副檔名判斷輸入格式)
+_SAFE_SUFFIX_PATTERN = re.compile(r"^\.[A-Za-z0-9]{1,10}$")
+# 表單欄位與 multipart 標頭等非檔案內容的容許量
+_MAX_FORM_OVERHEAD_BYTES = 1024 * 1024
+
+_lock = threading.Lock()
+_stats = {"stored": 0, "deduplicated": 0, "bytes_received": 0, "rejected": 0, "in_memory": 0}
+# 記憶體中的上傳內容 (鍵 -> 位元組)，轉換工作結束時釋放
+_memory: Dict[str, bytes] = {}
+_memory_bytes = 0
+
+class UploadTooLargeError(ValueError):
+    """上傳檔案或請求總大小超過上限 (對應 HTTP 413)"""
+    status_code = 413
+
+class UploadBudget:
+    """單次請求的上傳大小額度，同一請求中的所有檔案共用"""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = Config.UPLOAD_MAX_REQUEST_BYTES if max_bytes is None else max_bytes
+        self.used = 0
+        self.spooled = 0  # 目前保留在記憶體緩衝中的位元組數
+
+    def consume(self, size: int) -> None:
+        self.used += size
+        if self.max_bytes and self.used > self.max_bytes:
+            raise UploadTooLargeError(f"請求的上傳總大小超過上限 ({self.max_bytes} bytes)")
+
+    def spool(self, size: int) -> bool:
+        """請求中所有檔案的記憶體緩衝合計不超過 `Config.UPLOAD_SPOOL_MAX_BYTES` 時佔用額度並返回 True"""
+        if self.spooled + size > Config.UPLOAD_SPOOL_MAX_BYTES:
+            return False
+        self.spooled += size
+        return True
+
+    def unspool(self, size: int) -> None:
+        self.spooled = max(0, self.spooled - size)
+
+class StoredUpload:
+    """已儲存的上傳檔案"""
+
+    def __init__(
+        self,
+        path: Path,
+        sha256: str,
+        size: int,
+        original_filename: str,
+        deduplicated: bool,
+        memory_key: Optional[str] = None,
+        retained: bool = True,
+    ):
+        self.path = path  # 未保存於磁碟時 (只在記憶體中) 此路徑不存在，只提供名稱與副檔名
+        self.sha256 = sha256
+        self.size = size
+        self.original_filename = original_filename
+        self.deduplicated = deduplicated
+        self.memory_key = memory_key  # 內容保留在記憶體中時，以 memory_data() 取得
+        self.retained = retained  # False 時轉換後以 discard() 刪除
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "path": str(self.path),
+            "sha256": self.sha256,
+            "size": self.size,
+            "original_filename": self.original_filename,
+            "deduplicated": self.deduplicated,
+            "memory_key": self.memory_key,
+            "retained": self.retained,
+        }
+
+def _suffix(filename: Optional[str]) -> str:
+    suffix = Path(filename or "").suffix.lower()
+    return suffix if _SAFE_SUFFIX_PATTERN.match(suffix) else ""
+
+def stored_path(sha256: str, filename: Optional[str]) -> Path:
+    """內容雜湊對應的儲存路徑"""
+    return UPLOADS_DIR / sha256[:2] / f"{sha256}{_suffix(filename)}"
+
+def _hold(data: bytes) -> Optional[str]:
+    """將上傳內容保留在記憶體中，超過 `Config.UPLOAD_MEMORY_MAX_BYTES` 總量時返回 None"""
+    global _memory_bytes
+    with _lock:
+        if _memory_bytes + len(data) > Config.UPLOAD_MEMORY_MAX_BYTES:
+            return None
+        key = uuid.uuid4().hex
+        _memory[key] = data
+        _memory_bytes += len(data)
+        _stats["in_memory"] += 1
+    return key
+
+def memory_data(memory_key: Optional[str]) -> Optional[bytes]:
+    """取得記憶體中的上傳內容；不存在 (已釋放或服務已重啟) 時返回 None"""
+    if not memory_key:
+        return None
+    with _lock:
+        return _memory.get(memory_key)
+
+def discard(file_path: Optional[str], memory_key: Optional[str] = None, retained: bool = True) -> None:
+    """轉換工作結束後釋放記憶體中的上傳內容，未保存的上傳檔案一併刪除"""
+    global _memory_bytes
+    if memory_key:
+        with _lock:
+            data = _memory.pop(memory_key, None)
+            if data is not None:
+                _memory_bytes -= len(data)
+    if not retained and file_path:
+        Path(file_path).unlink(missing_ok=True)
+
+def _spill(buffer: io.BytesIO, staging_dir: Path, suffix: str):
+    """將記憶體緩衝寫入暫存檔，返回 (檔案物件, 路徑)"""
+    fd, tmp_path = tempfile.mkstemp(dir=staging_dir, suffix=suffix)
+    handle = os.fdopen(fd, "wb")
+    handle.write(buffer.getbuffer())
+    return handle, tmp_path
+
+def _write_chunk(handle, digest, chunk: bytes) -> None:
+    # hashlib 處理大區塊時會釋放 GIL，與寫入一起在執行緒中進行
+    digest.update(chunk)
+    handle.write(chunk)
+
+def _commit(tmp_path: str, target: Path) -> bool:
+    """將暫存檔移到內容定址路徑，已有相同內容時捨棄暫存檔並返回 True"""
+    if target.is_file():
+        os.unlink(tmp_path)
+        os.utime(target)  # 更新修改時間，供清理舊上傳時判斷
+        return True
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp_path, target)
+    return False
+
+class IncomingUpload:
+    """接收中的上傳檔案：邊接收邊計算雜湊並寫入暫存檔，接收完成後以 store() 移入儲存
+
+    請求中所有檔案合計不超過 `Config.UPLOAD_SPOOL_MAX_BYTES` 的內容先保留在記憶體緩衝，超過時才寫入暫存檔。
+    """
+
+    def __init__(self, filename: str, budget: UploadBudget, staging_dir: Path):
+        self.filename = filename
+        self.error: Optional[UploadTooLargeError] = None  # 單一檔案超過上限時記錄於此，store() 時引發
+        self._budget = budget
+        self._staging_dir = staging_dir
+        self._suffix = _suffix(filename)
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._handle = None
+        self._tmp_path: Optional[str] = None
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    async def write(self, data: bytes) -> None:
+        if self.error is not None:
+            return
+        self.size += len(data)
+        max_file = Config.UPLOAD_MAX_FILE_BYTES
+        if max_file and self.size > max_file:
+            self.error = UploadTooLargeError(f"檔案 {self.filename} 超過大小上限 ({max_file} bytes)")
+            with _lock:
+                _stats["rejected"] += 1
+            self.close()
+            return
+        # 解析器每次交付的片段很小，累積到一個區塊再交給執行緒寫入與雜湊
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= max(64 * 1024, Config.UPLOAD_CHUNK_SIZE):
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.error is not None or not self._pending:
+            return
+        chunk = b"".join(self._pending)
+        self._pending.clear()
+        self._pending_bytes = 0
+        if self._handle is None and not self._budget.spool(len(chunk)):
+            self._budget.unspool(self._buffer.tell())
+            self._handle, self._tmp_path = await asyncio.to_thread(_spill, self._buffer, self._staging_dir, self._suffix)
+            self._buffer = None
+        await asyncio.to_thread(_write_chunk, self._handle if self._handle is not None else self._buffer, self._digest, chunk)
+
+    async def store(self, in_memory: bool = False) -> StoredUpload:
+        """將接收完成的上傳移入內容定址儲存 (暫存檔直接移動，不再複製)，返回 StoredUpload
+
+        in_memory=True 時，仍在記憶體緩衝中的上傳保留在記憶體中 (見模組說明)；呼叫端須在轉換結束後以 discard() 釋放。
+        """
+        if self.error is not None:
+            raise self.error
+        retain = Config.UPLOAD_RETAIN
+        memory_key: Optional[str] = None
+        deduplicated = False
+        try:
+            await self.flush()
+            sha256 = self._digest.hexdigest()
+            target = stored_path(sha256, self.filename)
+            if self._handle is None and in_memory:
+                memory_key = _hold(self._buffer.getvalue())
+            if self._handle is None and (memory_key is None or retain):
+                # 需要保存上傳或記憶體額度不足時，將緩衝內容寫入磁碟 (記憶體中的內容仍供轉換直接使用)
+                self._handle, self._tmp_path = await asyncio.to_thread(_spill, self._buffer, self._staging_dir, self._suffix)
+            if self._handle is not None:
+                await asyncio.to_thread(self._handle.close)
+                self._handle = None
+                if retain:
+                    deduplicated = await asyncio.to_thread(_commit, self._tmp_path, target)
+                else:
+                    # 不保存的上傳使用專屬的暫存檔，轉換後刪除不影響其他請求
+                    target = Path(self._tmp_path)
+                self._tmp_path = None
+        except BaseException:
+            discard(None, memory_key)
+            raise
+        finally:
+            self.close()
+
+        with _lock:
+            _stats["deduplicated" if deduplicated else "stored"] += 1
+            _stats["bytes_received"] += self.size
+        location = "記憶體" if memory_key and not retain else str(target)
+        print(f"[upload_service] 檔案已儲存至: {location} ({self.size} bytes{', 內容重複' if deduplicated else ''})")
+        return StoredUpload(target, sha256, self.size, self.filename, deduplicated, memory_key=memory_key, retained=retain)
+
+    def close(self) -> None:
+        """釋放緩衝並刪除尚未移入儲存的暫存檔 (可重複呼叫)"""
+        if self._buffer is not None:
+            self._budget.unspool(self._buffer.tell())
+            self._buffer = None
+        self._pending.clear()
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        if self._tmp_path is not None:
+            Path(self._tmp_path).unlink(missing_ok=True)
+            self._tmp_path = None
+
+async def receive_form(request: Request, budget: Optional[UploadBudget] = None) -> Tuple[Dict[str, List[str]], List[IncomingUpload]]:
+    """直接從請求串流解析 multipart/form-data，返回 (表單欄位, 上傳檔案)
+
+    不經過 Starlette 的表單解析 (會先將整個請求暫存後才交給路由)：上傳內容邊接收邊寫入暫存檔，
+    請求總大小與單一檔案大小在接收過程中即檢查。請求總大小超過上限時停止接收並引發 UploadTooLargeError；
+    單一檔案超過上限時只記錄在該檔案 (IncomingUpload.error)，其餘檔案照常接收。
+    發生錯誤時已接收的暫存檔一併刪除；成功時呼叫端須對每個上傳呼叫 store() 或 close()。
+    """
+    budget = budget or UploadBudget()
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("請求必須是 multipart/form-data")
+    # 表單欄位與各部分標頭另計，不佔用檔案的額度
+    max_body = budget.max_bytes + _MAX_FORM_OVERHEAD_BYTES if budget.max_bytes else 0
+    declared = request.headers.get("content-length", "")
+    if max_body and declared.isdigit() and int(declared) > max_body:
+        with _lock:
+            _stats["rejected"] += 1
+        raise UploadTooLargeError(f"請求的上傳總大小超過上限 ({budget.max_bytes} bytes)")
+    staging_dir = UPLOADS_DIR / ".incoming"
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    events: List[Tuple[str, Any]] = []
+    header_field = bytearray()
+    header_value = bytearray()
+    headers: Dict[bytes, bytes] = {}
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header_value.extend(data[start:end])
+
+    def on_header_end() -> None:
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished() -> None:
+        events.append(("part", dict(headers)))
+        headers.clear()
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        events.append(("data", data[start:end]))
+
+    def on_part_end() -> None:
+        events.append(("end", None))
+
+    parser = multipart.MultipartParser(boundary, {
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    fields: Dict[str, List[str]] = {}
+    uploads: List[IncomingUpload] = []
+    current: Optional[IncomingUpload] = None
+    field_name = ""
+    field_value = bytearray()
+    received = 0
+
+    async def handle_events() -> None:
+        nonlocal current, field_name
+        for kind, value in events:
+            if kind == "part":
+                _, options = parse_options_header(value.get(b"content-disposition"))
+                field_name = options.get(b"name", b"").decode("utf-8", "replace")
+                filename = options.get(b"filename")
+                current = IncomingUpload(filename.decode("utf-8", "replace"), budget, staging_dir) if filename is not None else None
+                if current is not None:
+                    uploads.append(current)
+            elif kind == "data":
+                if current is not None:
+                    budget.consume(len(value))
+                    await current.write(value)
+                else:
+                    field_value.extend(value)
+                    if len(field_value) > _MAX_FORM_OVERHEAD_BYTES:
+                        raise ValueError(f"表單欄位 {field_name} 過大")
+            elif current is not None:
+                await current.flush()
+                current = None
+            else:
+                fields.setdefault(field_name, []).append(field_value.decode("utf-8", "replace"))
+                field_value.clear()
+        events.clear()
+
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if max_body and received > max_body:
+                raise UploadTooLargeError(f"請求的上傳總大小超過上限 ({budget.max_bytes} bytes)")
+            parser.write(chunk)
+            await handle_events()
+        parser.finalize()
+        await handle_events()
+    except BaseException as e:
+        for upload in uploads:
+            upload.close()
+        if isinstance(e, UploadTooLargeError):
+            with _lock:
+                _stats["rejected"] += 1
+        raise
+    return fields, uploads
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "max_file_bytes": Config.UPLOAD_MAX_FILE_BYTES,
+            "max_request_bytes": Config.UPLOAD_MAX_REQUEST_BYTES,
+            "retain": Config.UPLOAD_RETAIN,
+            "memory_bytes": _memory_bytes,
+            "memory_uploads": len(_memory),
+            **_stats,
+        }
@@ -0,0 +1,84 @@
+"""URL 來源快取
+
+記錄每個 URL 最近一次下載的 ETag / Last-Modified 與內容雜湊。再次轉換同一個 URL 時，
+若該內容的轉換結果仍在結果快取中，先以條件式請求 (If-None-Match / If-Modified-Since) 確認遠端文件是否變更；
+遠端回應 304 時直接使用快取結果，略過下載與轉換。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from config import Config
+
+_lock = threading.Lock()
+_stats = {"revalidated": 0, "not_modified": 0, "modified": 0}
+
+def _entry_path(url: str) -> Path:
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return Config.URL_CACHE_DIR / key[:2] / f"{key}.json"
+
+def lookup(url: str) -> Optional[Dict[str, Any]]:
+    """返回 URL 的快取項目 ({"url", "etag", "last_modified", "sha256", "extension", "size", "fetched_at"})"""
+    if not Config.URL_CACHE_ENABLED:
+        return None
+    path = _entry_path(url)
+    try:
+        entry = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[url_cache] 忽略損壞的快取項目 {path}: {e}")
+        path.unlink(missing_ok=True)
+        return None
+    return entry if entry.get("url") == url else None
+
+def conditional_headers(entry: Dict[str, Any]) -> Dict[str, str]:
+    """依快取項目組合條件式請求標頭；沒有可用的驗證值時返回空字典"""
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def record(url: str, download) -> None:
+    """記錄下載結果 (download 為 download_service.DownloadedFile)；遠端沒有提供驗證值時移除舊項目"""
+    if not Config.URL_CACHE_ENABLED:
+        return
+    path = _entry_path(url)
+    if not (download.etag or download.last_modified):
+        path.unlink(missing_ok=True)
+        return
+    entry = {
+        "url": url,
+        "etag": download.etag,
+        "last_modified": download.last_modified,
+        "sha256": download.sha256,
+        "extension": download.extension,
+        "size": download.size,
+        "fetched_at": time.time(),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 同一網址可能被並行下載：每次寫入使用各自的暫存檔，避免互相覆寫或搬走對方的檔案
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+def record_revalidation(not_modified: bool) -> None:
+    with _lock:
+        _stats["revalidated"] += 1
+        _stats["not_modified" if not_modified else "modified"] += 1
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return {"enabled": Config.URL_CACHE_ENABLED, **_stats}
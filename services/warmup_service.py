@@ -0,0 +1,144 @@
+"""模型預熱服務
+
+在應用程式啟動時預先建立常用選項的轉換器，並執行一次極小的合成轉換，
+讓 layout、TableFormer 與 OCR 等延遲載入的模型權重在第一個請求之前載入記憶體。
+"""
+import asyncio
+import io
+import time
+import traceback
+from typing import Dict, Any, List, Optional
+
+from PIL import Image, ImageDraw
+from docling.datamodel.base_models import DocumentStream, InputFormat
+
+from config import Config
+from models import ConversionOptions
+from services import conversion_service, conversion_executor
+
+# 預熱狀態，供 /readyz 查詢
+WARMUP_STATE: Dict[str, Any] = {
+    "status": "pending",  # pending / running / ready / error
+    "started_at": None,
+    "finished_at": None,
+    "profiles": [],
+    "error": None,
+}
+
+def build_warmup_pdf() -> bytes:
+    """產生一頁含文字與簡單表格的合成 PDF，用於觸發各模型載入"""
+    image = Image.new("RGB", (600, 400), "white")
+    draw = ImageDraw.Draw(image)
+    draw.text((40, 30), "Docling warm-up document", fill="black")
+    draw.text((40, 60), "This page forces layout, table and OCR models to load.", fill="black")
+
+    # 繪製 3x3 的表格格線與內容
+    left, top, cell_w, cell_h = 40, 120, 160, 50
+    for row in range(4):
+        draw.line([(left, top + row * cell_h), (left + 3 * cell_w, top + row * cell_h)], fill="black", width=2)
+    for col in range(4):
+        draw.line([(left + col * cell_w, top), (left + col * cell_w, top + 3 * cell_h)], fill="black", width=2)
+    for row in range(3):
+        for col in range(3):
+            draw.text((left + col * cell_w + 10, top + row * cell_h + 18), f"R{row + 1}C{col + 1}", fill="black")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PDF", resolution=72.0)
+    return buffer.getvalue()
+
+def warm_up_profile(options: ConversionOptions, run_sample: bool = True) -> Dict[str, Any]:
+    """預熱單一選項組合：建立轉換器、初始化 pipeline，並視需要執行合成轉換"""
+    start = time.perf_counter()
+    converter = conversion_service.get_converter(options)
+
+    # 先初始化 PDF pipeline (建立模型物件)
+    if hasattr(converter, "initialize_pipeline"):
+        converter.initialize_pipeline(InputFormat.PDF)
+    init_time = time.perf_counter() - start
+
+    sample_time = None
+    if run_sample:
+        sample_start = time.perf_counter()
+        stream = DocumentStream(name="warmup.pdf", stream=io.BytesIO(build_warmup_pdf()))
+        converter.convert(stream)
+        sample_time = time.perf_counter() - sample_start
+
+    return {
+        "pipeline": options.pipeline.value if hasattr(options.pipeline, "value") else str(options.pipeline),
+        "ocr": options.ocr,
+        "init_time": round(init_time, 3),
+        "sample_time": round(sample_time, 3) if sample_time is not None else None,
+    }
+
+def warm_up(profiles: Optional[List[ConversionOptions]] = None, run_sample: Optional[bool] = None) -> Dict[str, Any]:
+    """依設定的選項清單預熱轉換器 (同步執行，應於背景執行緒呼叫)"""
+    profiles = profiles if profiles is not None else Config.WARMUP_PROFILES
+    run_sample = Config.WARMUP_RUN_SAMPLE if run_sample is None else run_sample
+
+    WARMUP_STATE.update({
+        "status": "running",
+        "started_at": time.time(),
+        "finished_at": None,
+        "profiles": [],
+        "error": None,
+    })
+    print(f"[warmup] 開始預熱 {len(profiles)} 組轉換選項")
+
+    try:
+        for options in profiles:
+            profile_info = warm_up_profile(options, run_sample=run_sample)
+            WARMUP_STATE["profiles"].append(profile_info)
+            print(f"[warmup] 已預熱: {profile_info}")
+        WARMUP_STATE["status"] = "ready"
+    except Exception as e:
+        print(f"[warmup] 預熱失敗: {e}")
+        traceback.print_exc()
+        WARMUP_STATE["status"] = "error"
+        WARMUP_STATE["error"] = str(e)
+    finally:
+        WARMUP_STATE["finished_at"] = time.time()
+
+    return WARMUP_STATE
+
+def mark_ready() -> None:
+    """停用預熱時直接標記為就緒"""
+    now = time.time()
+    WARMUP_STATE.update({"status": "ready", "started_at": now, "finished_at": now})
+
+def is_ready() -> bool:
+    """預熱是否已完成"""
+    return WARMUP_STATE["status"] == "ready"
+
+async def run_startup_warmup() -> None:
+    """啟動時的預熱流程 (由 app lifespan 於背景呼叫)
+
+    使用工作行程時，預熱在每個工作行程內執行，這裡只等待所有行程回報就緒。
+    """
+    executor = conversion_executor.EXECUTOR
+    if not executor.uses_processes:
+        if Config.WARMUP_ENABLED:
+            await asyncio.to_thread(warm_up)
+        else:
+            mark_ready()
+        return
+
+    WARMUP_STATE.update({
+        "status": "running",
+        "started_at": time.time(),
+        "finished_at": None,
+        "profiles": [],
+        "error": None,
+    })
+    infos = await executor.wait_ready()
+
+    errors = []
+    for info in infos:
+        worker_state = info.get("warmup")
+        WARMUP_STATE["profiles"].append({"pid": info.get("pid"), "warmup": worker_state})
+        if worker_state is not None and worker_state.get("status") != "ready":
+            errors.append(f"pid {info.get('pid')}: {worker_state.get('error')}")
+
+    WARMUP_STATE["status"] = "error" if errors else "ready"
+    WARMUP_STATE["error"] = "; ".join(errors) if errors else None
+    WARMUP_STATE["finished_at"] = time.time()
+    print(f"[warmup] 工作行程預熱結束，狀態: {WARMUP_STATE['status']}")
@@ -0,0 +1,139 @@
+"""services/image_rewriter.py 的掃描與改寫測試
+
+直接載入模組檔案，不經過 services/__init__.py (避免匯入 docling)。
+
+用法:
+    python -m pytest tests/test_image_rewriter.py
+"""
+import importlib.util
+from pathlib import Path
+
+_MODULE_PATH = Path(__file__).resolve().parent.parent / "services" / "image_rewriter.py"
+_spec = importlib.util.spec_from_file_location("image_rewriter", _MODULE_PATH)
+image_rewriter = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(image_rewriter)
+
+PNG_DATA = "iVBORw0KGgoAAAANSUhEUg=="
+
+def _summary(references):
+    return [(ref.kind, ref.src, ref.alt) for ref in references]
+
+# --- scan_markdown ---
+
+def test_markdown_finds_data_path_and_placeholder_in_order():
+    content = f"a ![logo](data:image/png;base64,{PNG_DATA}) b ![圖](images/a.png)\n<!-- image -->\n"
+    references = list(image_rewriter.scan_markdown(content))
+    assert [ref.kind for ref in references] == ["data", "path", "placeholder"]
+    data, path, placeholder = references
+    assert data.alt == "logo"
+    assert data.image_type == "png"
+    assert data.base64_data == PNG_DATA
+    assert data.data_length == len(PNG_DATA)
+    assert data.text == f"![logo](data:image/png;base64,{PNG_DATA})"
+    assert (path.src, path.alt) == ("images/a.png", "圖")
+    assert placeholder.text == image_rewriter.PLACEHOLDER
+
+def test_markdown_skips_remote_absolute_and_non_image_data_uris():
+    content = (
+        "![a](http://example.com/a.png) ![b](https://example.com/b.png) ![c](/static/c.png) "
+        "![d](data:application/pdf;base64,JVBERi0=) ![e](data:text/plain,hello) ![f]() ![g](g.png)"
+    )
+    assert _summary(image_rewriter.scan_markdown(content)) == [("path", "g.png", "g")]
+
+def test_markdown_data_uri_without_base64_marker_is_skipped():
+    content = "![a](data:image/svg+xml,%3Csvg%3E) ![b](b.png)"
+    assert _summary(image_rewriter.scan_markdown(content)) == [("path", "b.png", "b")]
+
+def test_markdown_unterminated_alt_does_not_swallow_next_image():
+    # "![" 沒有在同一行以 "](" 結束時，不應吃掉下一行的圖片
+    content = "![沒有結尾\n![ok](ok.png)"
+    assert _summary(image_rewriter.scan_markdown(content)) == [("path", "ok.png", "ok")]
+
+def test_markdown_unterminated_bang_at_end():
+    assert list(image_rewriter.scan_markdown("文字 ![")) == []
+    assert list(image_rewriter.scan_markdown("![alt")) == []
+
+def test_markdown_unterminated_src_stops_without_error():
+    content = "![a](a.png) ![b](b.png"
+    assert _summary(image_rewriter.scan_markdown(content)) == [("path", "a.png", "a")]
+
+def test_markdown_placeholder_before_image():
+    content = "<!-- image --> ![a](a.png)"
+    assert [ref.kind for ref in image_rewriter.scan_markdown(content)] == ["placeholder", "path"]
+
+# --- scan_html ---
+
+def test_html_quoted_unquoted_and_single_quoted_src():
+    content = '<img src="a.png" alt="A"><img src=b.png alt=B><img alt=\'C\' src=\'c.png\'>'
+    assert _summary(image_rewriter.scan_html(content)) == [
+        ("path", "a.png", "A"),
+        ("path", "b.png", "B"),
+        ("path", "c.png", "C"),
+    ]
+
+def test_html_data_uri_with_alt_after_src():
+    content = f'<p><img src="data:image/jpeg;base64,{PNG_DATA}" width=10 alt="照片"/></p>'
+    (reference,) = image_rewriter.scan_html(content)
+    assert reference.kind == "data"
+    assert reference.image_type == "jpeg"
+    assert reference.base64_data == PNG_DATA
+    assert reference.alt == "照片"
+    assert reference.text == content[len("<p>"):-len("</p>")]
+
+def test_html_ignores_tags_that_only_start_with_img():
+    content = '<imgx src="a.png"><image src="b.png"><img\nsrc="c.png"><img/src="d.png">'
+    assert [ref.src for ref in image_rewriter.scan_html(content)] == ["c.png", "d.png"]
+
+def test_html_skips_non_image_data_remote_and_missing_src():
+    content = (
+        '<img src="data:text/html;base64,PGI+"><img src="data:image/png,raw">'
+        '<img src="https://example.com/a.png"><img src="/static/a.png"><img alt="x"><img src="">'
+        '<img src="ok.png">'
+    )
+    assert [ref.src for ref in image_rewriter.scan_html(content)] == ["ok.png"]
+
+def test_html_attribute_names_are_case_insensitive_and_first_wins():
+    content = '<IMG SRC="a.png" src="b.png" ALT="A">'
+    # 標籤名稱區分大小寫 (docling 輸出小寫)，大寫 <IMG> 不處理
+    assert list(image_rewriter.scan_html(content)) == []
+    content = '<img SRC="a.png" src="b.png" ALT="A">'
+    assert _summary(image_rewriter.scan_html(content)) == [("path", "a.png", "A")]
+
+def test_html_unterminated_tag_stops_without_error():
+    content = '<img src="a.png"> <img src="b.png"'
+    assert [ref.src for ref in image_rewriter.scan_html(content)] == ["a.png"]
+
+def test_html_placeholder():
+    content = '<!-- image --><img src="a.png">'
+    assert [ref.kind for ref in image_rewriter.scan_html(content)] == ["placeholder", "path"]
+
+# --- rewrite ---
+
+def test_rewrite_replaces_selected_references_and_counts():
+    content = f"A ![x](data:image/png;base64,{PNG_DATA}) B ![y](y.png) C <!-- image --> D"
+    counts = {}
+
+    def replace(reference):
+        if reference.kind == "data":
+            return f"![{reference.alt}](/static/images/x.png)"
+        if reference.kind == "placeholder":
+            return ""
+        return None
+
+    result = image_rewriter.rewrite_markdown(content, replace, counts)
+    assert result == "A ![x](/static/images/x.png) B ![y](y.png) C  D"
+    assert counts == {"data": 1, "path": 1, "placeholder": 1, "replaced": 2}
+
+def test_rewrite_without_replacements_returns_same_object():
+    content = '<img src="a.png">'
+    assert image_rewriter.rewrite_html(content, lambda reference: None) is content
+
+def test_rewrite_html_keeps_surrounding_content():
+    content = '<p>前</p><img src=\'a.png\' alt=a><p>後</p>'
+    result = image_rewriter.rewrite_html(content, lambda reference: f'<img src="/static/images/{reference.src}">')
+    assert result == '<p>前</p><img src="/static/images/a.png"><p>後</p>'
+
+def test_rewrite_handles_adjacent_references():
+    content = "![a](a.png)![b](b.png)"
+    result = image_rewriter.rewrite_markdown(content, lambda reference: reference.src.upper())
+    assert result == "A.PNGB.PNG"